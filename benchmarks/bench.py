@@ -0,0 +1,318 @@
+"""
+Headless benchmarks of the npcl ops and solvers on synthetic data.
+
+Usage:
+    python benchmarks/bench.py [--quick] [--filter SUBSTRING]
+        [--save baseline.json] [--compare baseline.json] [--tolerance 0.2]
+
+Every benchmark reports its throughput in Mpix/s (pixels processed per
+second, times the number of iterations for iterative algorithms) and, for
+iterative algorithms, iterations per second. Results can be saved as a
+baseline, and a later run compared against it: a benchmark is flagged
+when its throughput dropped by more than the tolerance, or when its
+result checksum changed.
+
+Iterative algorithms run a fixed number of iterations (tolerances set to
+zero), so that runs are comparable. Runs on any OpenCL device, including
+CPU runtimes such as PoCL; select one with PYOPENCL_CTX.
+"""
+import argparse
+import json
+import sys
+from time import perf_counter
+import numpy as np
+import pyopencl as cl
+import npcl
+from npcl.ops import convolve as conv
+from npcl.ops import local
+from npcl.regularizers.local import denoise_tv
+from npcl.solvers.cg import solve_cg
+from npcl.solvers.fbs import solve_fbs
+from npcl.solvers.fista import solve_fista, solve_gfista
+from npcl.solvers.flb import solve_flb
+from npcl.solvers.inpaint import inpaint_h1, inpaint_tv
+from npcl.solvers.deconv import deconv_fbs, deconv_fista, deconv_sv_fbs
+from npcl.solvers.pdhg import deconv_pdhg
+
+
+PADDINGS = ('zero', 'same', 'wrap')
+
+
+def image(n, seed=0):
+    # smooth synthetic image with edges, in [0, 1]
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:n, :n]/float(n)
+    img = 0.5+0.25*np.sin(12*x)*np.cos(9*y)
+    img[n//4:n//2, n//4:3*n//4] += 0.25
+    return (img+0.05*rng.randn(n, n)).astype(np.float32)
+
+
+def gaussian(size, sigma=None):
+    sigma = size/4. if sigma is None else sigma
+    r = np.arange(size)-size//2
+    k = np.exp(-(r[:, None]**2+r[None, :]**2)/(2*sigma**2))
+    return (k/k.sum()).astype(np.float32)
+
+
+def sv_kernel(size, shape):
+    # spatially-variant gaussian blur, widening from left to right
+    k = np.empty((size, size)+shape, np.float32)
+    for j in range(shape[1]):
+        k[..., j] = gaussian(size, size/8.+size/4.*j/shape[1])[..., None]
+    return k
+
+
+def checksum(res):
+    if isinstance(res, tuple):
+        res = res[0]
+    x = res.get().astype(np.float64)
+    return [float(x.sum()), float(np.sqrt((x**2).sum()))]
+
+
+def timeit(func, queue, min_time=0.2, max_repeat=20):
+    """
+    Median wall time of func() after one warm-up call, which also
+    compiles the kernels. Returns the time and the result of func.
+    """
+    res = func()
+    queue.finish()
+    times = []
+    total = 0.
+    while total < min_time and len(times) < max_repeat:
+        t = perf_counter()
+        res = func()
+        queue.finish()
+        times.append(perf_counter()-t)
+        total += times[-1]
+    return float(np.median(times)), res
+
+
+def variant(x, k, padding, entry):
+    # direct convolution with a given kernel variant
+    return lambda: conv.convolve2d_direct(x, k, padding, entry)
+
+
+def benchmarks(quick=False):
+    """
+    Yield (name, func, pixels, iterations) for every benchmark, where
+    func runs it once, and iterations is None for non-iterative ones.
+    """
+    sizes = (256,) if quick else (256, 1024)
+    ksizes = (3, 7) if quick else (3, 7, 15)
+    TS = int(conv.get_tile_size(npcl._queue(None).device))
+    local_tile = {'path': 'local', 'tile': (TS, TS)}
+    for n in sizes:
+        x = npcl.to_device(image(n))
+        for ks in ksizes:
+            k = npcl.to_device(gaussian(ks))
+            for padding in PADDINGS:
+                def run(method, x=x, k=k, padding=padding):
+                    return lambda: conv.convolve2d(x, k, padding, method)
+                tag = '%dx%d/k%d/%s' % (n, n, ks, padding)
+                yield 'convolve2d/local/'+tag, variant(
+                    x, k, padding, local_tile), n*n, None
+                yield 'convolve2d/global/'+tag, variant(
+                    x, k, padding, {'path': 'global'}), n*n, None
+                yield 'convolve2d/direct/'+tag, run('direct'), n*n, None
+                yield 'convolve2d/separable/'+tag, \
+                    run('separable'), n*n, None
+                yield 'convolve2d/fft/'+tag, run('fft'), n*n, None
+
+    n = 256
+    x = npcl.to_device(image(n))
+    for ks in (3, 7):
+        k = npcl.to_device(sv_kernel(ks, (n, n)))
+        for padding in PADDINGS:
+            tag = '%dx%d/k%d/%s' % (n, n, ks, padding)
+            for name, entry in (('local', local_tile),
+                                ('global', {'path': 'global'})):
+                yield 'convolve2d_sv/%s/%s' % (name, tag), \
+                    (lambda k=k, padding=padding, entry=entry:
+                        conv.convolve2d_sv(x, k, padding, variant=entry)
+                     ), n*n, None
+            yield 'correlate2d_sv/'+tag, \
+                (lambda k=k, padding=padding:
+                    conv.correlate2d_sv(x, k, padding)), n*n, None
+
+    for n in sizes:
+        x = npcl.to_device(image(n))
+        gx, gy = local.grad2d(x)
+        tag = '%dx%d' % (n, n)
+        yield 'local/grad2d/'+tag, lambda x=x: local.grad2d(x), n*n, None
+        yield 'local/norm2d/'+tag, \
+            lambda gx=gx, gy=gy: local.norm2d(gx, gy), n*n, None
+        yield 'local/divergence2d/'+tag, \
+            lambda gx=gx, gy=gy: local.divergence2d(gx, gy), n*n, None
+        yield 'local/tv_primal/'+tag, \
+            (lambda x=x, gx=gx, gy=gy:
+                local.tv_primal(x, gx, gy)), n*n, None
+        yield 'local/tv_step/'+tag, \
+            (lambda x=x, gx=gx, gy=gy:
+                local.tv_step(x, gx, gy, np.float32(0.25), np.float32(0.1))
+             ), n*n, None
+        yield 'local/soft_shrink/'+tag, \
+            lambda x=x: local.soft_shrink(x, np.float32(0.5)), n*n, None
+        n_iter = 20 if quick else 50
+        yield 'denoise_tv/'+tag, \
+            (lambda x=x, n_iter=n_iter:
+                denoise_tv(x, 0.1, eps=0., n_iter_max=n_iter)), n*n, n_iter
+
+    for name, func, pixels, iterations in solver_benchmarks(quick):
+        yield name, func, pixels, iterations
+
+
+def solver_benchmarks(quick=False):
+    n = 256
+    n_iter = 10 if quick else 30
+    tag = '%dx%d' % (n, n)
+    psf = npcl.to_device(gaussian(7))
+    psf_T = conv.transpose2d(psf)
+    truth = npcl.to_device(image(n))
+    b = conv.convolve2d(truth, psf)
+    ATb = conv.convolve2d(b, psf_T)
+    zero = np.float32(0)
+    mu = np.float32(1e-3)
+
+    def ATA(x):
+        return conv.convolve2d(conv.convolve2d(x, psf), psf_T)
+
+    def A_cg(x):
+        # A^TA + mu I, symmetric positive definite
+        return ATA(x)+mu*x
+
+    def prox(x, mu):
+        return denoise_tv(x, mu, eps=0., n_iter_max=5)
+
+    def A(x):
+        return conv.convolve2d(x, psf)
+
+    yield 'solve_cg/'+tag, lambda: solve_cg(
+        A_cg, ATb, b, tol=zero, max_iter=n_iter), n*n, n_iter
+    yield 'solve_cg_device/'+tag, lambda: solve_cg(
+        A_cg, ATb, b, tol=zero, max_iter=n_iter, sync_every=10,
+        ), n*n, n_iter
+    yield 'solve_fbs/'+tag, lambda: solve_fbs(
+        ATA, ATb, b, prox, delta=np.float32(1.5), mu=mu, tol=zero,
+        max_iter=n_iter), n*n, n_iter
+    yield 'solve_fista/'+tag, lambda: solve_fista(
+        ATA, ATb, b, prox, delta=np.float32(1.5), mu=mu, tol=zero,
+        max_iter=n_iter), n*n, n_iter
+    yield 'solve_gfista/'+tag, lambda: solve_gfista(
+        ATA, ATb, b, prox, mu=mu, tol=zero, max_iter=n_iter), n*n, n_iter
+    yield 'solve_flb/'+tag, lambda: solve_flb(
+        A, A, b, tol=zero, max_iter=n_iter), n*n, n_iter
+
+    mask = np.zeros((n, n), np.float32)
+    mask[::16] = 1
+    mask[:, ::16] = 1
+    mask = npcl.to_device(mask)
+    damaged = truth*(1-mask)
+    yield 'inpaint_h1/'+tag, lambda: inpaint_h1(
+        damaged, mask, tol=zero, max_iter=n_iter), n*n, n_iter
+    n_outer = max(n_iter//10, 1)
+    yield 'inpaint_tv/'+tag, lambda: inpaint_tv(
+        damaged, mask, tol=zero, max_iter=n_outer), n*n, n_outer
+
+    yield 'deconv_fbs/'+tag, lambda: deconv_fbs(
+        b, psf, tol=zero, max_iter=n_iter), n*n, n_iter
+    yield 'deconv_fista/'+tag, lambda: deconv_fista(
+        b, psf, tol=zero, max_iter=n_iter), n*n, n_iter
+    yield 'deconv_fista/wrap/'+tag, lambda: deconv_fista(
+        b, psf, tol=zero, max_iter=n_iter, padding='wrap'), n*n, n_iter
+    yield 'deconv_pdhg/'+tag, lambda: deconv_pdhg(
+        b, psf, tol=zero, max_iter=n_iter), n*n, n_iter
+    yield 'deconv_pdhg/precondition/'+tag, lambda: deconv_pdhg(
+        b, psf, tol=zero, max_iter=n_iter, precondition=True), n*n, n_iter
+    psf_sv = npcl.to_device(sv_kernel(7, (n, n)))
+    yield 'deconv_sv_fbs/'+tag, lambda: deconv_sv_fbs(
+        b, psf_sv, tol=zero, max_iter=n_iter), n*n, n_iter
+
+
+def run(quick=False, pattern=None, out=sys.stdout):
+    queue = npcl._queue(None)
+    results = {}
+    for name, func, pixels, iterations in benchmarks(quick):
+        if pattern is not None and pattern not in name:
+            continue
+        t, res = timeit(func, queue)
+        results[name] = {
+            'time': t,
+            'mpix_s': pixels*(iterations or 1)/t*1e-6,
+            'iter_s': None if iterations is None else iterations/t,
+            'checksum': checksum(res),
+            }
+        it_s = results[name]['iter_s']
+        out.write('%-48s %10.2f Mpix/s %12s\n' % (
+            name, results[name]['mpix_s'],
+            '' if it_s is None else '%.1f it/s' % it_s))
+        out.flush()
+    return results
+
+
+def compare(results, baseline, tolerance=0.2, rtol=1e-3):
+    """
+    Benchmarks slower than the baseline by more than tolerance (relative
+    throughput), or whose checksum differs by more than rtol.
+    """
+    flagged = []
+    for name, res in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = res['mpix_s']/base['mpix_s']
+        if ratio < 1-tolerance:
+            flagged.append('%s: %.2f Mpix/s, baseline %.2f Mpix/s (%+.0f%%)'
+                           % (name, res['mpix_s'], base['mpix_s'],
+                              100*(ratio-1)))
+        if not np.allclose(res['checksum'], base['checksum'], rtol=rtol):
+            flagged.append('%s: checksum %s, baseline %s' % (
+                name, res['checksum'], base['checksum']))
+    return flagged
+
+
+def device_info(queue):
+    device = queue.device
+    return {
+        'device': device.name.strip(),
+        'platform': device.platform.name.strip(),
+        'driver': device.driver_version,
+        'npcl': npcl.__version__,
+        'pyopencl': cl.VERSION_TEXT,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes only')
+    parser.add_argument('--filter', default=None,
+                        help='run the benchmarks whose name contains it')
+    parser.add_argument('--save', default=None,
+                        help='save the results as a baseline json file')
+    parser.add_argument('--compare', default=None,
+                        help='baseline json file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative throughput drop')
+    args = parser.parse_args(argv)
+
+    info = device_info(npcl._queue(None))
+    print('%(device)s (%(platform)s), npcl %(npcl)s' % info)
+    results = run(args.quick, args.filter)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'info': info, 'results': results}, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['info']['device'] != info['device']:
+            print('warning: baseline measured on %s' %
+                  baseline['info']['device'])
+        flagged = compare(results, baseline['results'], args.tolerance)
+        for line in flagged:
+            print('REGRESSION ' + line)
+        return 1 if flagged else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
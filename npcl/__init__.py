@@ -7,43 +7,80 @@ import numpy as np
 ctx = None
 queue = None
 
-from . import ops, regularizers, solvers
+from . import cache, registry, memory
+from . import ops, regularizers, solvers, tiling, multidevice, pipeline
+from . import tuning
+from .profiling import profile
 
 
-def create_ctx_queue():
+def create_ctx_queue(profiling=False):
     global ctx, queue
     ctx = cl.create_some_context(interactive=False)
-    queue = cl.CommandQueue(ctx)
+    properties = cl.command_queue_properties.PROFILING_ENABLE \
+        if profiling else 0
+    queue = cl.CommandQueue(ctx, properties=properties)
 
 
-def to_device(x, dtype=np.float32):
+def _queue(q):
+    if q is not None:
+        return q
     if ctx is None:
         create_ctx_queue()
-    return cl_array.to_device(queue, np.require(x, dtype, 'C'))
+    return queue
 
 
-def zeros(shape, dtype):
-    if ctx is None:
-        create_ctx_queue()
-    return cl_array.zeros(queue, shape, dtype)
+def to_device(x, dtype=np.float32, queue=None):
+    """
+    Copy x to the device as a dtype array (the dtype of x when dtype is
+    None). npcl kernels support float16, float32 and float64 arrays.
+
+    With memory.set_zero_copy() on a device sharing host memory, an
+    aligned C-contiguous dtype array x is not copied but wrapped: the
+    device array aliases x. See memory.aligned_empty.
+    """
+    queue = _queue(queue)
+    if dtype is None:
+        dtype = np.asarray(x).dtype
+    if memory.can_wrap(x, np.dtype(dtype), queue):
+        return memory.wrap(x, queue)
+    return cl_array.to_device(
+        queue, np.require(x, dtype, 'C'), allocator=memory.allocator(queue))
+
+
+def get(x):
+    """
+    Return the device array x on the host.
+
+    With memory.set_zero_copy() on a device sharing host memory, the
+    result maps the memory of x instead of copying it, see
+    memory.map_to_host.
+    """
+    if memory.zero_copy and x.flags.c_contiguous and x.size > 0 and \
+            memory.shares_host_memory(x.queue.device):
+        return memory.map_to_host(x)
+    return x.get()
+
+
+def zeros(shape, dtype, queue=None):
+    queue = _queue(queue)
+    return cl_array.zeros(
+        queue, shape, dtype, allocator=memory.allocator(queue))
 
 
 def zeros_like(x):
-    if ctx is None:
-        create_ctx_queue()
-    return cl_array.zeros_like(x)
+    return cl_array.zeros(
+        x.queue, x.shape, x.dtype, allocator=memory.allocator(x.queue))
 
 
-def empty(shape, dtype):
-    if ctx is None:
-        create_ctx_queue()
-    return cl_array.empty(queue, shape, dtype)
+def empty(shape, dtype, queue=None):
+    queue = _queue(queue)
+    return cl_array.empty(
+        queue, shape, dtype, allocator=memory.allocator(queue))
 
 
 def empty_like(x):
-    if ctx is None:
-        create_ctx_queue()
-    return cl_array.empty_like(x)
+    return cl_array.empty(
+        x.queue, x.shape, x.dtype, allocator=memory.allocator(x.queue))
 
 
 def get_local_mem_size(dev_id=0):
@@ -0,0 +1,162 @@
+"""
+Persistent on-disk cache of compiled OpenCL program binaries.
+
+Binaries are keyed by the kernel source, the build options and the
+platform/device/driver they were compiled for. A cache entry which fails
+to load (stale driver, corrupted file, ...) is silently rebuilt from source.
+
+The cache directory defaults to ~/.cache/npcl and can be changed with the
+NPCL_CACHE_DIR environment variable. Setting NPCL_NO_CACHE disables it.
+"""
+from glob import glob
+from hashlib import sha256
+import os
+import numpy as np
+import pyopencl as cl
+from .dtypes import render_file
+
+
+def cache_dir():
+    path = os.environ.get('NPCL_CACHE_DIR')
+    if path is None:
+        base = os.environ.get(
+            'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'),
+            )
+        path = os.path.join(base, 'npcl')
+    return path
+
+
+def cache_enabled():
+    return not os.environ.get('NPCL_NO_CACHE')
+
+
+def _normalize_options(options):
+    if options is None:
+        return []
+    if isinstance(options, str):
+        return options.split()
+    return [str(o) for o in options]
+
+
+def cache_key(source, device, options=None):
+    h = sha256()
+    for item in (
+            source,
+            ' '.join(_normalize_options(options)),
+            device.platform.name,
+            device.platform.version,
+            device.name,
+            device.version,
+            device.driver_version,
+            cl.VERSION_TEXT,
+            ):
+        h.update(item.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _cache_path(key):
+    return os.path.join(cache_dir(), key + '.bin')
+
+
+def _load_binaries(keys):
+    binaries = []
+    for key in keys:
+        try:
+            with open(_cache_path(key), 'rb') as f:
+                binaries.append(f.read())
+        except OSError:
+            return None
+    return binaries
+
+
+def _store_binaries(prg, devices, keys):
+    binaries = prg.get_info(cl.program_info.BINARIES)
+    prg_devices = prg.get_info(cl.program_info.DEVICES)
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        for dev, binary in zip(prg_devices, binaries):
+            if dev not in devices or not binary:
+                continue
+            path = _cache_path(keys[devices.index(dev)])
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(binary)
+            os.replace(tmp, path)
+    except OSError:
+        # an unwritable cache must never break a build
+        pass
+
+
+def build_program(ctx, source, options=None):
+    """
+    Build an OpenCL program, reusing cached binaries when possible.
+
+    Inputs:
+        ctx : (pyopencl.Context) context to build the program for.
+        source : (str) OpenCL C source of the program.
+        options : (list of str) build options.
+
+    Outputs:
+        prg : (pyopencl.Program) the built program.
+    """
+    options = _normalize_options(options)
+    if not cache_enabled():
+        return cl.Program(ctx, source).build(options)
+    devices = list(ctx.devices)
+    keys = [cache_key(source, dev, options) for dev in devices]
+    binaries = _load_binaries(keys)
+    if binaries is not None:
+        try:
+            return cl.Program(ctx, devices, binaries).build(options)
+        except (cl.Error, RuntimeError):
+            # stale or corrupted entry, fall back to a normal rebuild
+            pass
+    prg = cl.Program(ctx, source).build(options)
+    _store_binaries(prg, devices, keys)
+    return prg
+
+
+def build_file(ctx, kernel_fp, options=None, dtype=np.float32):
+    """
+    Build a kernel source file, rendered for dtype (see npcl.dtypes).
+    """
+    return build_program(ctx, render_file(kernel_fp, dtype), options)
+
+
+def kernel_files():
+    root = os.path.dirname(os.path.abspath(__file__))
+    return sorted(glob(os.path.join(root, '*', '*.cl')))
+
+
+def warm_cache(ctx=None, options=None, dtypes=(np.float32,)):
+    """
+    Compile every program shipped with npcl and store the binaries.
+
+    Inputs:
+        ctx : (pyopencl.Context) context to compile for.
+            npcl.ctx is used (and created if needed) when omitted.
+        options : (list of str) build options.
+        dtypes : dtypes to generate the kernels for.
+
+    Outputs:
+        kernel_fps : (list of str) kernel sources that were compiled.
+    """
+    if ctx is None:
+        import npcl
+        if npcl.ctx is None:
+            npcl.create_ctx_queue()
+        ctx = npcl.ctx
+    kernel_fps = kernel_files()
+    for kernel_fp in kernel_fps:
+        for dtype in dtypes:
+            build_file(ctx, kernel_fp, options, dtype)
+    return kernel_fps
+
+
+def clear_cache():
+    for path in glob(os.path.join(cache_dir(), '*.bin')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
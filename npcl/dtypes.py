@@ -0,0 +1,125 @@
+"""
+dtype templating of the OpenCL kernel sources.
+
+Kernel sources are mako templates, rendered once per dtype with
+    T : storage type of the arrays (half, float or double),
+    R : arithmetic type (float for half storage, T otherwise),
+and a preamble defining LOAD(p, i) and STORE(p, i, v), which read and
+write elements of a T array as R values. Half precision storage goes
+through vload_half/vstore_half and does not need cl_khr_fp16.
+
+Sources without template syntax render to themselves.
+"""
+from mako.template import Template
+import numpy as np
+
+
+SUPPORTED = {
+    np.dtype(np.float16): ('half', 'float'),
+    np.dtype(np.float32): ('float', 'float'),
+    np.dtype(np.float64): ('double', 'double'),
+    }
+
+_preamble = {
+    'half': """
+#define LOAD(p, i) vload_half((i), (p))
+#define STORE(p, i, v) vstore_half((v), (i), (p))
+""",
+    'float': """
+#define LOAD(p, i) ((p)[i])
+#define STORE(p, i, v) ((p)[i] = (v))
+""",
+    'double': """
+#pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#define LOAD(p, i) ((p)[i])
+#define STORE(p, i, v) ((p)[i] = (v))
+""",
+    }
+
+_templates = {}
+
+
+def check(dtype):
+    """
+    Return dtype as a numpy dtype, raising ValueError if npcl kernels do
+    not support it.
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in SUPPORTED:
+        raise ValueError('unsupported dtype: %s' % dtype)
+    return dtype
+
+
+def check_solver(dtype):
+    """
+    Return dtype as a numpy dtype, raising ValueError if the solvers do
+    not support it. The solvers rely on pyopencl array arithmetic, which
+    has no float16 support: float16 arrays are supported by the ops only.
+    """
+    dtype = check(dtype)
+    if dtype == np.float16:
+        raise ValueError(
+            'the solvers do not support float16, convert to float32')
+    return dtype
+
+
+def dtype_of(parameter):
+    """
+    dtype the kernels should be generated for: the dtype of an array,
+    float32 for anything else (contexts, queues, None).
+    """
+    dtype = getattr(parameter, 'dtype', None)
+    return np.dtype(np.float32) if dtype is None else check(dtype)
+
+
+def real_dtype(dtype):
+    """
+    Arithmetic dtype of a storage dtype, used for filters, scalars and
+    reductions.
+    """
+    return np.dtype(np.float64 if check(dtype) == np.float64 else np.float32)
+
+
+def ctypes(dtype):
+    return SUPPORTED[check(dtype)]
+
+
+def render(source, dtype=np.float32):
+    T, R = ctypes(dtype)
+    template = _templates.get(source)
+    if template is None:
+        template = _templates[source] = Template(source)
+    return _preamble[T] + template.render(T=T, R=R)
+
+
+def render_file(kernel_fp, dtype=np.float32):
+    with open(kernel_fp, 'r') as f:
+        source = f.read()
+    return render(source, dtype)
+
+
+def complex_dtype(dtype):
+    """
+    Complex dtype of the spectra of dtype arrays.
+    """
+    return np.dtype(
+        np.complex128 if real_dtype(dtype) == np.float64 else np.complex64)
+
+
+def astype(x, dtype):
+    """
+    x converted to dtype, x itself when it already has that dtype.
+
+    Meant for (constant) filter arrays: the conversion goes through the
+    host, and is cached for as long as x is alive.
+    """
+    dtype = np.dtype(dtype)
+    if x.dtype == dtype:
+        return x
+    from .registry import array_cache
+    import npcl
+    cache = array_cache(x)
+    key = ('astype', dtype.name)
+    if key not in cache:
+        cache[key] = npcl.to_device(x.get(), dtype, queue=x.queue)
+    return cache[key]
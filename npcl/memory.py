@@ -0,0 +1,233 @@
+"""
+Memory pools backing the npcl array constructors.
+
+Every context gets one pool, shared by npcl.to_device, zeros, empty,
+their *_like variants and the outputs of npcl.ops. Temporaries created
+from pooled arrays (e.g. x - y) are allocated from the same pool, so long
+iterative solves stop calling the driver allocator after warm-up.
+
+With zero-copy enabled (set_zero_copy), devices sharing host memory (CPU
+runtimes, integrated GPUs) avoid the copies between host allocations:
+pools allocate ALLOC_HOST_PTR buffers, suitably aligned host arrays are
+wrapped as USE_HOST_PTR buffers by npcl.to_device, and npcl.get maps
+results instead of reading them. Other devices keep copying.
+"""
+import threading
+import numpy as np
+import pyopencl as cl
+import pyopencl.array as cl_array
+import pyopencl.tools as cl_tools
+from .registry import get, find
+
+
+enabled = True
+limit = None
+zero_copy = False
+
+
+class Pool(object):
+    """
+    A pyopencl memory pool with a cap on held bytes and usage statistics.
+
+    Inputs:
+        queue : (pyopencl.CommandQueue) queue used for the allocations.
+        limit : (int) maximum number of bytes managed by the pool. Held
+            (unused) blocks are released to the driver once the limit is
+            exceeded. None means no limit.
+    """
+
+    def __init__(self, queue, limit=None, mem_flags=cl.mem_flags.READ_WRITE):
+        self.context = queue.context
+        self.limit = limit
+        self._pool = cl_tools.MemoryPool(
+            cl_tools.ImmediateAllocator(queue, mem_flags))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.peak_bytes = 0
+
+    def __call__(self, nbytes):
+        with self._lock:
+            held = self._pool.held_blocks
+            buf = self._pool.allocate(nbytes)
+            if self._pool.held_blocks < held:
+                self.hits += 1
+            else:
+                self.misses += 1
+            active = self._pool.active_bytes
+            if active > self.peak_bytes:
+                self.peak_bytes = active
+            if self.limit is not None and self.managed_bytes > self.limit:
+                self._pool.free_held()
+        return buf
+
+    @property
+    def active_bytes(self):
+        return self._pool.active_bytes
+
+    @property
+    def managed_bytes(self):
+        return self._pool.managed_bytes
+
+    def free_held(self):
+        with self._lock:
+            self._pool.free_held()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'active_bytes': self.active_bytes,
+            'managed_bytes': self.managed_bytes,
+            'peak_bytes': self.peak_bytes,
+            'active_blocks': self._pool.active_blocks,
+            'held_blocks': self._pool.held_blocks,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.peak_bytes = self._pool.active_bytes
+
+
+def get_pool(queue):
+    """
+    Return the pool of the context of queue, creating it if needed.
+    """
+    def factory(ctx):
+        mem_flags = cl.mem_flags.READ_WRITE
+        if zero_copy and shares_host_memory(queue.device):
+            mem_flags |= cl.mem_flags.ALLOC_HOST_PTR
+        return Pool(queue, limit, mem_flags)
+    return get(queue, 'memory.pool', factory)
+
+
+def allocator(queue):
+    """
+    Allocator to pass to pyopencl.array constructors, or None when pooling
+    is disabled.
+    """
+    if not enabled:
+        return None
+    return get_pool(queue)
+
+
+def _pools(parameter=None):
+    return find('memory.pool', parameter)
+
+
+def set_limit(nbytes):
+    """
+    Set the maximum number of bytes managed by each pool (None for no
+    limit).
+    """
+    global limit
+    limit = nbytes
+    for pool in _pools():
+        pool.limit = nbytes
+
+
+def set_enabled(flag=True):
+    global enabled
+    enabled = flag
+
+
+def free_held(parameter=None):
+    """
+    Release the blocks held by the pool of a context (or of every context).
+    """
+    for pool in _pools(parameter):
+        pool.free_held()
+
+
+def stats(parameter=None):
+    """
+    Statistics of the pool of a context, summed over every context when
+    parameter is omitted.
+
+    Outputs:
+        stats : (dict) hits, misses, active/managed/peak bytes, and
+            active/held blocks.
+    """
+    total = {}
+    for pool in _pools(parameter):
+        for key, value in pool.stats().items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def set_zero_copy(flag=True):
+    """
+    Enable zero-copy host buffers. Pools of contexts which already
+    allocated arrays keep their allocation flags.
+    """
+    global zero_copy
+    zero_copy = flag
+
+
+def shares_host_memory(device):
+    """
+    Whether device works in host memory, so that buffer mappings need no
+    copy.
+    """
+    if device.type & cl.device_type.CPU:
+        return True
+    try:
+        return bool(device.host_unified_memory)
+    except cl.Error:
+        return False
+
+
+def alignment(device):
+    """
+    Alignment in bytes of host arrays usable as USE_HOST_PTR buffers.
+    """
+    return max(device.mem_base_addr_align//8, 64)
+
+
+def aligned_empty(shape, dtype=np.float32, align=4096):
+    """
+    Uninitialized host array whose data is aligned to align bytes, which
+    npcl.to_device can wrap without copy.
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    raw = np.empty(nbytes+align, np.uint8)
+    start = -raw.ctypes.data % align
+    return raw[start:start+nbytes].view(dtype).reshape(shape)
+
+
+def can_wrap(x, dtype, queue):
+    """
+    Whether the host array x can back a dtype device array without copy.
+    """
+    return zero_copy and isinstance(x, np.ndarray) and \
+        x.dtype == dtype and x.flags.c_contiguous and x.flags.writeable \
+        and x.size > 0 and shares_host_memory(queue.device) and \
+        x.ctypes.data % alignment(queue.device) == 0
+
+
+def wrap(x, queue):
+    """
+    Device array using the memory of the host array x (USE_HOST_PTR). The
+    two arrays alias each other.
+    """
+    buf = cl.Buffer(
+        queue.context, cl.mem_flags.READ_WRITE | cl.mem_flags.USE_HOST_PTR,
+        hostbuf=x,
+        )
+    return cl_array.Array(queue, x.shape, x.dtype, data=buf)
+
+
+def map_to_host(x):
+    """
+    Host array mapping the memory of the device array x. Without copy on
+    devices sharing host memory. The mapping must be released (by
+    deleting the returned array) before kernels write to x again.
+    """
+    res, _ = cl.enqueue_map_buffer(
+        x.queue, x.base_data, cl.map_flags.READ | cl.map_flags.WRITE,
+        x.offset, x.shape, x.dtype, is_blocking=True,
+        )
+    return res
@@ -0,0 +1,340 @@
+"""
+Domain decomposition of images across several OpenCL devices.
+
+An image is split into horizontal strips, one per queue (device). Every
+strip keeps halo rows copied from its neighbours, which are refreshed by
+exchange() before the operators reading across strip boundaries
+(convolutions, the total variation steps). Reductions are computed per
+strip on its core rows and combined on the host.
+
+Strips supports the arithmetic used by npcl.solvers, so that solve_fbs and
+solve_fista run unchanged on strips, given strips_dot as their dot
+product.
+"""
+import numpy as np
+import pyopencl as cl
+import npcl
+from .ops.convolve import convolve2d, transpose2d
+from .ops.local import tv_step, tv_primal
+from .solvers.fbs import solve_fbs
+from .solvers.fista import solve_fista
+
+
+def create_queues(devices=None):
+    """
+    Create one context and command queue per device.
+
+    Inputs:
+        devices : list of pyopencl.Device. By default every GPU device, or
+            every device when there is no GPU.
+
+    Outputs:
+        queues : list of pyopencl.CommandQueue.
+    """
+    if devices is None:
+        all_devices = [
+            dev for platform in cl.get_platforms()
+            for dev in platform.get_devices()
+            ]
+        devices = [
+            dev for dev in all_devices
+            if dev.type & cl.device_type.GPU
+            ] or all_devices
+    return [cl.CommandQueue(cl.Context([dev])) for dev in devices]
+
+
+def split_rows(n_rows, n_parts, halo):
+    """
+    Row ranges (r0, r1) of n_parts strips of nearly equal heights.
+    """
+    bounds = np.linspace(0, n_rows, n_parts+1).astype(int)
+    if np.min(np.diff(bounds)) < halo:
+        raise ValueError('strips must be at least as high as the halo')
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class Strips(object):
+    """
+    An image split into horizontal strips living on several queues.
+
+    Inputs:
+        parts : list of device arrays, strip i covering the image rows
+            rows[i][0]-top[i] to rows[i][1]+bottom[i].
+        rows : list of (r0, r1) core row ranges.
+        halo : (int) number of halo rows between two strips.
+    """
+
+    def __init__(self, parts, rows, halo):
+        self.parts = parts
+        self.rows = rows
+        self.halo = halo
+        n = len(parts)
+        self.top = [halo if i > 0 else 0 for i in range(n)]
+        self.bottom = [halo if i < n-1 else 0 for i in range(n)]
+        self.shape = (rows[-1][1], parts[0].shape[1])
+        self.dtype = parts[0].dtype
+        self.ndim = 2
+
+    @classmethod
+    def scatter(cls, x, queues, halo, dtype=np.float32):
+        """
+        Split the host image x across queues.
+        """
+        rows = split_rows(x.shape[0], len(queues), halo)
+        parts = []
+        for i, ((r0, r1), queue) in enumerate(zip(rows, queues)):
+            a = max(r0-halo, 0) if i > 0 else r0
+            b = min(r1+halo, x.shape[0]) if i < len(queues)-1 else r1
+            parts.append(npcl.to_device(x[a:b], dtype, queue))
+        return cls(parts, rows, halo)
+
+    def like(self, parts):
+        return Strips(parts, self.rows, self.halo)
+
+    def map(self, func, *others):
+        """
+        Strips of func(part, *other_parts), computed strip by strip.
+        """
+        return self.like([
+            func(*parts) for parts in zip(
+                self.parts, *[other.parts for other in others])
+            ])
+
+    def core(self, i):
+        return self.parts[i][self.top[i]:self.top[i]+self.rows[i][1] -
+                             self.rows[i][0]]
+
+    def gather(self):
+        """
+        Copy the image back to the host.
+        """
+        return np.concatenate(
+            [self.core(i).get() for i in range(len(self.parts))])
+
+    def exchange(self, rows=None):
+        """
+        Refresh the halo rows from the neighbouring strips.
+
+        Inputs:
+            rows : (int) number of halo rows to refresh, every one by
+                default.
+        """
+        h = self.halo if rows is None else rows
+        n = len(self.parts)
+        if n == 1 or h == 0:
+            return
+        W = self.shape[1]
+        item = self.dtype.itemsize
+        # download every outgoing band first, so that all devices copy
+        # concurrently, then upload them into the halos of the neighbours.
+        bands, events = [], []
+        for i in range(n-1):
+            lower, upper = self.parts[i], self.parts[i+1]
+            end = self.top[i]+self.rows[i][1]-self.rows[i][0]
+            down = np.empty((h, W), self.dtype)
+            up = np.empty((h, W), self.dtype)
+            events.append(cl.enqueue_copy(
+                lower.queue, down, lower.base_data,
+                src_offset=lower.offset+(end-h)*W*item, is_blocking=False,
+                ))
+            events.append(cl.enqueue_copy(
+                upper.queue, up, upper.base_data,
+                src_offset=upper.offset+self.top[i+1]*W*item,
+                is_blocking=False,
+                ))
+            bands.append((down, up, end))
+        for event in events:
+            # the strips live on different contexts
+            event.wait()
+        for i, (down, up, end) in enumerate(bands):
+            lower, upper = self.parts[i], self.parts[i+1]
+            cl.enqueue_copy(
+                lower.queue, lower.base_data, up,
+                dst_offset=lower.offset+end*W*item, is_blocking=False,
+                )
+            cl.enqueue_copy(
+                upper.queue, upper.base_data, down,
+                dst_offset=upper.offset+(self.top[i+1]-h)*W*item,
+                is_blocking=False,
+                )
+
+    def copy(self):
+        return self.map(lambda a: a.copy())
+
+    def __add__(self, other):
+        if isinstance(other, Strips):
+            return self.map(lambda a, b: a+b, other)
+        return self.map(lambda a: a+other)
+
+    def __sub__(self, other):
+        if isinstance(other, Strips):
+            return self.map(lambda a, b: a-b, other)
+        return self.map(lambda a: a-other)
+
+    def __mul__(self, other):
+        if isinstance(other, Strips):
+            return self.map(lambda a, b: a*b, other)
+        return self.map(lambda a: a*other)
+
+    __radd__ = __add__
+    __rmul__ = __mul__
+
+    def __rsub__(self, other):
+        return self.map(lambda a: other-a)
+
+
+def strips_dot(a, b):
+    """
+    Dot product of two Strips, summed over the core rows of every strip.
+    """
+    sums = [
+        npcl.dot(a.core(i), b.core(i)) for i in range(len(a.parts))
+        ]
+    return np.sum([s.get() for s in sums])
+
+
+def convolve2d_strips(x, k, padding='zero', **kwargs):
+    """
+    npcl.ops.convolve.convolve2d of Strips.
+
+    Inputs:
+        x : Strips, whose halo is at least the kernel radius.
+        k : list of convolutional kernel arrays, one per strip queue.
+        padding : 'zero' or 'same'.
+        kwargs : passed to convolve2d.
+    """
+    if padding == 'wrap' and len(x.parts) > 1:
+        raise ValueError('wrap padding is not supported across strips')
+    if x.halo < k[0].shape[0]//2:
+        raise ValueError('the halo is smaller than the kernel radius')
+    x.exchange()
+    return x.like([
+        convolve2d(part, kernel, padding, **kwargs)
+        for part, kernel in zip(x.parts, k)
+        ])
+
+
+def denoise_tv_strips(
+        image, weight=0.1, eps=2.e-4, n_iter_max=100, check_every=4,
+        ):
+    """
+    npcl.regularizers.local.denoise_tv of Strips.
+
+    The dual field is exchanged after every iteration, and the energy of
+    the stopping criterion is summed over the whole image. The fused step
+    chains the divergence and the gradient, so that the halo must be at
+    least 2 rows.
+    """
+    if len(image.parts) > 1 and image.halo < 2:
+        raise ValueError('the total variation steps need a halo of 2 rows')
+    tau = np.float32(1/4.)
+    weight = np.float32(weight)
+    N = np.float32(image.shape[0]*image.shape[1])
+    image.exchange()
+    if n_iter_max < 1:
+        return image.copy()
+    zeros = image.map(npcl.zeros_like)
+    px, py = zeros, zeros.copy()
+    qx, qy = image.map(npcl.empty_like), image.map(npcl.empty_like)
+    energy = image.map(npcl.empty_like)
+    i = 0
+    while i < n_iter_max:
+        check = i % check_every == 0
+        for n in range(len(image.parts)):
+            tv_step(
+                image.parts[n], px.parts[n], py.parts[n], tau, weight,
+                out=(qx.parts[n], qy.parts[n]),
+                energy=energy.parts[n] if check else None,
+                )
+        px, py, qx, qy = qx, qy, px, py
+        px.exchange(1)
+        py.exchange(1)
+        if check:
+            sums = [
+                npcl.sum(energy.core(n)) for n in range(len(image.parts))
+                ]
+            E = np.sum([s.get() for s in sums])/N
+            if i == 0:
+                E_init = E
+                E_previous = E
+            else:
+                if np.abs(E_previous - E) < eps*E_init*check_every:
+                    break
+                E_previous = E
+        i += 1
+    return image.map(tv_primal, qx, qy)
+
+
+def _deconv_multi(
+        solver, img_blurry, psf, queues, mu, tol, delta, max_iter, verbose,
+        weight, eps, n_iter_max, method,
+        ):
+    if queues is None:
+        queues = create_queues()
+    psf = np.asarray(psf)
+    # the kernel radius, and 2 rows for denoise_tv_strips
+    halo = max(max(psf.shape)//2, 2)
+    x_0 = Strips.scatter(img_blurry, queues, halo)
+    k = [npcl.to_device(psf, queue=queue) for queue in queues]
+    kernel = [transpose2d(kk) for kk in k]
+
+    def ATA(x):
+        return convolve2d_strips(
+            convolve2d_strips(x, kernel, method=method), k, method=method)
+
+    def ProxR(x, mu):
+        return denoise_tv_strips(x, mu*weight, eps, n_iter_max)
+    ATb = convolve2d_strips(x_0, k, method=method)
+    x, n = solver(
+        ATA, ATb, x_0, ProxR,
+        delta=None if delta is None else np.float32(delta),
+        mu=np.float32(mu), tol=np.float32(tol),
+        verbose=verbose, max_iter=max_iter, dot=strips_dot,
+        )
+    return x.gather(), n
+
+
+def deconv_fbs_multi(
+        img_blurry, psf, queues=None,
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
+        max_iter=50, verbose=False,
+        weight=1., eps=2.e-4, n_iter_max=100, method='direct',
+        ):
+    """
+    npcl.solvers.deconv.deconv_fbs with the image split across devices.
+
+    Inputs:
+        img_blurry : (numpy.ndarray) blurry image, on the host.
+        psf : (numpy.ndarray) point spread function, on the host.
+        queues : list of pyopencl.CommandQueue, one per device. See
+            create_queues.
+        weight, eps, n_iter_max : parameters of the total variation
+            denoiser, whose weight is weight*mu*delta.
+        method : convolution method, 'direct', 'separable' or 'fft'.
+        delta : step size. When None, estimated by the solver with
+            npcl.solvers.lipschitz over strips_dot, as in deconv_fbs.
+
+    Outputs:
+        x : (numpy.ndarray) deblurred image.
+        k : (int) the total iteration number.
+    """
+    return _deconv_multi(
+        solve_fbs, img_blurry, psf, queues, mu, tol, delta, max_iter,
+        verbose, weight, eps, n_iter_max, method,
+        )
+
+
+def deconv_fista_multi(
+        img_blurry, psf, queues=None,
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
+        max_iter=50, verbose=False,
+        weight=1., eps=2.e-4, n_iter_max=100, method='direct',
+        ):
+    """
+    npcl.solvers.deconv.deconv_fista with the image split across devices.
+    See deconv_fbs_multi.
+    """
+    return _deconv_multi(
+        solve_fista, img_blurry, psf, queues, mu, tol, delta, max_iter,
+        verbose, weight, eps, n_iter_max, method,
+        )
@@ -1,3 +1,6 @@
+from . import batch
+from . import fft
 from . import convolve
 from . import local
 from . import nl
+from . import lowrank
@@ -0,0 +1,74 @@
+// Per-item operations on batches of n elements per item.
+
+// out[b] = sum_i a[b*n+i]*c[b*n+i], one work-group per item.
+// c may be NULL, in which case out[b] = sum_i a[b*n+i].
+__kernel void batch_dot(
+    __global const ${T} *a,
+    __global const ${T} *c,
+    __global ${R} *out,
+    __local ${R} *partial,
+    const int n
+    ){
+    int b = get_group_id(0);
+    int lid = get_local_id(0);
+    int L = get_local_size(0);
+    a += (long)n*b;
+
+    ${R} sum = 0;
+    if (c){
+        c += (long)n*b;
+        for (int i = lid; i < n; i += L){
+            sum += LOAD(a, i)*LOAD(c, i);
+        }
+    }
+    else{
+        for (int i = lid; i < n; i += L){
+            sum += LOAD(a, i);
+        }
+    }
+    partial[lid] = sum;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (int s = L/2; s > 0; s >>= 1){
+        if (lid < s){
+            partial[lid] += partial[lid+s];
+        }
+        barrier(CLK_LOCAL_MEM_FENCE);
+    }
+    if (lid == 0){
+        out[b] = partial[0];
+    }
+}
+
+
+// out = x + alpha[b]*y
+__kernel void batch_axpy(
+    __global const ${T} *x,
+    __global const ${R} *alpha,
+    __global const ${T} *y,
+    __global ${T} *out,
+    const int n
+    ){
+    int i = get_global_id(0);
+    int b = get_global_id(1);
+    if (i < n){
+        long idx = (long)n*b + i;
+        STORE(out, idx, LOAD(x, idx) + alpha[b]*LOAD(y, idx));
+    }
+}
+
+
+// out = mask[b] ? x : y
+__kernel void batch_select(
+    __global const int *mask,
+    __global const ${T} *x,
+    __global const ${T} *y,
+    __global ${T} *out,
+    const int n
+    ){
+    int i = get_global_id(0);
+    int b = get_global_id(1);
+    if (i < n){
+        long idx = (long)n*b + i;
+        STORE(out, idx, mask[b] ? LOAD(x, idx) : LOAD(y, idx));
+    }
+}
@@ -0,0 +1,115 @@
+from os.path import abspath
+import pyopencl as cl
+import npcl
+from npcl.registry import get_program
+from npcl.dtypes import dtype_of, real_dtype
+import numpy as np
+
+
+kernel_fp = abspath(__file__).replace('.py', '.cl')
+
+
+def build(parameter):
+    return get_program(parameter, kernel_fp, dtype=dtype_of(parameter))
+
+
+def batch_shape(x):
+    """
+    Shape (N, H, W) of x, seen as a batch of 2D images.
+
+    2D arrays are batches of a single image, the leading axis of 3D
+    arrays is the batch dimension.
+    """
+    if x.ndim == 2:
+        return (1,)+x.shape
+    return x.shape
+
+
+def global_size(x):
+    """
+    Global size of a one work-item per pixel launch over a batch.
+    """
+    return batch_shape(x)[::-1]
+
+
+def _group_size(device):
+    n = 256
+    while n > device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE):
+        n //= 2
+    return n
+
+
+def _launch_shape(x):
+    N, H, W = batch_shape(x)
+    n = H*W
+    L = _group_size(x.queue.device)
+    return n, (n+(-n) % L, N), (L, 1)
+
+
+def dot(a, b, out=None):
+    """
+    Per-item dot product of two batches.
+
+    Outputs:
+        out : (N,) array with the dot products of every item, accumulated
+            in the arithmetic dtype of a (float32 for float16 arrays).
+    """
+    prg = build(a)
+    N, H, W = batch_shape(a)
+    L = _group_size(a.queue.device)
+    real = real_dtype(a.dtype)
+    res = npcl.empty((N,), real, queue=a.queue) if out is None else out
+    prg.batch_dot(
+        a.queue, (L*N,), (L,),
+        a.data, None if b is None else b.data, res.data,
+        cl.LocalMemory(real.itemsize*L), np.int32(H*W),
+        )
+    return res
+
+
+def sum(x, out=None):
+    """
+    Per-item sum of a batch.
+    """
+    return dot(x, None, out=out)
+
+
+def norms(x, out=None):
+    """
+    Per-item squared l2 norms of a batch.
+    """
+    return dot(x, x, out=out)
+
+
+def axpy(x, alpha, y, out=None):
+    """
+    Compute x + alpha[b]*y for every item b of a batch.
+
+    Inputs:
+        alpha : (N,) array, of the arithmetic dtype of x.
+    """
+    prg = build(x)
+    n, gsize, lsize = _launch_shape(x)
+    res = npcl.empty_like(x) if out is None else out
+    prg.batch_axpy(
+        x.queue, gsize, lsize,
+        x.data, alpha.data, y.data, res.data, np.int32(n),
+        )
+    return res
+
+
+def select(mask, x, y, out=None):
+    """
+    Take item b from x where mask[b] is nonzero, and from y otherwise.
+
+    Inputs:
+        mask : (N,) int32 array.
+    """
+    prg = build(x)
+    n, gsize, lsize = _launch_shape(x)
+    res = npcl.empty_like(x) if out is None else out
+    prg.batch_select(
+        x.queue, gsize, lsize,
+        mask.data, x.data, y.data, res.data, np.int32(n),
+        )
+    return res
@@ -3,22 +3,69 @@ inline int wrap(int x, int w){
     return res<0?res+w:res;
 }
 
+// mode 0 : zero, 1 : same, 2 : wrap
+inline ${R} fetch(
+    __global const ${T} *input, int i, int j, int Nx, int Ny, int mode
+    ){
+    if (mode == 0){
+        if (i < 0 || i >= Nx || j < 0 || j >= Ny){
+            return 0.f;
+        }
+    }
+    else if (mode == 1){
+        i = clamp(i, 0, Nx-1);
+        j = clamp(j, 0, Ny-1);
+    }
+    else{
+        i = wrap(i, Nx);
+        j = wrap(j, Ny);
+    }
+    return LOAD(input, i + Nx*j);
+}
+
+
 __kernel void transpose2d(
-    __global const float * input,
-    __global float * output
+    __global const ${T} *input,
+    __global ${T} *output
     ){
     int i = get_global_id(0);
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
 
-    output[i + Nx*j] = input[(Nx-1-i) + Nx*(Ny-1-j)];
+    STORE(output, i + Nx*j, LOAD(input, (Nx-1-i) + Nx*(Ny-1-j)));
+}
+
+
+// Kernel of the composition of two convolutions,
+//     output = h1 (full convolution) h2,
+// of size (N1y+N2y-1) x (N1x+N2x-1).
+__kernel void compose2d(
+    __global const ${T} *h1,
+    __global const ${T} *h2,
+    __global ${T} *output,
+    const int N1y,
+    const int N1x,
+    const int N2y,
+    const int N2x
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+
+    ${R} res = 0;
+    for(int by = max(0, j-N1y+1); by <= min(j, N2y-1); ++by){
+        for(int bx = max(0, i-N1x+1); bx <= min(i, N2x-1); ++bx){
+            res += LOAD(h2, bx+N2x*by)*LOAD(h1, (i-bx)+N1x*(j-by));
+        }
+    }
+    STORE(output, i+Nx*j, res);
 }
 
 
 __kernel void transpose2d_sv(
-    __global const float * input,
-    __global float * output,
+    __global const ${T} *input,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -34,16 +81,16 @@ __kernel void transpose2d_sv(
         #pragma unroll
         for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
             ref_j = clamp(j+dy, 0, Ny-1);    
-            output[Nx*Ny*(Nhx/2+dx+Nhx*(Nhy/2+dy))+i+Nx*j] = input[Nx*Ny*(Nhx/2-dx+Nhx*(Nhy/2-dy))+ref_i+Nx*ref_j];
+            STORE(output, Nx*Ny*(Nhx/2+dx+Nhx*(Nhy/2+dy))+i+Nx*j, LOAD(input, Nx*Ny*(Nhx/2-dx+Nhx*(Nhy/2-dy))+ref_i+Nx*ref_j));
         }
     }
 }
 
 
 __kernel void convolve2d_w(
-    __global const float *input,
-    __global const float *h,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -51,8 +98,11 @@ __kernel void convolve2d_w(
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float res = 0.f;
+    ${R} res = 0;
     uint ref_i, ref_j;
 
     #pragma unroll
@@ -61,17 +111,17 @@ __kernel void convolve2d_w(
         #pragma unroll
         for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
             ref_j = wrap(j+dy, Ny);
-            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*input[ref_i+Nx*ref_j];
+            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*LOAD(input, ref_i+Nx*ref_j);
         }
     }
-    output[i+Nx*j] = res;
+    STORE(output, i+Nx*j, res);
 }
 
 
 __kernel void convolve2d_s(
-    __global const float *input,
-    __global const float *h,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -79,8 +129,11 @@ __kernel void convolve2d_s(
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float res = 0.f;
+    ${R} res = 0;
     uint ref_i, ref_j;
 
     #pragma unroll
@@ -89,17 +142,17 @@ __kernel void convolve2d_s(
         #pragma unroll
         for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
             ref_j = clamp(j+dy, 0, Ny-1);
-            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*input[ref_i+Nx*ref_j];
+            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*LOAD(input, ref_i+Nx*ref_j);
         }
     }
-    output[i+Nx*j] = res;
+    STORE(output, i+Nx*j, res);
 }
 
 
 __kernel void convolve2d_z(
-    __global const float *input,
-    __global const float *h,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -107,8 +160,11 @@ __kernel void convolve2d_z(
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float res = 0.f;
+    ${R} res = 0;
     uint ref_i, ref_j;
 
     #pragma unroll
@@ -117,240 +173,118 @@ __kernel void convolve2d_z(
         #pragma unroll
         for(int dy = max(-Nhy/2, -j); dy <= min(Nhy/2, Ny-1-j); ++dy){
             ref_j = j+dy;
-            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*input[ref_i+Nx*ref_j];
+            res += h[Nhx/2+dx + Nhx*(Nhy/2+dy)]*LOAD(input, ref_i+Nx*ref_j);
         }
     }
-    output[i+Nx*j] = res;
+    STORE(output, i+Nx*j, res);
 }
 
 // Using Local Memories
-
-__kernel void convolve2d_loc_z(
-    __global const float *input,
-    __global const float *h,
-    __local float *P,
-    __global float *output,
+// The tile of the work-group, extended by the kernel half sizes, is staged
+// in P by all of its work-items, so that tiles of any shape work and the
+// barrier is reached by every work-item.
+// mode : padding mode, see fetch.
+
+inline void convolve2d_loc(
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
     const int Ny,
     const int Nx,
     const int FSY,
-    const int FSX
+    const int FSX,
+    const int mode
     ){
-    
     // Ny: number of rows, Nx: number of columns
 
     int i_g = get_global_id(0); // i_g corresponds to column, X
     int j_g = get_global_id(1); // j_g corresponds to row, Y
-    
+
     int i_loc = get_local_id(0);
     int j_loc = get_local_id(1);
-    
+    int LX = get_local_size(0);
+    int LY = get_local_size(1);
+
     int HFSX = FSX / 2;
     int HFSY = FSY / 2;
-    int PSX = 2 * HFSX;
-    int PSY = 2 * HFSY;
-    int TS = get_local_size(0);
-    
-    if (i_g < Nx && j_g < Ny){
-        P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY)] = input[i_g + Nx * j_g];
-        
-        // This padding is valid only if FSX < TS and FSY < TS
-        int xoffset = 0;
-        int yoffset = 0;
-        if (i_loc < HFSX){
-            xoffset = -min(i_g, HFSX);
-        }
-        if (i_loc >= TS-HFSX){
-            xoffset = min(HFSX, Nx-1-i_g);
-        }
-        if (j_loc < HFSY){
-            yoffset = -min(j_g, HFSY);
-        }
-        if (j_loc >= TS-HFSY){
-            yoffset = min(HFSY, Ny-1-j_g);
-        }
-        if (xoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY)] = input[i_g + xoffset + Nx * j_g];
-        }
-        if (yoffset!=0){
-            P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY + yoffset)] = input[i_g + Nx * (j_g + yoffset)];
-        }
-        if (xoffset!=0 && yoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY + yoffset)] = input[i_g + xoffset + Nx * (j_g + yoffset)];
-        }
-        
-        barrier(CLK_LOCAL_MEM_FENCE);
-        
-        float sum = 0.f;
-        int i_ref, j_ref;
-        #pragma unroll
-        for (int dx = -min(HFSX, i_g); dx <= min(HFSX, Nx-1-i_g); dx++){
-            i_ref = i_loc + HFSX + dx;
-            #pragma unroll
-            for (int dy = -min(HFSY, j_g); dy <= min(HFSY, Ny-1-j_g); dy++){
-                j_ref = j_loc + HFSY + dy;
-                sum += P[i_ref + (TS+PSX)*j_ref] * h[dx + HFSX + FSX * (dy + HFSY)];
-            }
-        }
-        output[i_g + Nx * j_g] = sum;
+    int PX = LX + 2*HFSX;
+    int PY = LY + 2*HFSY;
+    int i_0 = get_group_id(0)*LX - HFSX;
+    int j_0 = get_group_id(1)*LY - HFSY;
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
+
+    for (int n = i_loc + LX*j_loc; n < PX*PY; n += LX*LY){
+        P[n] = fetch(input, i_0 + n % PX, j_0 + n / PX, Nx, Ny, mode);
     }
-    else{
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (i_g >= Nx || j_g >= Ny){
         return;
     }
+
+    ${R} sum = 0;
+    int i_ref, j_ref;
+    #pragma unroll
+    for (int dx = -HFSX; dx <= HFSX; dx++){
+        i_ref = i_loc + HFSX + dx;
+        #pragma unroll
+        for (int dy = -HFSY; dy <= HFSY; dy++){
+            j_ref = j_loc + HFSY + dy;
+            sum += P[i_ref + PX*j_ref] * h[dx + HFSX + FSX * (dy + HFSY)];
+        }
+    }
+    STORE(output, i_g + Nx * j_g, sum);
+}
+
+
+__kernel void convolve2d_loc_z(
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FSY,
+    const int FSX
+    ){
+    convolve2d_loc(input, h, P, output, Ny, Nx, FSY, FSX, 0);
 }
 
 
 __kernel void convolve2d_loc_s(
-    __global const float *input,
-    __global const float *h,
-    __local float *P,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
     const int Ny,
     const int Nx,
     const int FSY,
     const int FSX
     ){
-    int i_g = get_global_id(0);
-    int j_g = get_global_id(1);
-    
-    int i_loc = get_local_id(0);
-    int j_loc = get_local_id(1);
-    
-    int HFSX = FSX / 2;
-    int HFSY = FSY / 2;
-    int PSX = 2 * HFSX;
-    int PSY = 2 * HFSY;
-    int TS = get_local_size(0);
-    
-    if (i_g < Nx && j_g < Ny){
-        P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY)] = input[i_g + Nx * j_g];
-        
-        // This padding is valid only if FSX < TS and FSY < TS
-        int xoffset = 0;
-        int yoffset = 0;
-        if (i_loc < HFSX){
-            xoffset = -HFSX;
-        }
-        if (i_loc >= TS-HFSX){
-            xoffset = HFSX;
-        }
-        if (j_loc < HFSY){
-            yoffset = -HFSY;
-        }
-        if (j_loc >= TS-HFSY){
-            yoffset = HFSY;
-        }
-        if (xoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY)] =
-                input[clamp(i_g + xoffset, 0, Nx-1) + xoffset + Nx * j_g];
-        }
-        if (yoffset!=0){
-            P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY + yoffset)] = 
-                input[i_g + Nx * clamp(j_g + yoffset, 0, Ny-1)];
-        }
-        if (xoffset!=0 && yoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY + yoffset)] = 
-                input[clamp(i_g + xoffset, 0, Nx-1) + Nx * clamp(j_g + yoffset, 0, Ny-1)];
-        }
-        
-        barrier(CLK_LOCAL_MEM_FENCE);
-        
-        float sum = 0.f;
-        int i_ref, j_ref;
-        #pragma unroll
-        for (int dx = -HFSX; dx <= HFSX; dx++){
-            i_ref = i_loc + HFSX + dx;
-            #pragma unroll
-            for (int dy = -HFSY; dy <= HFSY; dy++){
-                j_ref = j_loc + HFSY + dy;
-                sum += P[i_ref + (TS+PSX)*j_ref] * h[dx + HFSX + FSX * (dy + HFSY)];
-            }
-        }
-        output[i_g + Nx * j_g] = sum;
-    }
-    else{
-        return;
-    }
+    convolve2d_loc(input, h, P, output, Ny, Nx, FSY, FSX, 1);
 }
 
 
 __kernel void convolve2d_loc_w(
-    __global const float *input,
-    __global const float *h,
-    __local float *P,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
     const int Ny,
     const int Nx,
     const int FSY,
     const int FSX
     ){
-    int i_g = get_global_id(0);
-    int j_g = get_global_id(1);
-    
-    int i_loc = get_local_id(0);
-    int j_loc = get_local_id(1);
-    
-    int HFSX = FSX / 2;
-    int HFSY = FSY / 2;
-    int PSX = 2 * HFSX;
-    int PSY = 2 * HFSY;
-    int TS = get_local_size(0);
-    
-    if (i_g < Nx && j_g < Ny){
-        P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY)] = input[i_g + Nx * j_g];
-        
-        // This padding is valid only if FSX < TS and FSY < TS
-        int xoffset = 0;
-        int yoffset = 0;
-        if (i_loc < HFSX){
-            xoffset = -HFSX;
-        }
-        if (i_loc >= TS-HFSX){
-            xoffset = HFSX;
-        }
-        if (j_loc < HFSY){
-            yoffset = -HFSY;
-        }
-        if (j_loc >= TS-HFSY){
-            yoffset = HFSY;
-        }
-        if (xoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY)] =
-                input[wrap(i_g + xoffset, Nx) + xoffset + Nx * j_g];
-        }
-        if (yoffset!=0){
-            P[i_loc + HFSX + (TS+PSX)*(j_loc + HFSY + yoffset)] =
-                input[i_g + Nx * wrap(j_g + yoffset, Ny)];
-        }
-        if (xoffset!=0 && yoffset!=0){
-            P[i_loc + HFSX + xoffset + (TS+PSX)*(j_loc + HFSY + yoffset)] =
-                input[wrap(i_g + xoffset, Nx) + Nx * wrap(j_g + yoffset, Ny)];
-        }
-        
-        barrier(CLK_LOCAL_MEM_FENCE);
-        
-        float sum = 0.f;
-        int i_ref, j_ref;
-        #pragma unroll
-        for (int dx = -HFSX; dx <= HFSX; dx++){
-            i_ref = i_loc + HFSX + dx;
-            #pragma unroll
-            for (int dy = -HFSY; dy <= HFSY; dy++){
-                j_ref = j_loc + HFSY + dy;
-                sum += P[i_ref + (TS+PSX)*j_ref] * h[dx + HFSX + FSX * (dy + HFSY)];
-            }
-        }
-        output[i_g + Nx * j_g] = sum;
-    }
-    else{
-        return;
-    }
+    convolve2d_loc(input, h, P, output, Ny, Nx, FSY, FSX, 2);
 }
 
 
     __kernel void convolve2d_sv_w(
-        __global const float *input,
-        __global const float *h,
-        __global float *output,
+        __global const ${T} *input,
+        __global const ${T} *h,
+        __global ${T} *output,
         const int Nhy,
         const int Nhx
         ){
@@ -358,8 +292,11 @@ __kernel void convolve2d_loc_w(
         int j = get_global_id(1);
         int Nx = get_global_size(0);
         int Ny = get_global_size(1);
+        int b = get_global_id(2);
+        input += Nx*Ny*b;
+        output += Nx*Ny*b;
 
-        float res = 0.f;
+        ${R} res = 0;
         uint ref_i, ref_j;
 
         #pragma unroll
@@ -368,17 +305,17 @@ __kernel void convolve2d_loc_w(
             #pragma unroll
             for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
                 ref_j = wrap(j+dy, Ny);
-                res += h[Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j]*input[ref_i + Nx * ref_j];
+                res += LOAD(h, Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j)*LOAD(input, ref_i + Nx * ref_j);
             }
         }
-        output[i+Nx*j] = res;
+        STORE(output, i+Nx*j, res);
 }
 
 
 __kernel void convolve2d_sv_s(
-    __global const float *input,
-    __global const float *h,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -386,8 +323,11 @@ __kernel void convolve2d_sv_s(
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float res = 0.f;
+    ${R} res = 0;
     uint ref_i, ref_j;
 
     #pragma unroll
@@ -396,17 +336,17 @@ __kernel void convolve2d_sv_s(
         #pragma unroll
         for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
             ref_j = clamp(j+dy, 0, Ny-1);
-            res += h[Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j]*input[ref_i + Nx * ref_j];
+            res += LOAD(h, Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j)*LOAD(input, ref_i + Nx * ref_j);
         }
     }
-    output[i+Nx*j] = res;
+    STORE(output, i+Nx*j, res);
 }
 
 
 __kernel void convolve2d_sv_z(
-    __global const float *input,
-    __global const float *h,
-    __global float *output,
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
     const int Nhy,
     const int Nhx
     ){
@@ -414,8 +354,11 @@ __kernel void convolve2d_sv_z(
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float res = 0.f;
+    ${R} res = 0;
     uint ref_i, ref_j;
 
     #pragma unroll
@@ -424,8 +367,265 @@ __kernel void convolve2d_sv_z(
         #pragma unroll
         for(int dy = max(-Nhy/2, -j); dy <= min(Nhy/2, Ny-1-j); ++dy){
             ref_j = j+dy;
-            res += h[Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j]*input[ref_i + Nx * ref_j];
+            res += LOAD(h, Nx*Ny*(Nhx/2+dx + Nhx*(Nhy/2 + dy))+i+Nx*j)*LOAD(input, ref_i + Nx * ref_j);
         }
     }
-    output[i+Nx*j] = res;
-}
\ No newline at end of file
+    STORE(output, i+Nx*j, res);
+}
+
+// Spatially-variant convolution, using local memories
+// The input tile is staged as in convolve2d_loc. The loops have the same
+// bounds for every work-item (zero padding is staged in P), so that the
+// kernel reads of neighbouring work-items, at consecutive addresses of
+// each kernel plane, are issued together.
+
+inline void convolve2d_sv_loc(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FSY,
+    const int FSX,
+    const int mode
+    ){
+    int i_g = get_global_id(0);
+    int j_g = get_global_id(1);
+
+    int i_loc = get_local_id(0);
+    int j_loc = get_local_id(1);
+    int LX = get_local_size(0);
+    int LY = get_local_size(1);
+
+    int HFSX = FSX / 2;
+    int HFSY = FSY / 2;
+    int PX = LX + 2*HFSX;
+    int PY = LY + 2*HFSY;
+    int i_0 = get_group_id(0)*LX - HFSX;
+    int j_0 = get_group_id(1)*LY - HFSY;
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
+
+    for (int n = i_loc + LX*j_loc; n < PX*PY; n += LX*LY){
+        P[n] = fetch(input, i_0 + n % PX, j_0 + n / PX, Nx, Ny, mode);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (i_g >= Nx || j_g >= Ny){
+        return;
+    }
+
+    ${R} sum = 0;
+    int i_ref, j_ref;
+    int plane = Nx*Ny;
+    h += i_g + Nx*j_g;
+    #pragma unroll
+    for (int dx = -HFSX; dx <= HFSX; dx++){
+        i_ref = i_loc + HFSX + dx;
+        #pragma unroll
+        for (int dy = -HFSY; dy <= HFSY; dy++){
+            j_ref = j_loc + HFSY + dy;
+            sum += LOAD(h, plane*(dx + HFSX + FSX*(dy + HFSY))) *
+                P[i_ref + PX*j_ref];
+        }
+    }
+    STORE(output, i_g + Nx * j_g, sum);
+}
+
+
+__kernel void convolve2d_sv_loc_z(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FSY,
+    const int FSX
+    ){
+    convolve2d_sv_loc(input, h, P, output, Ny, Nx, FSY, FSX, 0);
+}
+
+
+__kernel void convolve2d_sv_loc_s(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FSY,
+    const int FSX
+    ){
+    convolve2d_sv_loc(input, h, P, output, Ny, Nx, FSY, FSX, 1);
+}
+
+
+__kernel void convolve2d_sv_loc_w(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FSY,
+    const int FSX
+    ){
+    convolve2d_sv_loc(input, h, P, output, Ny, Nx, FSY, FSX, 2);
+}
+
+
+// Adjoint of the spatially-variant convolution, gathering with reversed
+// kernel indices from the original kernel:
+//     y_{i, j} = \sum_{k, l} h_{-k, -l, i+k, j+l} x_{i+k, j+l}
+// The padding mode is applied to the kernel plane and the input alike.
+// Same as convolve2d_sv with the kernel of transpose2d_sv, without
+// building it.
+inline void correlate2d_sv(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
+    const int Nhy,
+    const int Nhx,
+    int mode
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
+
+    ${R} res = 0;
+    int ref_i, ref_j;
+
+    for(int dx = -Nhx/2; dx <= Nhx/2; ++dx){
+        ref_i = i+dx;
+        if (mode == 0 && (ref_i < 0 || ref_i >= Nx)) continue;
+        ref_i = mode == 1 ? clamp(ref_i, 0, Nx-1) :
+            mode == 2 ? wrap(ref_i, Nx) : ref_i;
+        for(int dy = -Nhy/2; dy <= Nhy/2; ++dy){
+            ref_j = j+dy;
+            if (mode == 0 && (ref_j < 0 || ref_j >= Ny)) continue;
+            ref_j = mode == 1 ? clamp(ref_j, 0, Ny-1) :
+                mode == 2 ? wrap(ref_j, Ny) : ref_j;
+            res += LOAD(h, Nx*Ny*(Nhx/2-dx + Nhx*(Nhy/2-dy))+ref_i+Nx*ref_j)*LOAD(input, ref_i + Nx*ref_j);
+        }
+    }
+    STORE(output, i+Nx*j, res);
+}
+
+
+__kernel void correlate2d_sv_z(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
+    const int Nhy,
+    const int Nhx
+    ){
+    correlate2d_sv(input, h, output, Nhy, Nhx, 0);
+}
+
+
+__kernel void correlate2d_sv_s(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
+    const int Nhy,
+    const int Nhx
+    ){
+    correlate2d_sv(input, h, output, Nhy, Nhx, 1);
+}
+
+
+__kernel void correlate2d_sv_w(
+    __global const ${T} *input,
+    __global const ${T} *h,
+    __global ${T} *output,
+    const int Nhy,
+    const int Nhx
+    ){
+    correlate2d_sv(input, h, output, Nhy, Nhx, 2);
+}
+
+
+// Separable convolution passes, using local memories
+
+__kernel void convolve_rows_loc(
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FS,
+    const int mode
+    ){
+    int i_g = get_global_id(0);
+    int j_g = get_global_id(1);
+    int i_loc = get_local_id(0);
+    int j_loc = get_local_id(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
+    int LX = get_local_size(0);
+    int PSX = LX + FS - 1;
+    int i_0 = get_group_id(0)*LX - FS/2;
+
+    // the whole tile row, halo included, is loaded cooperatively
+    for (int t = i_loc; t < PSX; t += LX){
+        P[t + PSX*j_loc] = j_g < Ny ? fetch(input, i_0 + t, j_g, Nx, Ny, mode) : 0.f;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (i_g < Nx && j_g < Ny){
+        ${R} sum = 0;
+        for (int d = 0; d < FS; d++){
+            sum += P[i_loc + d + PSX*j_loc] * h[d];
+        }
+        STORE(output, i_g + Nx*j_g, sum);
+    }
+}
+
+
+__kernel void convolve_cols_loc(
+    __global const ${T} *input,
+    __global const ${R} *h,
+    __local ${R} *P,
+    __global ${T} *output,
+    const int Ny,
+    const int Nx,
+    const int FS,
+    const int mode,
+    const int accumulate
+    ){
+    int i_g = get_global_id(0);
+    int j_g = get_global_id(1);
+    int i_loc = get_local_id(0);
+    int j_loc = get_local_id(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Nx*Ny*b;
+    int LX = get_local_size(0);
+    int LY = get_local_size(1);
+    int PSY = LY + FS - 1;
+    int j_0 = get_group_id(1)*LY - FS/2;
+
+    for (int t = j_loc; t < PSY; t += LY){
+        P[i_loc + LX*t] = i_g < Nx ? fetch(input, i_g, j_0 + t, Nx, Ny, mode) : 0.f;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (i_g < Nx && j_g < Ny){
+        ${R} sum = 0;
+        for (int d = 0; d < FS; d++){
+            sum += P[i_loc + LX*(j_loc + d)] * h[d];
+        }
+        if (accumulate){
+            sum += LOAD(output, i_g + Nx*j_g);
+        }
+        STORE(output, i_g + Nx*j_g, sum);
+    }
+}
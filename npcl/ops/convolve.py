@@ -1,37 +1,253 @@
 from os.path import abspath
 import pyopencl as cl
 import npcl
+from npcl.registry import get_program, device_of, array_cache
+from npcl.dtypes import dtype_of, real_dtype, astype
+from npcl.ops.fft import convolve2d_fft, fft_cost, PADDING_MODES
+from npcl.ops.fft import check_kernel_shape
+from npcl.ops.batch import batch_shape, global_size
+from npcl import tuning
 import numpy as np
 
 
-prg = None
+kernel_fp = abspath(__file__).replace('.py', '.cl')
 
 
 def build(parameter):
-    if type(parameter) == cl.Context:
-        ctx = parameter
-    if type(parameter) == npcl.Array:
-        ctx = parameter.context
-    global prg, local_mem_size, TS
-    kernel_fp = abspath(__file__).replace('.py', '.cl')
-    prg = cl.Program(ctx, open(kernel_fp, 'r').read())
-    prg.build()
-    local_mem_size = npcl.get_local_mem_size() // 4
-    TS = np.int32(np.sqrt(npcl.get_max_work_group_size()))
-
-
-def use_local_mem(filter_size):
-    if filter_size[0] > TS:
+    return get_program(parameter, kernel_fp, dtype=dtype_of(parameter))
+
+
+def get_local_mem_size(device, itemsize=4):
+    return device.get_info(cl.device_info.LOCAL_MEM_SIZE) // itemsize
+
+
+def get_tile_size(device):
+    return np.int32(
+        np.sqrt(device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)))
+
+
+def use_local_mem(filter_size, device=None, itemsize=4, tile=None):
+    if device is None:
+        device = device_of(None)
+    if tile is None:
+        TS = get_tile_size(device)
+        tile = (TS, TS)
+    if filter_size[0] > tile[0]:
         return False
-    elif filter_size[1] > TS:
+    elif filter_size[1] > tile[1]:
         return False
-    elif (TS+filter_size[0]-1)*(TS+filter_size[1]-1) > local_mem_size:
+    elif (tile[0]+filter_size[0]-1)*(tile[1]+filter_size[1]-1) > \
+            get_local_mem_size(device, itemsize):
         return False
     else:
         return True
 
 
-def convolve2d(x, k, padding='zero'):
+def _variant(op, x, kernel_shape, padding):
+    device = x.queue.device
+    entry = tuning.lookup(device, op, x.shape, kernel_shape, padding, x.dtype)
+    if entry is not None:
+        return entry
+    if use_local_mem(kernel_shape, device, real_dtype(x.dtype).itemsize):
+        TS = int(get_tile_size(device))
+        return {'path': 'local', 'tile': (TS, TS)}
+    return {'path': 'global'}
+
+
+def direct_variant(x, k, padding='zero'):
+    """
+    Variant of the direct convolution kernel for x and k: the entry of
+    the tuning database (see npcl.tuning), or by default the local memory
+    kernel with square tiles when the tile and its halo fit in local
+    memory, the global memory kernel otherwise.
+
+    Outputs:
+        variant : (dict) {'path': 'global'} or
+            {'path': 'local', 'tile': (rows, columns)}.
+    """
+    return _variant('convolve2d', x, k.shape, padding)
+
+
+def sv_variant(x, k, padding='zero'):
+    """
+    Variant of the spatially-variant convolution kernel for x and k, see
+    direct_variant.
+    """
+    return _variant('convolve2d_sv', x, k.shape[:2], padding)
+
+
+def _run_local(run_kernel, x, h, res, kernel_shape, tile, itemsize):
+    # launch a convolve2d_loc or convolve2d_sv_loc kernel on tiles of
+    # shape tile (rows, columns)
+    TY, TX = tile
+    N, Ny, Nx = batch_shape(x)
+    padded_shape = (Ny+(-Ny) % TY, Nx+(-Nx) % TX)
+    cache_size = itemsize * \
+        (TY+2*(kernel_shape[0]//2))*(TX+2*(kernel_shape[1]//2))
+    run_kernel(
+        x.queue, padded_shape[::-1]+(N,), (TX, TY, 1),
+        x.data, h.data, cl.LocalMemory(cache_size), res.data,
+        np.int32(Ny),
+        np.int32(Nx),
+        np.int32(kernel_shape[0]),
+        np.int32(kernel_shape[1]),
+        )
+    return res
+
+
+def direct_cost(shape, kernel_shape):
+    """
+    Estimated cost of the direct convolution, in multiply-adds.
+    """
+    return int(np.prod(shape))*kernel_shape[0]*kernel_shape[1]
+
+
+def separable_cost(shape, kernel_shape, rank):
+    """
+    Estimated cost of the separable convolution, in multiply-adds.
+    """
+    return int(np.prod(shape))*rank*(kernel_shape[0]+kernel_shape[1]+2)
+
+
+def use_fft(shape, kernel_shape):
+    return fft_cost(shape, kernel_shape) < direct_cost(shape, kernel_shape)
+
+
+SVD_TOL = 1e-5
+
+
+def separate2d(k, rank=None, tol=SVD_TOL, dtype=np.float32):
+    """
+    Decompose a 2D kernel into a sum of separable (rank-1) kernels.
+
+    The decomposition is computed on the host from the SVD of k,
+        k = \sum_r cols[r] rows[r]^T,
+    and cached for as long as k is alive.
+
+    Inputs:
+        k : convolutional kernel array.
+        rank : (int) number of terms to keep. By default every term whose
+            singular value is larger than tol times the largest one.
+        tol : (float) relative tolerance on the singular values.
+        dtype : dtype of the filter arrays.
+
+    Outputs:
+        terms : list of R (col, row) pairs of 1D filter arrays.
+    """
+    cache = array_cache(k)
+    if 'svd' not in cache:
+        cache['svd'] = np.linalg.svd(k.get().astype(np.float64))
+    u, s, vt = cache['svd']
+    if rank is None:
+        rank = max(int(np.sum(s > tol*s[0])), 1) if s[0] > 0 else 1
+    rank = min(rank, len(s))
+    key = ('separable', rank, np.dtype(dtype).name)
+    if key not in cache:
+        cache[key] = [
+            (
+                npcl.to_device(u[:, r]*np.sqrt(s[r]), dtype, queue=k.queue),
+                npcl.to_device(vt[r]*np.sqrt(s[r]), dtype, queue=k.queue),
+                )
+            for r in range(rank)
+            ]
+    return cache[key]
+
+
+def separable_rank(k, tol=SVD_TOL):
+    return len(separate2d(k, tol=tol))
+
+
+def _group_shape(device, shape):
+    max_size = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+    if shape[0]*shape[1] <= max_size:
+        return shape
+    n = int(np.sqrt(max_size))
+    return (n, n)
+
+
+def _padded(size, group):
+    return size+(-size) % group
+
+
+def convolve2d_separable(x, k, padding='zero', rank=None, out=None):
+    """
+    Compute 2D convolution as a sum of row and column 1D passes.
+
+    Exact when k has (numerical) rank at most rank, which can be used to
+    approximate nearly separable kernels.
+
+    Inputs:
+        x : input array, an image or a batch of images.
+        k : convolutional kernel array.
+        padding : 'zero', 'same' or 'wrap'.
+        rank : (int) number of separable terms, see separate2d.
+        out : output array. Allocated when omitted.
+
+    Outputs:
+        y : output array.
+    """
+    check_kernel_shape(k.shape)
+    prg = build(x)
+    queue = x.queue
+    device = queue.device
+    mode = np.int32(PADDING_MODES[padding])
+    real = real_dtype(x.dtype)
+    terms = separate2d(k, rank, dtype=real)
+    Kh, Kw = k.shape
+    N, Ny, Nx = batch_shape(x)
+    row_group = _group_shape(device, (256, 1))
+    col_group = _group_shape(device, (16, 16))
+    row_global = (_padded(Nx, row_group[0]), _padded(Ny, row_group[1]), N)
+    col_global = (_padded(Nx, col_group[0]), _padded(Ny, col_group[1]), N)
+    row_group = row_group+(1,)
+    col_group = col_group+(1,)
+    row_cache = cl.LocalMemory(
+        real.itemsize*(row_group[0]+Kw-1)*row_group[1])
+    col_cache = cl.LocalMemory(
+        real.itemsize*col_group[0]*(col_group[1]+Kh-1))
+    tmp = npcl.empty_like(x)
+    res = npcl.empty_like(x) if out is None else out
+    for r, (col, row) in enumerate(terms):
+        prg.convolve_rows_loc(
+            queue, row_global, row_group,
+            x.data, row.data, row_cache, tmp.data,
+            np.int32(Ny), np.int32(Nx), np.int32(Kw), mode,
+            )
+        prg.convolve_cols_loc(
+            queue, col_global, col_group,
+            tmp.data, col.data, col_cache, res.data,
+            np.int32(Ny), np.int32(Nx), np.int32(Kh), mode,
+            np.int32(r > 0),
+            )
+    return res
+
+
+def method_costs(shape, k):
+    """
+    Estimated costs of the convolution methods for an image of the given
+    shape, see direct_cost, fft_cost and separable_cost.
+    """
+    costs = {
+        'direct': direct_cost(shape, k.shape),
+        'fft': fft_cost(shape, k.shape),
+        }
+    if min(k.shape) > 1 and \
+            separable_cost(shape, k.shape, 1) < min(costs.values()):
+        # the (cached) SVD is only worth looking at when it could win
+        costs['separable'] = separable_cost(
+            shape, k.shape, separable_rank(k))
+    return costs
+
+
+def select_method(shape, k):
+    """
+    Pick the cheapest convolution method for an image of the given shape.
+    """
+    costs = method_costs(shape, k)
+    return min(costs, key=costs.get)
+
+
+def convolve2d(x, k, padding='zero', method='auto', rank=None, out=None):
     """
     Compute 2D convolution.
 
@@ -40,38 +256,63 @@ def convolve2d(x, k, padding='zero'):
     where k : convolutional kernel.
 
     Inputs:
-        x : input array.
+        x : input array, an image (2D) or a batch of images (3D) which
+            are all convolved with k. float16 arrays are convolved in
+            float32 arithmetic, float64 arrays in float64.
+        k : convolutional kernel array, of odd height and width.
+        padding : 'zero', 'same' or 'wrap'.
+        method : 'direct', 'fft', 'separable' or 'auto'.
+            'auto' picks the cheapest one according to a cost model.
+        rank : (int) number of separable terms used to approximate k.
+            Implies method='separable' when method is 'auto'.
+        out : output array. Allocated when omitted.
+
+    Outputs:
+        y : output array.
+    """
+    check_kernel_shape(k.shape)
+    if method == 'auto':
+        method = 'separable' if rank is not None else select_method(x.shape, k)
+    if method == 'fft':
+        return convolve2d_fft(x, k, padding, out=out)
+    elif method == 'separable':
+        return convolve2d_separable(x, k, padding, rank, out=out)
+    elif method != 'direct':
+        raise ValueError('unknown convolution method: %s' % method)
+    return convolve2d_direct(x, k, padding, out=out)
+
+
+def convolve2d_direct(x, k, padding='zero', variant=None, out=None):
+    """
+    Compute 2D convolution with the direct kernels.
+
+    Inputs:
+        x : input array, an image or a batch of images.
         k : convolutional kernel array.
+        padding : 'zero', 'same' or 'wrap'.
+        variant : (dict) kernel variant, see direct_variant (the default).
+        out : output array. Allocated when omitted.
 
     Outputs:
         y : output array.
     """
-    if prg is None:
-        build(x)
-    if use_local_mem(k.shape):
+    check_kernel_shape(k.shape)
+    if variant is None:
+        variant = direct_variant(x, k, padding)
+    prg = build(x)
+    queue = x.queue
+    real = real_dtype(x.dtype)
+    h = astype(k, real)
+    res = npcl.empty_like(x) if out is None else out
+    if variant['path'] == 'local':
         if padding == 'zero':
             run_kernel = prg.convolve2d_loc_z
         elif padding == 'same':
             run_kernel = prg.convolve2d_loc_s
         elif padding == 'wrap':
             run_kernel = prg.convolve2d_loc_w
-        queue = x.queue
-        res = npcl.zeros_like(x)
-        padded_shape = (
-            x.shape[0]+(-x.shape[0]) % TS,
-            x.shape[1]+(-x.shape[1]) % TS,
-            )
-        cache_size = 4*(TS+2*(k.shape[0]//2))*(TS+2*(k.shape[1]//2))
-        if 'intel' not in prg.context.devices[0].vendor.lower() or x.shape==padded_shape:
-            run_kernel(
-                queue, padded_shape[::-1], (TS, TS),
-                x.data, k.data, cl.LocalMemory(cache_size), res.data,
-                np.int32(x.shape[0]),
-                np.int32(x.shape[1]),
-                np.int32(k.shape[0]),
-                np.int32(k.shape[1]),
-                )
-            return res
+        return _run_local(
+            run_kernel, x, h, res, k.shape, variant['tile'], real.itemsize)
 
     if padding == 'zero':
         run_kernel = prg.convolve2d_z
@@ -79,18 +320,16 @@ def convolve2d(x, k, padding='zero'):
         run_kernel = prg.convolve2d_s
     elif padding == 'wrap':
         run_kernel = prg.convolve2d_w
-    queue = x.queue
-    res = npcl.zeros_like(x)
     run_kernel(
-        queue, x.shape[::-1], None,
-        x.data, k.data, res.data,
+        queue, global_size(x), None,
+        x.data, h.data, res.data,
         np.int32(k.shape[0]),
         np.int32(k.shape[1]),
         )
     return res
 
 
-def convolve2d_sv(x, k, padding='zero'):
+def convolve2d_sv(x, k, padding='zero', out=None, variant=None):
     r"""
     Compute 2D spatially-variant convolution.
 
@@ -99,15 +338,34 @@ def convolve2d_sv(x, k, padding='zero'):
     where k : convolutional kernel.
 
     Inputs:
-        x : input array (2D).
+        x : input array (2D), or a batch of images (3D).
         k : convolutional kernel array (4D).
             dimensions : kernel window (2D) x image size (2D)
+            Converted to the dtype of x if needed.
+        out : output array. Allocated when omitted.
+        variant : (dict) global memory kernel, or local memory kernel and
+            its tile shape, see sv_variant (the default).
 
     Outputs:
         y : output array.
     """
-    if prg is None:
-        build(x)
+    check_kernel_shape(k.shape)
+    if variant is None:
+        variant = sv_variant(x, k, padding)
+    prg = build(x)
+    h = astype(k, x.dtype)
+    if variant['path'] == 'local':
+        if padding == 'zero':
+            run_kernel = prg.convolve2d_sv_loc_z
+        elif padding == 'same':
+            run_kernel = prg.convolve2d_sv_loc_s
+        elif padding == 'wrap':
+            run_kernel = prg.convolve2d_sv_loc_w
+        res = npcl.empty_like(x) if out is None else out
+        return _run_local(
+            run_kernel, x, h, res, k.shape[:2], variant['tile'],
+            real_dtype(x.dtype).itemsize,
+            )
     if padding == 'zero':
         run_kernel = prg.convolve2d_sv_z
     elif padding == 'same':
@@ -115,21 +373,59 @@ def convolve2d_sv(x, k, padding='zero'):
     elif padding == 'wrap':
         run_kernel = prg.convolve2d_sv_w
     queue = x.queue
-    res = npcl.zeros_like(x)
+    res = npcl.empty_like(x) if out is None else out
+    run_kernel(
+        queue, global_size(x), None,
+        x.data, h.data, res.data,
+        np.int32(k.shape[0]),
+        np.int32(k.shape[1]),
+        )
+    return res
+
+
+def correlate2d_sv(x, k, padding='zero', out=None):
+    r"""
+    Compute the adjoint of the 2D spatially-variant convolution.
+
+    This function computes
+        y_{i, j} = \sum_{k, l} k_{-k, -l, i + k, j + l} x_{i + k, j + l},
+    directly from the kernel of convolve2d_sv, so that
+    correlate2d_sv(x, k) == convolve2d_sv(x, transpose2d_sv(k)) without
+    the transposed kernel. The adjoint is exact for 'zero' and 'wrap'
+    padding.
+
+    Inputs:
+        x : input array (2D), or a batch of images (3D).
+        k : convolutional kernel array (4D), see convolve2d_sv.
+        out : output array. Allocated when omitted.
+
+    Outputs:
+        y : output array.
+    """
+    check_kernel_shape(k.shape)
+    prg = build(x)
+    h = astype(k, x.dtype)
+    if padding == 'zero':
+        run_kernel = prg.correlate2d_sv_z
+    elif padding == 'same':
+        run_kernel = prg.correlate2d_sv_s
+    elif padding == 'wrap':
+        run_kernel = prg.correlate2d_sv_w
+    queue = x.queue
+    res = npcl.empty_like(x) if out is None else out
     run_kernel(
-        queue, x.shape[::-1], None,
-        x.data, k.data, res.data,
+        queue, global_size(x), None,
+        x.data, h.data, res.data,
         np.int32(k.shape[0]),
         np.int32(k.shape[1]),
         )
     return res
 
 
-def transpose2d(k):
-    if prg is None:
-        build(k)
+def transpose2d(k, out=None):
+    prg = build(k)
     queue = k.queue
-    kernel = npcl.empty_like(k)
+    kernel = npcl.empty_like(k) if out is None else out
     prg.transpose2d(
         queue, k.shape[::-1], None,
         k.data, kernel.data,
@@ -137,14 +433,99 @@ def transpose2d(k):
     return kernel
 
 
-def transpose2d_sv(k):
-    if prg is None:
-        build(k)
+def transpose2d_sv(k, out=None):
+    prg = build(k)
     queue = k.queue
-    kernel = npcl.empty_like(k)
+    kernel = npcl.empty_like(k) if out is None else out
     prg.transpose2d_sv(
         queue, k.shape[2:][::-1], None,
         k.data, kernel.data,
         np.int32(k.shape[0]), np.int32(k.shape[1]),
         )
     return kernel
+
+
+def compose2d(k1, k2, out=None):
+    """
+    Kernel of the composition of two convolutions with wrap padding,
+        convolve2d(convolve2d(x, k1, 'wrap'), k2, 'wrap')
+            == convolve2d(x, compose2d(k1, k2), 'wrap'),
+    of size (Kh1+Kh2-1) x (Kw1+Kw2-1), in the arithmetic dtype of k1.
+    Kernel sizes must be odd.
+    """
+    k1 = astype(k1, real_dtype(k1.dtype))
+    k2 = astype(k2, k1.dtype)
+    prg = build(k1)
+    queue = k1.queue
+    shape = (k1.shape[0]+k2.shape[0]-1, k1.shape[1]+k2.shape[1]-1)
+    res = npcl.empty(shape, k1.dtype, queue=queue) if out is None else out
+    prg.compose2d(
+        queue, shape[::-1], None,
+        k1.data, k2.data, res.data,
+        np.int32(k1.shape[0]), np.int32(k1.shape[1]),
+        np.int32(k2.shape[0]), np.int32(k2.shape[1]),
+        )
+    return res
+
+
+def _composable(kernel, psf, padding, shape):
+    if padding != 'wrap' or any(n % 2 == 0 for n in kernel.shape+psf.shape):
+        return False
+    if shape is None:
+        return True
+    composed = (kernel.shape[0]+psf.shape[0]-1,
+                kernel.shape[1]+psf.shape[1]-1)
+    two_pass = min(method_costs(shape, kernel).values()) + \
+        min(method_costs(shape, psf).values())
+    return min(direct_cost(shape, composed),
+               fft_cost(shape, composed)) < two_pass
+
+
+def normal2d(psf, kernel=None, padding='zero', shape=None):
+    """
+    Normal operator of the convolution with psf, as used by the
+    deconvolution solvers,
+        ATA(x) = convolve2d(convolve2d(x, kernel, padding), psf, padding),
+    where kernel defaults to transpose2d(psf).
+
+    With wrap padding the two convolutions are exactly one convolution
+    with the composed kernel (the autocorrelation of psf by default),
+    which is precomputed on the device, cached with psf (along with its
+    spectrum when convolve2d uses FFTs), and used when the cost model
+    deems it cheaper for images of the given shape. Other padding modes
+    keep the two passes.
+
+    Inputs:
+        psf : convolutional kernel array.
+        kernel : the adjoint kernel. transpose2d(psf) when omitted.
+        padding : 'zero', 'same' or 'wrap'.
+        shape : shape of the images ATA is applied to, for the cost
+            model. The composed kernel is used whenever possible when
+            omitted.
+
+    Outputs:
+        ATA : a function of one array.
+    """
+    if _composable(psf if kernel is None else kernel, psf, padding, shape):
+        if kernel is None:
+            cache = array_cache(psf)
+            if 'normal' not in cache:
+                cache['normal'] = compose2d(transpose2d(psf), psf)
+            composed = cache['normal']
+        else:
+            composed = compose2d(kernel, psf)
+
+        def ATA(x, out=None):
+            return convolve2d(x, composed, 'wrap', out=out)
+        return ATA
+    if kernel is None:
+        kernel = transpose2d(psf)
+    tmp = {}
+
+    def ATA(x, out=None):
+        key = (x.shape, x.dtype)
+        if key not in tmp:
+            tmp[key] = npcl.empty_like(x)
+        y = convolve2d(x, kernel, padding, out=tmp[key])
+        return convolve2d(y, psf, padding, out=out)
+    return ATA
@@ -0,0 +1,171 @@
+inline int wrap(int x, int w){
+    int res = x % w;
+    return res<0?res+w:res;
+}
+
+inline ${R}2 cmul(${R}2 a, ${R}2 b){
+    return (${R}2)(a.x*b.x - a.y*b.y, a.x*b.y + a.y*b.x);
+}
+
+inline ${R}2 cmul_conj(${R}2 a, ${R}2 b){
+    return (${R}2)(a.x*b.x + a.y*b.y, a.y*b.x - a.x*b.y);
+}
+
+// One Stockham pass of radix R (2 or 4) over a line of N elements, which
+// are stride apart. tw holds exp(-2*pi*i*m/N) for m < N.
+inline void stockham(
+    __global const ${R}2 *s,
+    __global ${R}2 *d,
+    __global const ${R}2 *tw,
+    const int j,
+    const int N,
+    const int R,
+    const int Ns,
+    const int stride,
+    const ${R} sign
+    ){
+    int k = j % Ns;
+    int step = N/(R*Ns);
+    int idx = (j/Ns)*Ns*R + k;
+    ${R}2 w;
+
+    if (R == 4){
+        int M = N/4;
+        ${R}2 v0 = s[j*stride];
+        ${R}2 v1 = s[(j+M)*stride];
+        ${R}2 v2 = s[(j+2*M)*stride];
+        ${R}2 v3 = s[(j+3*M)*stride];
+        w = tw[k*step];
+        v1 = cmul(v1, (${R}2)(w.x, -sign*w.y));
+        w = tw[2*k*step];
+        v2 = cmul(v2, (${R}2)(w.x, -sign*w.y));
+        w = tw[3*k*step];
+        v3 = cmul(v3, (${R}2)(w.x, -sign*w.y));
+        ${R}2 a0 = v0+v2;
+        ${R}2 a1 = v0-v2;
+        ${R}2 a2 = v1+v3;
+        ${R}2 a3 = v1-v3;
+        // a3 times sign*i
+        a3 = (${R}2)(-sign*a3.y, sign*a3.x);
+        d[idx*stride] = a0+a2;
+        d[(idx+Ns)*stride] = a1+a3;
+        d[(idx+2*Ns)*stride] = a0-a2;
+        d[(idx+3*Ns)*stride] = a1-a3;
+    }
+    else{
+        ${R}2 v0 = s[j*stride];
+        ${R}2 v1 = s[(j+N/2)*stride];
+        w = tw[k*step];
+        v1 = cmul(v1, (${R}2)(w.x, -sign*w.y));
+        d[idx*stride] = v0+v1;
+        d[(idx+Ns)*stride] = v0-v1;
+    }
+}
+
+
+// One Stockham pass along the rows of a (batch of) Ny x N array.
+__kernel void fft_rows(
+    __global const ${R}2 *src,
+    __global ${R}2 *dst,
+    __global const ${R}2 *tw,
+    const int R,
+    const int Ns,
+    const ${R} sign
+    ){
+    int j = get_global_id(0);
+    int b = get_global_id(1);
+    int N = R*get_global_size(0);
+
+    stockham(src + b*N, dst + b*N, tw, j, N, R, Ns, 1, sign);
+}
+
+
+// One Stockham pass along the columns of a (batch of) N x Nx array.
+// Neighbouring work-items handle neighbouring columns, which keeps the
+// memory accesses contiguous.
+__kernel void fft_cols(
+    __global const ${R}2 *src,
+    __global ${R}2 *dst,
+    __global const ${R}2 *tw,
+    const int R,
+    const int Ns,
+    const ${R} sign
+    ){
+    int c = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int N = R*get_global_size(1);
+    int b = c + N*Nx*get_global_id(2);
+
+    stockham(src + b, dst + b, tw, j, N, R, Ns, Nx, sign);
+}
+
+
+// Extend input (Ny x Nx) by (hy, hx) with the given padding mode into the
+// top-left Ey x Ex corner of a complex Py x Px array, zero elsewhere.
+// mode 0 : zero, 1 : same, 2 : wrap
+__kernel void fft_pad(
+    __global const ${T} *input,
+    __global ${R}2 *output,
+    const int Ny,
+    const int Nx,
+    const int hy,
+    const int hx,
+    const int Ey,
+    const int Ex,
+    const int mode
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Px = get_global_size(0);
+    int Py = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    output += Px*Py*b;
+
+    ${R} val = 0;
+    if (i < Ex && j < Ey){
+        int ref_i = i - hx;
+        int ref_j = j - hy;
+        if (mode == 0){
+            if (ref_i >= 0 && ref_i < Nx && ref_j >= 0 && ref_j < Ny){
+                val = LOAD(input, ref_i + Nx*ref_j);
+            }
+        }
+        else if (mode == 1){
+            val = LOAD(input, clamp(ref_i, 0, Nx-1) + Nx*clamp(ref_j, 0, Ny-1));
+        }
+        else{
+            val = LOAD(input, wrap(ref_i, Nx) + Nx*wrap(ref_j, Ny));
+        }
+    }
+    output[i + Px*j] = (${R}2)(val, 0);
+}
+
+
+// a *= conj(h), where h (of size N) is shared by a batch of spectra
+__kernel void fft_mul_conj(
+    __global ${R}2 *a,
+    __global const ${R}2 *h,
+    const int N
+    ){
+    int i = get_global_id(0);
+    a[i] = cmul_conj(a[i], h[i % N]);
+}
+
+
+__kernel void fft_crop(
+    __global const ${R}2 *input,
+    __global ${T} *output,
+    const int Py,
+    const int Px,
+    const ${R} scale
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+
+    STORE(output, i + Nx*j + Nx*Ny*b, input[i + Px*j + Px*Py*b].x*scale);
+}
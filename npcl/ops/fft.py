@@ -0,0 +1,206 @@
+from os.path import abspath
+import npcl
+from npcl.registry import get, get_program, array_cache
+from npcl.dtypes import dtype_of, real_dtype, complex_dtype, astype
+from npcl.ops.batch import batch_shape
+import numpy as np
+
+
+kernel_fp = abspath(__file__).replace('.py', '.cl')
+
+PADDING_MODES = {'zero': 0, 'same': 1, 'wrap': 2}
+
+
+def check_kernel_shape(kernel_shape):
+    """
+    Raise ValueError for kernels of even height or width, whose centre
+    is not a pixel.
+    """
+    if kernel_shape[0] % 2 == 0 or kernel_shape[1] % 2 == 0:
+        raise ValueError(
+            'kernel sizes must be odd, got %dx%d' % tuple(kernel_shape[:2]))
+
+
+def build(parameter, dtype=None):
+    if dtype is None:
+        dtype = dtype_of(parameter)
+    return get_program(parameter, kernel_fp, dtype=dtype)
+
+
+def next_pow2(n):
+    return 1 << int(np.ceil(np.log2(max(n, 1))))
+
+
+def fft_shape(shape, kernel_shape):
+    """
+    Shape of the (power of two) spectrum used to convolve an image of
+    the given shape with a kernel of the given shape.
+    """
+    return (
+        next_pow2(shape[-2]+kernel_shape[0]-1),
+        next_pow2(shape[-1]+kernel_shape[1]-1),
+        )
+
+
+def twiddles(parameter, N, dtype=np.complex64):
+    """
+    Twiddle factors exp(-2*pi*i*m/N), m < N, on the context of parameter.
+    """
+    dtype = np.dtype(dtype)
+
+    def factory(ctx):
+        tw = np.exp(-2j*np.pi*np.arange(N)/N)
+        return npcl.to_device(tw, dtype, queue=parameter.queue)
+    return get(parameter, ('fft_twiddles', N, dtype.name), factory)
+
+
+def _passes(N):
+    # radix-4 passes, finished by one radix-2 pass for odd powers of two
+    Ns = 1
+    while Ns < N:
+        R = 4 if Ns*4 <= N else 2
+        yield R, Ns
+        Ns *= R
+
+
+def _real_of(dtype):
+    return np.dtype(np.float64 if dtype == np.complex128 else np.float32)
+
+
+def _fft2d(prg, a, b, sign):
+    # returns the buffer that holds the result, the other one is scratch
+    queue = a.queue
+    N, P, Q = batch_shape(a)
+    sign = _real_of(a.dtype).type(sign)
+    tw = twiddles(a, Q, a.dtype)
+    for R, Ns in _passes(Q):
+        prg.fft_rows(
+            queue, (Q//R, N*P), None, a.data, b.data, tw.data,
+            np.int32(R), np.int32(Ns), sign,
+            )
+        a, b = b, a
+    tw = twiddles(a, P, a.dtype)
+    for R, Ns in _passes(P):
+        prg.fft_cols(
+            queue, (Q, P//R, N), None, a.data, b.data, tw.data,
+            np.int32(R), np.int32(Ns), sign,
+            )
+        a, b = b, a
+    return a, b
+
+
+def fft2d(x, inverse=False):
+    """
+    Compute the (unnormalized) 2D FFT of a complex64 or complex128 array.
+
+    Both image dimensions of x must be powers of two.
+
+    Inputs:
+        x : input array (complex), an image or a batch of images.
+        inverse : (bool) compute the inverse transform (without 1/N).
+
+    Outputs:
+        y : output array (complex).
+    """
+    for n in x.shape[-2:]:
+        if n != next_pow2(n):
+            raise ValueError('fft2d needs power of two dimensions')
+    prg = build(x, _real_of(x.dtype))
+    a = x.copy()
+    b = npcl.empty_like(x)
+    a, b = _fft2d(prg, a, b, 1 if inverse else -1)
+    return a
+
+
+def _pad(prg, x, P, Q, hy, hx, Ey, Ex, mode):
+    N, H, W = batch_shape(x)
+    res = npcl.empty(
+        x.shape[:-2]+(P, Q), complex_dtype(x.dtype), queue=x.queue)
+    prg.fft_pad(
+        x.queue, (Q, P, N), None,
+        x.data, res.data,
+        np.int32(H), np.int32(W),
+        np.int32(hy), np.int32(hx),
+        np.int32(Ey), np.int32(Ex),
+        np.int32(mode),
+        )
+    return res
+
+
+def kernel_spectrum(k, shape, dtype=np.float32):
+    """
+    Spectrum of the convolutional kernel k zero-padded to shape, used to
+    convolve dtype arrays.
+
+    The spectrum is cached for as long as k is alive, so iterative solvers
+    pay for the kernel FFT only once. Call npcl.registry.forget(k) after
+    modifying k in place.
+    """
+    cache = array_cache(k)
+    real = real_dtype(dtype)
+    key = ('fft_spectrum', tuple(shape), real.name)
+    spectrum = cache.get(key)
+    if spectrum is None:
+        k_real = astype(k, real)
+        prg = build(k_real)
+        P, Q = shape
+        a = _pad(prg, k_real, P, Q, 0, 0, k.shape[0], k.shape[1], 0)
+        b = npcl.empty_like(a)
+        spectrum, _ = _fft2d(prg, a, b, -1)
+        cache[key] = spectrum
+    return spectrum
+
+
+def convolve2d_fft(x, k, padding='zero', out=None):
+    """
+    Compute 2D convolution with FFTs.
+
+    This function computes the same result as
+    npcl.ops.convolve.convolve2d(x, k, padding) by extending x according
+    to the padding mode, and multiplying spectra.
+
+    Inputs:
+        x : input array, an image or a batch of images.
+        k : convolutional kernel array.
+        padding : 'zero', 'same' or 'wrap'.
+        out : output array. Allocated when omitted.
+
+    Outputs:
+        y : output array.
+    """
+    check_kernel_shape(k.shape)
+    prg = build(x)
+    queue = x.queue
+    N, H, W = batch_shape(x)
+    P, Q = fft_shape(x.shape, k.shape)
+    spectrum = kernel_spectrum(k, (P, Q), x.dtype)
+    a = _pad(
+        prg, x, P, Q, k.shape[0]//2, k.shape[1]//2,
+        H+k.shape[0]-1, W+k.shape[1]-1,
+        PADDING_MODES[padding],
+        )
+    b = npcl.empty_like(a)
+    a, b = _fft2d(prg, a, b, -1)
+    prg.fft_mul_conj(
+        queue, (N*P*Q,), None, a.data, spectrum.data, np.int32(P*Q))
+    a, b = _fft2d(prg, a, b, 1)
+    res = npcl.empty_like(x) if out is None else out
+    prg.fft_crop(
+        queue, (W, H, N), None,
+        a.data, res.data, np.int32(P), np.int32(Q),
+        real_dtype(x.dtype).type(1./(P*Q)),
+        )
+    return res
+
+
+def fft_cost(shape, kernel_shape):
+    """
+    Estimated cost of convolve2d_fft (with a cached kernel spectrum),
+    in units of one multiply-add of the direct convolution.
+    """
+    P, Q = fft_shape(shape, kernel_shape)
+    N = shape[0] if len(shape) == 3 else 1
+    n_passes = len(list(_passes(P))) + len(list(_passes(Q)))
+    # two FFTs, plus padding, pointwise product and cropping, where one
+    # pass over the complex spectrum costs about two multiply-adds.
+    return 2*N*P*Q*(2*n_passes+3)
@@ -1,7 +1,7 @@
 __kernel void grad(
-    __global const float *input,
-    __global float * gx,
-    __global float * gy
+    __global const ${T} *input,
+    __global ${T} *gx,
+    __global ${T} *gy
     ){
     
     int i = get_global_id(0);
@@ -9,16 +9,20 @@ __kernel void grad(
 
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    input += Nx*Ny*b;
+    gx += Nx*Ny*b;
+    gy += Nx*Ny*b;
 
-    gx[i+Nx*j] = i<Nx-1?input[i+1+Nx*j]-input[i+Nx*j]:0;
-    gy[i+Nx*j] = j<Ny-1?input[i+Nx*(j+1)]-input[i+Nx*j]:0;
+    STORE(gx, i+Nx*j, i<Nx-1?LOAD(input, i+1+Nx*j)-LOAD(input, i+Nx*j):0);
+    STORE(gy, i+Nx*j, j<Ny-1?LOAD(input, i+Nx*(j+1))-LOAD(input, i+Nx*j):0);
 }
 
 
 __kernel void norm(
-    __global const float * gx,
-    __global const float * gy,
-    __global float *output
+    __global const ${T} *gx,
+    __global const ${T} *gy,
+    __global ${T} *output
     ){
 
     int i = get_global_id(0);
@@ -26,25 +30,274 @@ __kernel void norm(
 
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    gx += Nx*Ny*b;
+    gy += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    output[i+Nx*j] = sqrt(pow(gx[i+Nx*j], 2) + pow(gy[i+Nx*j], 2));
+    ${R} dx = LOAD(gx, i+Nx*j);
+    ${R} dy = LOAD(gy, i+Nx*j);
+    STORE(output, i+Nx*j, sqrt(dx*dx + dy*dy));
 }
 
 
 __kernel void divergence2d(
-    __global const float * px,
-    __global const float * py,
-    __global float * output
+    __global const ${T} *px,
+    __global const ${T} *py,
+    __global ${T} *output
     ){
 
     int i = get_global_id(0);
     int j = get_global_id(1);
     int Nx = get_global_size(0);
     int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    px += Nx*Ny*b;
+    py += Nx*Ny*b;
+    output += Nx*Ny*b;
 
-    float dx, dy;
-    dx = i>0&&i<Nx-1?px[i+Nx*j]-px[i-1+Nx*j]:i==0?px[i+Nx*j]:-px[i-1+Nx*j];
-    dy = j>0&&j<Ny-1?py[i+Nx*j]-py[i+Nx*(j-1)]:j==0?py[i+Nx*j]:-py[i+Nx*(j-1)];
+    ${R} dx, dy;
+    dx = i>0&&i<Nx-1?LOAD(px, i+Nx*j)-LOAD(px, i-1+Nx*j):i==0?LOAD(px, i+Nx*j):-LOAD(px, i-1+Nx*j);
+    dy = j>0&&j<Ny-1?LOAD(py, i+Nx*j)-LOAD(py, i+Nx*(j-1)):j==0?LOAD(py, i+Nx*j):-LOAD(py, i+Nx*(j-1));
 
-    output[i+Nx*j] = dx+dy;
+    STORE(output, i+Nx*j, dx+dy);
+}
+
+
+// not named sign, which is an OpenCL builtin
+__kernel void signum(
+    __global const ${T} *input,
+    __global ${T} *output
+    ){
+    int i = get_global_id(0);
+    STORE(output, i, LOAD(input, i) >= 0 ? 1.f : -1.f);
+}
+
+
+__kernel void soft_shrink(
+    __global const ${T} *input,
+    __global ${T} *output,
+    const ${R} mu
+    ){
+    int i = get_global_id(0);
+    ${R} shrinked = fabs(LOAD(input, i)) - mu;
+    STORE(output, i, shrinked > 0 ? (LOAD(input, i) >= 0 ? shrinked : -shrinked) : 0.f);
+}
+
+
+__kernel void soft_shrink_array(
+    __global const ${T} *input,
+    __global const ${T} *mu,
+    __global ${T} *output
+    ){
+    int i = get_global_id(0);
+    ${R} shrinked = fabs(LOAD(input, i)) - LOAD(mu, i);
+    STORE(output, i, shrinked > 0 ? (LOAD(input, i) >= 0 ? shrinked : -shrinked) : 0.f);
+}
+
+
+// Chambolle's projection algorithm for total variation denoising
+
+inline ${R} divergence_at(
+    __global const ${T} *px,
+    __global const ${T} *py,
+    int i, int j, int Nx, int Ny
+    ){
+    int idx = i + Nx*j;
+    ${R} dx, dy;
+    dx = i>0&&i<Nx-1?LOAD(px, idx)-LOAD(px, idx-1):i==0?LOAD(px, idx):-LOAD(px, idx-1);
+    dy = j>0&&j<Ny-1?LOAD(py, idx)-LOAD(py, idx-Nx):j==0?LOAD(py, idx):-LOAD(py, idx-Nx);
+    return dx+dy;
+}
+
+
+inline ${R} tv_primal_at(
+    __global const ${T} *img,
+    __global const ${T} *px,
+    __global const ${T} *py,
+    int i, int j, int Nx, int Ny
+    ){
+    return LOAD(img, i + Nx*j) - divergence_at(px, py, i, j, Nx, Ny);
+}
+
+
+// out = img - div(p), for the items b with mask[b] != 0 (mask may be NULL)
+__kernel void tv_primal(
+    __global const ${T} *img,
+    __global const ${T} *px,
+    __global const ${T} *py,
+    __global ${T} *output,
+    __global const int * mask
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    if (mask && !mask[b]){
+        return;
+    }
+    img += Nx*Ny*b;
+    px += Nx*Ny*b;
+    py += Nx*Ny*b;
+    output += Nx*Ny*b;
+
+    STORE(output, i+Nx*j, tv_primal_at(img, px, py, i, j, Nx, Ny));
+}
+
+
+// One fused iteration: px_out, py_out are the projections of the dual
+// field px, py, and energy (if requested) receives the per-pixel energy
+//     (div p)^2 + weight*|grad(img - div p)|.
+// The primal image img - div(p) of the work-group, and its right/bottom
+// halo, are staged in local memory.
+// Items b of a batch with active[b] == 0 are skipped (active may be NULL).
+__kernel void tv_step_loc(
+    __global const ${T} *img,
+    __global const ${T} *px,
+    __global const ${T} *py,
+    __global ${T} *px_out,
+    __global ${T} *py_out,
+    __global ${T} *energy,
+    __global const int * active,
+    __local ${R} *P,
+    const int Ny,
+    const int Nx,
+    const ${R} tau,
+    const ${R} weight,
+    const int with_energy
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int b = get_global_id(2);
+    int i_loc = get_local_id(0);
+    int j_loc = get_local_id(1);
+    int LX = get_local_size(0);
+    int LY = get_local_size(1);
+    int PSX = LX + 1;
+    int inside = i < Nx && j < Ny;
+
+    // uniform over the work-group, which lies in a single item
+    if (active && !active[b]){
+        return;
+    }
+    img += Nx*Ny*b;
+    px += Nx*Ny*b;
+    py += Nx*Ny*b;
+    px_out += Nx*Ny*b;
+    py_out += Nx*Ny*b;
+    energy += Nx*Ny*b;
+
+    if (inside){
+        P[i_loc + PSX*j_loc] = tv_primal_at(img, px, py, i, j, Nx, Ny);
+        if (i_loc == LX-1 && i+1 < Nx){
+            P[LX + PSX*j_loc] = tv_primal_at(img, px, py, i+1, j, Nx, Ny);
+        }
+        if (j_loc == LY-1 && j+1 < Ny){
+            P[i_loc + PSX*LY] = tv_primal_at(img, px, py, i, j+1, Nx, Ny);
+        }
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    if (inside){
+        int idx = i + Nx*j;
+        ${R} out = P[i_loc + PSX*j_loc];
+        ${R} gx = i<Nx-1?P[i_loc+1 + PSX*j_loc]-out:0.f;
+        ${R} gy = j<Ny-1?P[i_loc + PSX*(j_loc+1)]-out:0.f;
+        ${R} norm = sqrt(gx*gx + gy*gy);
+        if (with_energy){
+            ${R} d = LOAD(img, idx) - out;
+            STORE(energy, idx, d*d + weight*norm);
+        }
+        norm = norm*(tau/weight) + 1.f;
+        STORE(px_out, idx, (LOAD(px, idx) - tau*gx)/norm);
+        STORE(py_out, idx, (LOAD(py, idx) - tau*gy)/norm);
+    }
+}
+
+
+// Primal-dual (Chambolle-Pock) iterations for TV-regularized least
+// squares. Step sizes are scalars, or per-pixel arrays (diagonal
+// preconditioning) when the array argument is not NULL.
+
+// Dual step of the total variation term, fused with the gradient:
+//     p = proj_{|p| <= mu}(p + sigma*grad(xbar)), in place.
+__kernel void pdhg_dual_tv(
+    __global const ${T} *xbar,
+    __global ${T} *px,
+    __global ${T} *py,
+    const ${R} sigma,
+    const ${R} mu
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    xbar += Nx*Ny*b;
+    px += Nx*Ny*b;
+    py += Nx*Ny*b;
+
+    int idx = i + Nx*j;
+    ${R} x = LOAD(xbar, idx);
+    ${R} qx = LOAD(px, idx) + sigma*(i<Nx-1?LOAD(xbar, idx+1)-x:0.f);
+    ${R} qy = LOAD(py, idx) + sigma*(j<Ny-1?LOAD(xbar, idx+Nx)-x:0.f);
+    ${R} norm = max(sqrt(qx*qx + qy*qy)/mu, (${R})1.f);
+    STORE(px, idx, qx/norm);
+    STORE(py, idx, qy/norm);
+}
+
+
+// Dual step of the data term 1/2*|Ax-b|^2:
+//     y = (y + sigma*(Axbar - b))/(1 + sigma), in place.
+__kernel void pdhg_dual_data(
+    __global ${T} *y,
+    __global const ${T} *Axbar,
+    __global const ${T} *b,
+    __global const ${T} *sigma_array,
+    const ${R} sigma
+    ){
+    int i = get_global_id(0);
+    ${R} s = sigma_array ? LOAD(sigma_array, i) : sigma;
+    STORE(y, i, (LOAD(y, i) + s*(LOAD(Axbar, i) - LOAD(b, i)))/(1.f + s));
+}
+
+
+// Primal step, fused with the divergence and the extrapolation:
+//     x_new = x - tau*(ATy - div(p)), in place,
+//     xbar = x_new + theta*(x_new - x),
+// and the squared update |x_new - x|^2 per pixel if requested.
+__kernel void pdhg_primal(
+    __global ${T} *x,
+    __global const ${T} *ATy,
+    __global const ${T} *px,
+    __global const ${T} *py,
+    __global const ${T} *tau_array,
+    __global ${T} *xbar,
+    __global ${T} *diff,
+    const ${R} tau,
+    const ${R} theta,
+    const int with_diff
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    x += Nx*Ny*b;
+    ATy += Nx*Ny*b;
+    px += Nx*Ny*b;
+    py += Nx*Ny*b;
+    xbar += Nx*Ny*b;
+    diff += Nx*Ny*b;
+
+    int idx = i + Nx*j;
+    ${R} t = tau_array ? LOAD(tau_array + Nx*Ny*b, idx) : tau;
+    ${R} x_old = LOAD(x, idx);
+    ${R} d = -t*(LOAD(ATy, idx) - divergence_at(px, py, i, j, Nx, Ny));
+    STORE(x, idx, x_old + d);
+    STORE(xbar, idx, x_old + (1.f + theta)*d);
+    if (with_diff){
+        STORE(diff, idx, d*d);
+    }
 }
@@ -1,55 +1,195 @@
 from os.path import abspath
 import pyopencl as cl
 import npcl
+from npcl.registry import get_program
+from npcl.dtypes import dtype_of, real_dtype
+from npcl.ops.batch import batch_shape, global_size
 import numpy as np
 
 
-prg = None
+kernel_fp = abspath(__file__).replace('.py', '.cl')
 
 
 def build(parameter):
-    if type(parameter) == cl.Context:
-        ctx = parameter
-    if type(parameter) == npcl.Array:
-        ctx = parameter.context
-    global prg
-    kernel_fp = abspath(__file__).replace('.py', '.cl')
-    prg = cl.Program(ctx, open(kernel_fp, 'r').read())
-    prg.build()
-
-
-def grad2d(x):
-    if prg is None:
-        build(x)
+    return get_program(parameter, kernel_fp, dtype=dtype_of(parameter))
+
+
+def grad2d(x, out=None):
+    prg = build(x)
     queue = x.queue
-    gx = npcl.zeros_like(x)
-    gy = npcl.zeros_like(x)
-    prg.grad(queue, x.shape[::-1], None, x.data, gx.data, gy.data)
+    if out is None:
+        gx = npcl.empty_like(x)
+        gy = npcl.empty_like(x)
+    else:
+        gx, gy = out
+    prg.grad(queue, global_size(x), None, x.data, gx.data, gy.data)
     return gx, gy
 
 
-def norm2d(gx, gy):
-    if prg is None:
-        build(gx)
+def norm2d(gx, gy, out=None):
+    prg = build(gx)
     queue = gx.queue
-    norm = npcl.zeros_like(gx)
-    prg.norm(queue, norm.shape[::-1], None, gx.data, gy.data, norm.data)
+    norm = npcl.empty_like(gx) if out is None else out
+    prg.norm(queue, global_size(gx), None, gx.data, gy.data, norm.data)
     return norm
 
 
-def divergence2d(px, py):
-    if prg is None:
-        build(px)
+def divergence2d(px, py, out=None):
+    prg = build(px)
     queue = px.queue
-    d = npcl.zeros_like(px)
-    prg.divergence2d(queue, d.shape[::-1], None, px.data, py.data, d.data)
+    d = npcl.empty_like(px) if out is None else out
+    prg.divergence2d(
+        queue, global_size(px), None, px.data, py.data, d.data)
     return d
 
 
-def sign(x):
-    return ((x >= 0).astype(np.float32)-np.float32(0.5))*2
+def tv_primal(img, px, py, out=None, mask=None):
+    """
+    Compute img - div(px, py).
+
+    For batches, only the items b with mask[b] != 0 are written when a
+    (N,) int32 mask array is given.
+    """
+    prg = build(img)
+    res = npcl.empty_like(img) if out is None else out
+    prg.tv_primal(
+        img.queue, global_size(img), None,
+        img.data, px.data, py.data, res.data,
+        None if mask is None else mask.data,
+        )
+    return res
+
+
+def tv_step(
+        img, px, py, tau, weight, out=None, energy=None, active=None,
+        ):
+    """
+    One fused iteration of Chambolle's projection algorithm.
+
+    This function computes, in a single kernel,
+        g = grad(img - div(p)),
+        p_out = (p - tau*g) / (1 + tau/weight*|g|),
+    and optionally the per-pixel energy (div p)^2 + weight*|g|.
+
+    Inputs:
+        img : input image.
+        px, py : dual field p.
+        tau : (np.float32) step size.
+        weight : (np.float32) regularization weight.
+        out : (px_out, py_out) output arrays, which must not alias px, py.
+        energy : array receiving the per-pixel energy, skipped when None.
+        active : (N,) int32 array. For batches, items b with
+            active[b] == 0 are left untouched.
+
+    Outputs:
+        px_out, py_out : updated dual field.
+    """
+    prg = build(img)
+    queue = img.queue
+    if out is None:
+        px_out = npcl.empty_like(px)
+        py_out = npcl.empty_like(py)
+    else:
+        px_out, py_out = out
+    real = real_dtype(img.dtype)
+    group = _group_shape(queue.device)
+    N, Ny, Nx = batch_shape(img)
+    prg.tv_step_loc(
+        queue,
+        (Nx+(-Nx) % group[0], Ny+(-Ny) % group[1], N), group+(1,),
+        img.data, px.data, py.data, px_out.data, py_out.data,
+        (px_out if energy is None else energy).data,
+        None if active is None else active.data,
+        cl.LocalMemory(real.itemsize*(group[0]+1)*(group[1]+1)),
+        np.int32(Ny), np.int32(Nx),
+        real.type(tau), real.type(weight),
+        np.int32(energy is not None),
+        )
+    return px_out, py_out
+
+
+def pdhg_dual_tv(xbar, px, py, sigma, mu):
+    """
+    Dual step of the total variation term of the primal-dual algorithm,
+    in place:
+        p = proj_{|p| <= mu}(p + sigma*grad(xbar)).
+    """
+    prg = build(xbar)
+    real = real_dtype(xbar.dtype)
+    prg.pdhg_dual_tv(
+        xbar.queue, global_size(xbar), None,
+        xbar.data, px.data, py.data, real.type(sigma), real.type(mu),
+        )
+    return px, py
+
+
+def pdhg_dual_data(y, Axbar, b, sigma):
+    """
+    Dual step of the data term 1/2*|Ax-b|^2 of the primal-dual algorithm,
+    in place:
+        y = (y + sigma*(Axbar - b))/(1 + sigma),
+    where sigma is a scalar or an array of per-pixel steps.
+    """
+    prg = build(y)
+    is_array = isinstance(sigma, npcl.Array)
+    prg.pdhg_dual_data(
+        y.queue, (y.size,), None,
+        y.data, Axbar.data, b.data, sigma.data if is_array else None,
+        real_dtype(y.dtype).type(0 if is_array else sigma),
+        )
+    return y
+
+
+def pdhg_primal(x, ATy, px, py, tau, theta=1., xbar=None, diff=None):
+    """
+    Primal step of the primal-dual algorithm, in place, with the
+    extrapolation:
+        x_new = x - tau*(ATy - div(p)),
+        xbar = x_new + theta*(x_new - x),
+    where tau is a scalar or an array of per-pixel steps. The squared
+    update (x_new - x)^2 is written to diff if given.
+
+    Outputs:
+        x, xbar : updated arrays.
+    """
+    prg = build(x)
+    real = real_dtype(x.dtype)
+    xbar = npcl.empty_like(x) if xbar is None else xbar
+    is_array = isinstance(tau, npcl.Array)
+    prg.pdhg_primal(
+        x.queue, global_size(x), None,
+        x.data, ATy.data, px.data, py.data,
+        tau.data if is_array else None, xbar.data,
+        (xbar if diff is None else diff).data,
+        real.type(0 if is_array else tau), real.type(theta),
+        np.int32(diff is not None),
+        )
+    return x, xbar
+
+
+def _group_shape(device):
+    n = 16
+    while n*n > device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE):
+        n //= 2
+    return (n, n)
+
+
+def sign(x, out=None):
+    prg = build(x)
+    res = npcl.empty_like(x) if out is None else out
+    prg.signum(x.queue, (x.size,), None, x.data, res.data)
+    return res
 
 
-def soft_shrink(x, mu):
-    shrinked = npcl.fabs(x)-mu
-    return sign(x)*(shrinked > 0)*shrinked
+def soft_shrink(x, mu, out=None):
+    prg = build(x)
+    res = npcl.empty_like(x) if out is None else out
+    if isinstance(mu, npcl.Array):
+        prg.soft_shrink_array(
+            x.queue, (x.size,), None, x.data, mu.data, res.data)
+    else:
+        prg.soft_shrink(
+            x.queue, (x.size,), None, x.data, res.data,
+            real_dtype(x.dtype).type(mu),
+            )
+    return res
@@ -0,0 +1,35 @@
+// Low-rank spatially-variant convolution, sum_r w_r (k_r*x).
+// Global size : (W, H, N), w is a single H x W weight map.
+
+// out = w*x, or out += w*x when accumulate is nonzero.
+__kernel void weighted_sum(
+    __global const ${T} *x,
+    __global const ${R} *w,
+    __global ${T} *out,
+    const int accumulate
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    int p = i + Nx*j;
+    x += Nx*Ny*b;
+    out += Nx*Ny*b;
+
+    ${R} res = w[p]*LOAD(x, p);
+    if (accumulate){
+        res += LOAD(out, p);
+    }
+    STORE(out, p, res);
+}
+
+
+// out += x, elementwise (global size : the number of elements).
+__kernel void accumulate(
+    __global const ${T} *x,
+    __global ${T} *out
+    ){
+    int i = get_global_id(0);
+    STORE(out, i, LOAD(out, i) + LOAD(x, i));
+}
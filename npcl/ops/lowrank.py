@@ -0,0 +1,209 @@
+r"""
+Low-rank representation of spatially-variant blurs.
+
+A spatially-variant PSF is represented by R shift-invariant basis PSFs
+k_r and R weight maps w_r, the PSF at pixel p being
+    K_p = \sum_r w_r(p) k_r.
+Memory scales with R*H*W instead of Kh*Kw*H*W for the dense 4D kernel
+of convolve2d_sv. The blur is applied as R convolutions,
+    y = \sum_r w_r (k_r*x),
+which computes the same as convolve2d_sv with the dense kernel.
+"""
+from os.path import abspath
+import npcl
+from npcl.registry import get_program
+from npcl.dtypes import dtype_of, real_dtype, astype
+from npcl.ops.batch import global_size
+from npcl.ops.convolve import convolve2d, transpose2d
+import numpy as np
+
+
+kernel_fp = abspath(__file__).replace('.py', '.cl')
+
+
+def build(parameter):
+    return get_program(parameter, kernel_fp, dtype=dtype_of(parameter))
+
+
+class LowRankPSF(object):
+    """
+    Spatially-variant PSF as a sum of R weighted shift-invariant PSFs.
+
+    Inputs:
+        basis : list of R convolutional kernel arrays (Kh x Kw).
+        weights : list of R weight map arrays (H x W).
+
+    Attributes:
+        shape : (Kh, Kw, H, W), the shape of the equivalent dense kernel.
+        rank : R.
+    """
+
+    def __init__(self, basis, weights):
+        if len(basis) != len(weights):
+            raise ValueError('basis and weights must have the same length')
+        self.basis = list(basis)
+        self.weights = list(weights)
+        self.shape = self.basis[0].shape + self.weights[0].shape
+        self.rank = len(self.basis)
+        self._transposed = None
+
+    @property
+    def queue(self):
+        return self.basis[0].queue
+
+    def transposed_basis(self):
+        """
+        Transposed basis kernels, computed once per basis list.
+        """
+        if self._transposed is None or self._transposed[0] is not self.basis:
+            self._transposed = (
+                self.basis, [transpose2d(k) for k in self.basis])
+        return self._transposed[1]
+
+    def todense(self):
+        """
+        Equivalent dense kernel for convolve2d_sv, as a numpy array.
+        """
+        return sum(
+            k.get()[:, :, None, None]*w.get()[None, None]
+            for k, w in zip(self.basis, self.weights))
+
+
+def _weighted(prg, x, w, out, accumulate):
+    prg.weighted_sum(
+        x.queue, global_size(x), None,
+        x.data, w.data, out.data, np.int32(accumulate),
+        )
+    return out
+
+
+def convolve2d_lowrank(x, psf, padding='zero', out=None, **kwargs):
+    r"""
+    Compute 2D spatially-variant convolution with a low-rank PSF.
+
+    This function computes
+        y = \sum_r w_r (k_r*x),
+    the same as convolve2d_sv(x, psf.todense(), padding).
+
+    Inputs:
+        x : input array, an image or a batch of images.
+        psf : LowRankPSF.
+        padding : 'zero', 'same' or 'wrap'.
+        out : output array. Allocated when omitted.
+        kwargs : passed to convolve2d (method, rank).
+
+    Outputs:
+        y : output array.
+    """
+    prg = build(x)
+    real = real_dtype(x.dtype)
+    res = npcl.empty_like(x) if out is None else out
+    tmp = npcl.empty_like(x)
+    for r, (k, w) in enumerate(zip(psf.basis, psf.weights)):
+        convolve2d(x, k, padding, out=tmp, **kwargs)
+        _weighted(prg, tmp, astype(w, real), res, r > 0)
+    return res
+
+
+def correlate2d_lowrank(y, psf, padding='zero', out=None, **kwargs):
+    r"""
+    Adjoint of convolve2d_lowrank,
+        x = \sum_r k_r^T*(w_r y),
+    exact for zero padding.
+
+    Inputs:
+        y : input array, an image or a batch of images.
+        psf : LowRankPSF.
+        padding : 'zero', 'same' or 'wrap'.
+        out : output array. Allocated when omitted.
+        kwargs : passed to convolve2d (method, rank).
+
+    Outputs:
+        x : output array.
+    """
+    prg = build(y)
+    real = real_dtype(y.dtype)
+    res = npcl.empty_like(y) if out is None else out
+    tmp = npcl.empty_like(y)
+    conv = npcl.empty_like(y)
+    for r, (k, w) in enumerate(zip(psf.transposed_basis(), psf.weights)):
+        _weighted(prg, y, astype(w, real), tmp, False)
+        if r == 0:
+            convolve2d(tmp, k, padding, out=res, **kwargs)
+        else:
+            convolve2d(tmp, k, padding, out=conv, **kwargs)
+            prg.accumulate(y.queue, (y.size,), None, conv.data, res.data)
+    return res
+
+
+def _svd(a, rank, tol):
+    # truncated SVD of the 2D array a
+    u, s, vt = np.linalg.svd(a.astype(np.float64), full_matrices=False)
+    if rank is None:
+        rank = max(int(np.sum(s > tol*s[0])), 1) if s[0] > 0 else 1
+    rank = min(rank, len(s))
+    return u[:, :rank], s[:rank], vt[:rank]
+
+
+def _hat(n, m):
+    # (n, m) linear interpolation weights of m grid points, centred in m
+    # equal cells of [0, n), at the n pixels. Constant beyond the outer
+    # grid points; the rows sum to one.
+    centers = (np.arange(m)+0.5)*n/m-0.5
+    pos = np.clip(np.arange(n), centers[0], centers[-1])
+    res = np.zeros((n, m))
+    if m == 1:
+        res[:] = 1
+        return res
+    g = np.clip(np.searchsorted(centers, pos, side='right')-1, 0, m-2)
+    t = (pos-centers[g])/(centers[g+1]-centers[g])
+    res[np.arange(n), g] = 1-t
+    res[np.arange(n), g+1] = t
+    return res
+
+
+def fit_lowrank(psf_grid, shape, rank=None, tol=1e-3, dtype=np.float32,
+                queue=None):
+    """
+    Fit a LowRankPSF to PSFs measured on a regular grid.
+
+    The PSF at a pixel is the bilinear interpolation of the grid PSFs,
+    grid point (a, b) being the centre of cell (a, b) of a gy x gx
+    partition of the image. The grid PSFs are compressed to their
+    principal components, the weight maps interpolate the coefficients.
+
+    Inputs:
+        psf_grid : (numpy.ndarray) gy x gx x Kh x Kw PSFs.
+        shape : (H, W) image shape.
+        rank : (int) number of basis PSFs. By default every component
+            whose singular value is larger than tol times the largest one.
+        tol : (float) relative tolerance on the singular values.
+        dtype : dtype of the basis and weight arrays.
+
+    Outputs:
+        psf : LowRankPSF.
+    """
+    gy, gx, Kh, Kw = psf_grid.shape
+    u, s, vt = _svd(psf_grid.reshape(gy*gx, Kh*Kw), rank, tol)
+    Ay = _hat(shape[0], gy)
+    Ax = _hat(shape[1], gx)
+    return LowRankPSF(
+        [npcl.to_device(v.reshape(Kh, Kw), dtype, queue) for v in vt],
+        [npcl.to_device(np.dot(np.dot(Ay, c.reshape(gy, gx)), Ax.T),
+                        dtype, queue)
+         for c in (u*s).T],
+        )
+
+
+def lowrank_from_dense(k, rank=None, tol=1e-3, dtype=np.float32,
+                       queue=None):
+    """
+    Best rank R approximation of a dense spatially-variant kernel
+    (Kh x Kw x H x W numpy array), see fit_lowrank.
+    """
+    Kh, Kw, H, W = k.shape
+    u, s, vt = _svd(k.reshape(Kh*Kw, H*W), rank, tol)
+    return LowRankPSF(
+        [npcl.to_device(c.reshape(Kh, Kw), dtype, queue) for c in (u*s).T],
+        [npcl.to_device(v.reshape(H, W), dtype, queue) for v in vt],
+        )
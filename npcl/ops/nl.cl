@@ -0,0 +1,369 @@
+// Nonlocal operators on a sparse patch-similarity graph.
+//
+// The graph of an Ny x Nx image stores NL_K outgoing edges per pixel in
+// fixed-k layout: edge n of pixel x has the index e = x + Nx*Ny*n in
+//     weights : the edge weight w_e,
+//     nbrs : the (flattened) index of the neighbour, -1 for no edge,
+// and the NL_KR incoming edges of pixel y are listed (as indices e) in
+//     reverse : -1 for no edge,
+// so that the divergence gathers instead of scattering.
+// For batches, every item has its own graph (global id 2).
+
+#ifndef NL_K
+#define NL_K 10
+#endif
+#ifndef NL_KR
+#define NL_KR (2*NL_K)
+#endif
+
+inline int nl_index(int i, int j, int Nx){
+    return i + Nx*j;
+}
+
+
+// Weights of the NL_K most similar patches in the search window of
+// every pixel, w = exp(-d/h^2) normalized to sum 1, where d is the mean
+// squared difference of the (2*PR+1)^2 patches. With inv_h2 <= 0, h^2 is
+// the mean distance of the pixel's NL_K neighbours.
+// The tile of the work-group, extended by S+PR pixels on each side, is
+// staged in local memory, with 'same' padding.
+__kernel void nl_weights_loc(
+    __global const ${T} *input,
+    __global ${T} *weights,
+    __global int *nbrs,
+    __local ${R} *P,
+    const int Ny,
+    const int Nx,
+    const int S,
+    const int PR,
+    const ${R} inv_h2
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int b = get_global_id(2);
+    int i_loc = get_local_id(0);
+    int j_loc = get_local_id(1);
+    int LX = get_local_size(0);
+    int LY = get_local_size(1);
+    int H = S + PR;
+    int PX = LX + 2*H;
+    int PY = LY + 2*H;
+    int i0 = get_group_id(0)*LX - H;
+    int j0 = get_group_id(1)*LY - H;
+    input += Nx*Ny*b;
+    weights += Nx*Ny*NL_K*b;
+    nbrs += Nx*Ny*NL_K*b;
+
+    for (int n = i_loc + LX*j_loc; n < PX*PY; n += LX*LY){
+        int ii = clamp(i0 + n % PX, 0, Nx-1);
+        int jj = clamp(j0 + n / PX, 0, Ny-1);
+        P[n] = LOAD(input, ii + Nx*jj);
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (i >= Nx || j >= Ny){
+        return;
+    }
+
+    ${R} dist[NL_K];
+    int idx[NL_K];
+    for (int n = 0; n < NL_K; ++n){
+        dist[n] = MAXFLOAT;
+        idx[n] = -1;
+    }
+    int li = i_loc + H;
+    int lj = j_loc + H;
+    ${R} scale = 1.f/((2*PR+1)*(2*PR+1));
+    for (int oy = max(-S, -j); oy <= min(S, Ny-1-j); ++oy){
+        for (int ox = max(-S, -i); ox <= min(S, Nx-1-i); ++ox){
+            if (ox == 0 && oy == 0){
+                continue;
+            }
+            ${R} d = 0;
+            for (int qy = -PR; qy <= PR; ++qy){
+                for (int qx = -PR; qx <= PR; ++qx){
+                    ${R} diff = P[li+qx + PX*(lj+qy)] -
+                        P[li+ox+qx + PX*(lj+oy+qy)];
+                    d += diff*diff;
+                }
+            }
+            d *= scale;
+            if (d < dist[NL_K-1]){
+                int n = NL_K-1;
+                for (; n > 0 && dist[n-1] > d; --n){
+                    dist[n] = dist[n-1];
+                    idx[n] = idx[n-1];
+                }
+                dist[n] = d;
+                idx[n] = nl_index(i+ox, j+oy, Nx);
+            }
+        }
+    }
+
+    ${R} inv = inv_h2;
+    if (inv <= 0){
+        ${R} mean = 0;
+        int count = 0;
+        for (int n = 0; n < NL_K; ++n){
+            if (idx[n] >= 0){
+                mean += dist[n];
+                ++count;
+            }
+        }
+        inv = count > 0 ? count/max(mean, (${R})1e-30f) : 0;
+    }
+    ${R} total = 0;
+    for (int n = 0; n < NL_K; ++n){
+        dist[n] = idx[n] >= 0 ? exp(-dist[n]*inv) : 0;
+        total += dist[n];
+    }
+    int x = nl_index(i, j, Nx);
+    for (int n = 0; n < NL_K; ++n){
+        STORE(weights, x + Nx*Ny*n, total > 0 ? dist[n]/total : 0);
+        nbrs[x + Nx*Ny*n] = idx[n];
+    }
+}
+
+
+// Incoming edges of every pixel, found in its search window. Edges
+// beyond the NL_KR first ones get a zero weight, so that the divergence
+// stays the exact adjoint of the gradient. Each edge has one target, so
+// the edges written by a work-item are not accessed by any other.
+__kernel void nl_reverse(
+    __global ${T} *weights,
+    __global const int *nbrs,
+    __global int *reverse,
+    const int S
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    int NN = Nx*Ny;
+    weights += NN*NL_K*b;
+    nbrs += NN*NL_K*b;
+    reverse += NN*NL_KR*b;
+
+    int y = nl_index(i, j, Nx);
+    int count = 0;
+    for (int oy = max(-S, j-Ny+1); oy <= min(S, j); ++oy){
+        for (int ox = max(-S, i-Nx+1); ox <= min(S, i); ++ox){
+            int x = nl_index(i-ox, j-oy, Nx);
+            for (int n = 0; n < NL_K; ++n){
+                int e = x + NN*n;
+                if (nbrs[e] == y){
+                    if (count < NL_KR){
+                        reverse[y + NN*count] = e;
+                        ++count;
+                    }
+                    else{
+                        STORE(weights, e, 0.f);
+                    }
+                }
+            }
+        }
+    }
+    for (; count < NL_KR; ++count){
+        reverse[y + NN*count] = -1;
+    }
+}
+
+
+// Sum of the weights of the incoming and outgoing edges of every pixel,
+// whose maximum M bounds the norm of the gradient, |grad|^2 <= 2*M.
+__kernel void nl_degree(
+    __global const ${T} *weights,
+    __global const int *reverse,
+    __global ${T} *output
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    int NN = Nx*Ny;
+    weights += NN*NL_K*b;
+    reverse += NN*NL_KR*b;
+    output += NN*b;
+
+    int y = nl_index(i, j, Nx);
+    ${R} res = 0;
+    for (int n = 0; n < NL_K; ++n){
+        res += LOAD(weights, y + NN*n);
+    }
+    for (int r = 0; r < NL_KR; ++r){
+        int e = reverse[y + NN*r];
+        if (e >= 0){
+            res += LOAD(weights, e);
+        }
+    }
+    STORE(output, y, res);
+}
+
+
+// Nonlocal gradient, g_e = sqrt(w_e)*(u_q - u_x) for the edge e from x
+// to q.
+inline ${R} nl_grad_at(
+    __global const ${T} *u,
+    __global const ${T} *weights,
+    __global const int *nbrs,
+    int x, int e
+    ){
+    int q = nbrs[e];
+    return q >= 0 ? sqrt(LOAD(weights, e))*(LOAD(u, q) - LOAD(u, x)) : 0.f;
+}
+
+
+// Nonlocal divergence, the negative adjoint of the gradient: outgoing
+// minus incoming weighted edge values.
+inline ${R} nl_div_at(
+    __global const ${T} *p,
+    __global const ${T} *weights,
+    __global const int *reverse,
+    int y, int NN
+    ){
+    ${R} res = 0;
+    for (int n = 0; n < NL_K; ++n){
+        int e = y + NN*n;
+        res += sqrt(LOAD(weights, e))*LOAD(p, e);
+    }
+    for (int r = 0; r < NL_KR; ++r){
+        int e = reverse[y + NN*r];
+        if (e >= 0){
+            res -= sqrt(LOAD(weights, e))*LOAD(p, e);
+        }
+    }
+    return res;
+}
+
+
+__kernel void nl_grad(
+    __global const ${T} *u,
+    __global const ${T} *weights,
+    __global const int *nbrs,
+    __global ${T} *g
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    int NN = Nx*Ny;
+    u += NN*b;
+    weights += NN*NL_K*b;
+    nbrs += NN*NL_K*b;
+    g += NN*NL_K*b;
+
+    int x = nl_index(i, j, Nx);
+    for (int n = 0; n < NL_K; ++n){
+        int e = x + NN*n;
+        STORE(g, e, nl_grad_at(u, weights, nbrs, x, e));
+    }
+}
+
+
+__kernel void nl_divergence(
+    __global const ${T} *p,
+    __global const ${T} *weights,
+    __global const int *reverse,
+    __global ${T} *output
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    int NN = Nx*Ny;
+    p += NN*NL_K*b;
+    weights += NN*NL_K*b;
+    reverse += NN*NL_KR*b;
+    output += NN*b;
+
+    int y = nl_index(i, j, Nx);
+    STORE(output, y, nl_div_at(p, weights, reverse, y, NN));
+}
+
+
+// out = img - div(p), for the items b with mask[b] != 0 (mask may be
+// NULL)
+__kernel void nl_tv_primal(
+    __global const ${T} *img,
+    __global const ${T} *p,
+    __global const ${T} *weights,
+    __global const int *reverse,
+    __global ${T} *output,
+    __global const int *mask
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    if (mask && !mask[b]){
+        return;
+    }
+    int NN = Nx*Ny;
+    img += NN*b;
+    p += NN*NL_K*b;
+    weights += NN*NL_K*b;
+    reverse += NN*NL_KR*b;
+    output += NN*b;
+
+    int y = nl_index(i, j, Nx);
+    STORE(output, y, LOAD(img, y) - nl_div_at(p, weights, reverse, y, NN));
+}
+
+
+// Projection step of Chambolle's algorithm for nonlocal total variation:
+// with g = grad(u) and u = img - div(p),
+//     p_out = (p - tau*g) / (1 + tau/weight*|g|),
+// |g| being the norm of the edges of a pixel, and the per-pixel energy
+// (img - u)^2 + weight*|g| if requested.
+__kernel void nl_tv_step(
+    __global const ${T} *img,
+    __global const ${T} *u,
+    __global const ${T} *p,
+    __global const ${T} *weights,
+    __global const int *nbrs,
+    __global ${T} *p_out,
+    __global ${T} *energy,
+    __global const int *active,
+    const ${R} tau,
+    const ${R} weight,
+    const int with_energy
+    ){
+    int i = get_global_id(0);
+    int j = get_global_id(1);
+    int Nx = get_global_size(0);
+    int Ny = get_global_size(1);
+    int b = get_global_id(2);
+    if (active && !active[b]){
+        return;
+    }
+    int NN = Nx*Ny;
+    img += NN*b;
+    u += NN*b;
+    energy += NN*b;
+    p += NN*NL_K*b;
+    p_out += NN*NL_K*b;
+    weights += NN*NL_K*b;
+    nbrs += NN*NL_K*b;
+
+    int x = nl_index(i, j, Nx);
+    ${R} g[NL_K];
+    ${R} norm = 0;
+    for (int n = 0; n < NL_K; ++n){
+        g[n] = nl_grad_at(u, weights, nbrs, x, x + NN*n);
+        norm += g[n]*g[n];
+    }
+    norm = sqrt(norm);
+    if (with_energy){
+        ${R} d = LOAD(img, x) - LOAD(u, x);
+        STORE(energy, x, d*d + weight*norm);
+    }
+    norm = norm*(tau/weight) + 1.f;
+    for (int n = 0; n < NL_K; ++n){
+        int e = x + NN*n;
+        STORE(p_out, e, (LOAD(p, e) - tau*g[n])/norm);
+    }
+}
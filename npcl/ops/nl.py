@@ -1,18 +1,208 @@
+"""
+Nonlocal operators on a sparse patch-similarity graph.
+
+nl_weights connects every pixel to the k pixels of its search window
+whose surrounding patches are the most similar. The graph (NLGraph) is
+stored in a fixed-k layout, k weights and neighbour indices per pixel,
+along with the incoming edges of every pixel, so that the nonlocal
+gradient and divergence are both gathers. A graph can be computed once
+and reused by every iteration of a solver.
+"""
 from os.path import abspath
 import pyopencl as cl
 import npcl
+from npcl.registry import get_program
+from npcl.dtypes import dtype_of, real_dtype
+from npcl.ops.batch import batch_shape, global_size
 import numpy as np
 
 
-prg = None
+kernel_fp = abspath(__file__).replace('.py', '.cl')
+
+
+def build(parameter, k=10, kr=None):
+    if kr is None:
+        kr = 2*k
+    return get_program(
+        parameter, kernel_fp, options=('-DNL_K=%d' % k, '-DNL_KR=%d' % kr),
+        dtype=dtype_of(parameter),
+        )
+
+
+class NLGraph(object):
+    """
+    Nonlocal weight graph of an image (or of every item of a batch).
+
+    Attributes:
+        weights : (..., k, H, W) edge weights.
+        nbrs : (..., k, H, W) int32 flattened indices of the neighbours,
+            -1 for no edge.
+        reverse : (..., kr, H, W) int32 incoming edges (as indices into
+            weights), -1 for no edge.
+        k, kr : number of outgoing edges, maximum number of incoming
+            edges per pixel. Incoming edges beyond kr are dropped.
+        norm2 : bound on the squared norm of nl_grad.
+    """
+
+    def __init__(self, weights, nbrs, reverse, norm2):
+        self.weights = weights
+        self.nbrs = nbrs
+        self.reverse = reverse
+        self.k = weights.shape[-3]
+        self.kr = reverse.shape[-3]
+        self.norm2 = norm2
+
+    def program(self, parameter):
+        return build(parameter, self.k, self.kr)
+
+
+def _tile(device, halo, itemsize):
+    # work-group tile whose halo-extended input fits in local memory
+    n = 16
+    max_size = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+    local_mem = device.get_info(cl.device_info.LOCAL_MEM_SIZE)
+    while n > 1 and (n*n > max_size or (n+2*halo)**2*itemsize > local_mem):
+        n //= 2
+    if (n+2*halo)**2*itemsize > local_mem:
+        raise ValueError('search window too large for local memory')
+    return (n, n)
+
+
+def nl_weights(x, k=10, search=5, patch=1, h=None, kr=None):
+    """
+    Compute the k nearest patch-similarity graph of x.
+
+    The weight of the edge from pixel p to pixel q is
+        w = exp(-d(p, q)/h^2),
+    normalized to sum 1 over the edges of p, where d is the mean squared
+    difference of the patches around p and q.
+
+    Inputs:
+        x : input image, or batch of images (3D).
+        k : (int) number of neighbours of every pixel.
+        search : (int) radius of the search window.
+        patch : (int) radius of the patches.
+        h : (float) filtering parameter. When None, h^2 is the mean
+            distance of the k neighbours of every pixel.
+        kr : (int) maximum number of incoming edges per pixel, 2*k by
+            default.
+
+    Outputs:
+        graph : NLGraph.
+    """
+    if kr is None:
+        kr = 2*k
+    prg = build(x, k, kr)
+    queue = x.queue
+    real = real_dtype(x.dtype)
+    N, Ny, Nx = batch_shape(x)
+    shape = x.shape[:-2]
+    weights = npcl.empty(shape+(k, Ny, Nx), x.dtype, queue=queue)
+    nbrs = npcl.empty(shape+(k, Ny, Nx), np.int32, queue=queue)
+    reverse = npcl.empty(shape+(kr, Ny, Nx), np.int32, queue=queue)
+    halo = search+patch
+    group = _tile(queue.device, halo, real.itemsize)
+    prg.nl_weights_loc(
+        queue,
+        (Nx+(-Nx) % group[0], Ny+(-Ny) % group[1], N), group+(1,),
+        x.data, weights.data, nbrs.data,
+        cl.LocalMemory(real.itemsize*(group[0]+2*halo)*(group[1]+2*halo)),
+        np.int32(Ny), np.int32(Nx), np.int32(search), np.int32(patch),
+        real.type(0 if h is None else 1./h**2),
+        )
+    prg.nl_reverse(
+        queue, global_size(x), None,
+        weights.data, nbrs.data, reverse.data, np.int32(search),
+        )
+    degree = npcl.empty_like(x)
+    prg.nl_degree(
+        queue, global_size(x), None,
+        weights.data, reverse.data, degree.data,
+        )
+    norm2 = 2*float(degree.get().max())
+    return NLGraph(weights, nbrs, reverse, norm2)
+
+
+def nl_grad(u, graph, out=None):
+    """
+    Nonlocal gradient, g_e = sqrt(w_e)*(u_q - u_p) for every edge e from
+    p to q, as a (..., k, H, W) array.
+    """
+    prg = graph.program(u)
+    g = npcl.empty_like(graph.weights) if out is None else out
+    prg.nl_grad(
+        u.queue, global_size(u), None,
+        u.data, graph.weights.data, graph.nbrs.data, g.data,
+        )
+    return g
+
+
+def nl_divergence(p, graph, out=None):
+    """
+    Nonlocal divergence of the (..., k, H, W) edge field p, the negative
+    adjoint of nl_grad.
+    """
+    prg = graph.program(p)
+    shape = p.shape[:-3]+p.shape[-2:]
+    d = npcl.empty(shape, p.dtype, queue=p.queue) if out is None else out
+    prg.nl_divergence(
+        p.queue, global_size(d), None,
+        p.data, graph.weights.data, graph.reverse.data, d.data,
+        )
+    return d
+
+
+def nl_tv_primal(img, p, graph, out=None, mask=None):
+    """
+    Compute img - nl_divergence(p).
+
+    For batches, only the items b with mask[b] != 0 are written when a
+    (N,) int32 mask array is given.
+    """
+    prg = graph.program(img)
+    res = npcl.empty_like(img) if out is None else out
+    prg.nl_tv_primal(
+        img.queue, global_size(img), None,
+        img.data, p.data, graph.weights.data, graph.reverse.data, res.data,
+        None if mask is None else mask.data,
+        )
+    return res
+
+
+def nl_tv_step(
+        img, u, p, graph, tau, weight, out=None, energy=None, active=None,
+        ):
+    """
+    One fused projection step of Chambolle's algorithm for nonlocal total
+    variation,
+        g = nl_grad(u), with u = nl_tv_primal(img, p),
+        p_out = (p - tau*g) / (1 + tau/weight*|g|),
+    where |g| is the norm of the edges of a pixel, and optionally the
+    per-pixel energy (img - u)^2 + weight*|g|.
 
+    Inputs:
+        img : input image.
+        u : primal image nl_tv_primal(img, p).
+        p : dual edge field.
+        graph : NLGraph.
+        tau : (np.float32) step size.
+        weight : (np.float32) regularization weight.
+        out : p_out output array, which must not alias p.
+        energy : array receiving the per-pixel energy, skipped when None.
+        active : (N,) int32 array. For batches, items b with
+            active[b] == 0 are left untouched.
 
-def build(parameter):
-    if type(parameter) == cl.Context:
-        ctx = parameter
-    if type(parameter) == npcl.Array:
-        ctx = parameter.context
-    global prg
-    kernel_fp = abspath(__file__).replace('.py', '.cl')
-    prg = cl.Program(ctx, open(kernel_fp, 'r').read())
-    prg.build()
\ No newline at end of file
+    Outputs:
+        p_out : updated dual field.
+    """
+    prg = graph.program(img)
+    real = real_dtype(img.dtype)
+    p_out = npcl.empty_like(p) if out is None else out
+    prg.nl_tv_step(
+        img.queue, global_size(img), None,
+        img.data, u.data, p.data, graph.weights.data, graph.nbrs.data,
+        p_out.data, (u if energy is None else energy).data,
+        None if active is None else active.data,
+        real.type(tau), real.type(weight), np.int32(energy is not None),
+        )
+    return p_out
@@ -0,0 +1,146 @@
+"""
+Double-buffered streaming of frame sequences through the device.
+
+Frames are uploaded and results downloaded on a transfer queue, through
+pinned (ALLOC_HOST_PTR) staging buffers, while frames are processed on the
+compute queue. Uploading frame i+1 and downloading the result of frame i-1
+overlap the processing of frame i. The queues are synchronized with
+events only, results are returned in the order of the frames.
+"""
+from collections import deque
+import numpy as np
+import pyopencl as cl
+import pyopencl.array as cl_array
+import npcl
+from . import memory
+
+
+class _Staging(object):
+    # a pinned host buffer mapped to a numpy array
+    def __init__(self, queue, shape, dtype):
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        self.buffer = cl.Buffer(
+            queue.context,
+            cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, nbytes)
+        self.array, _ = cl.enqueue_map_buffer(
+            queue, self.buffer,
+            cl.map_flags.READ | cl.map_flags.WRITE, 0, shape, dtype,
+            is_blocking=True,
+            )
+        self.event = None
+
+    def wait(self):
+        # wait for the transfer still reading or writing the buffer
+        if self.event is not None:
+            self.event.wait()
+            self.event = None
+
+    def release(self, queue):
+        self.wait()
+        self.array.base.release(queue)
+
+
+def _split(result):
+    # image and the other outputs of a solver, e.g. (x, k)
+    if isinstance(result, tuple):
+        return result[0], result[1:]
+    return result, None
+
+
+def stream(frames, func, queue=None, dtype=np.float32, depth=2):
+    """
+    Process a sequence of frames, overlapping the host-device transfers
+    with the computation.
+
+    Inputs:
+        frames : iterable of 2D host arrays of the same shape.
+        func : a python function processing one device frame, e.g.
+            lambda x: deconv_fista(x, psf, mu=1e-3). It may return an
+            array, or a tuple whose first item is the array, as the
+            npcl.solvers functions do.
+        queue : compute queue. The transfers run on a second queue of the
+            same context.
+        dtype : dtype of the device frames.
+        depth : (int) number of frames in flight, at least 2.
+
+    Outputs:
+        results : generator of the results of func, in the order of the
+            frames, with the arrays copied to the host.
+    """
+    if depth < 2:
+        raise ValueError('depth must be at least 2')
+    queue = npcl._queue(queue)
+    transfer = cl.CommandQueue(queue.context, queue.device)
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return
+    shape = np.shape(first)
+    dtype = np.dtype(dtype)
+    inputs = [
+        cl_array.empty(
+            queue, shape, dtype, allocator=memory.allocator(queue))
+        for _ in range(depth)
+        ]
+    uploads = [_Staging(transfer, shape, dtype) for _ in range(depth)]
+    downloads = [_Staging(transfer, shape, dtype) for _ in range(depth)]
+    # compute queue events marking the end of the frame processing,
+    # after which its input buffer can be overwritten
+    done = [None]*depth
+
+    def upload(frame, i):
+        if np.shape(frame) != shape:
+            raise ValueError('every frame must have the shape %s' % (shape,))
+        slot = i % depth
+        staging = uploads[slot]
+        staging.wait()
+        np.copyto(staging.array, frame, casting='unsafe')
+        x = inputs[slot]
+        staging.event = cl.enqueue_copy(
+            transfer, x.base_data, staging.array,
+            dst_offset=x.offset, is_blocking=False,
+            wait_for=[done[slot]] if done[slot] is not None else None,
+            )
+        return x, staging.event
+
+    pending = deque()
+    try:
+        nxt = upload(first, 0)
+        i = 0
+        while nxt is not None:
+            x, uploaded = nxt
+            cl.enqueue_barrier(queue, wait_for=[uploaded])
+            frame = next(frames, None)
+            # the upload of the next frame overlaps the processing of x
+            nxt = upload(frame, i+1) if frame is not None else None
+            y, others = _split(func(x))
+            if y.shape != shape or y.dtype != dtype:
+                raise ValueError('func must return a frame of the same shape')
+            slot = i % depth
+            done[slot] = cl.enqueue_marker(queue)
+            staging = downloads[slot]
+            staging.wait()
+            staging.event = cl.enqueue_copy(
+                transfer, staging.array, y.base_data,
+                src_offset=y.offset, is_blocking=False,
+                wait_for=[done[slot]],
+                )
+            # y is kept alive until its download has completed
+            pending.append((staging, y, others))
+            if len(pending) == depth:
+                yield _result(*pending.popleft())
+            i += 1
+        while pending:
+            yield _result(*pending.popleft())
+    finally:
+        for staging in uploads+downloads:
+            staging.release(transfer)
+        transfer.finish()
+
+
+def _result(staging, y, others):
+    staging.wait()
+    res = staging.array.copy()
+    if others is None:
+        return res
+    return (res,)+others
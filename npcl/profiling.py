@@ -0,0 +1,285 @@
+"""
+Kernel-level profiling.
+
+    with npcl.profile() as prof:
+        x, k = deconv_fista(img_blurry, psf)
+    print(prof.report())
+    prof.to_chrome_trace('trace.json')
+
+Within the block, every kernel launch (npcl kernels as well as the
+pyopencl elementwise and reduction kernels behind array arithmetic) and
+every transfer is recorded with its event, the npcl function it was made
+from (the op), and the solver iteration it belongs to. Device times are
+read from the events when the block exits.
+
+Profiling is implemented by wrapping pyopencl.Kernel.__call__ and
+pyopencl.enqueue_copy for the duration of the block only, so it costs
+nothing when disabled.
+"""
+from collections import OrderedDict
+import json
+import sys
+import pyopencl as cl
+import npcl
+
+
+_active = None
+
+
+def iteration(solver, k=None):
+    """
+    Mark the start of iteration k of solver, or the end of the iterations
+    when solver is None. Called by npcl.solvers.
+    """
+    if _active is not None:
+        _active.iteration = None if solver is None else (solver, k)
+
+
+def _op():
+    # innermost public module-level npcl function on the stack
+    frame = sys._getframe(2)
+    while frame is not None:
+        g = frame.f_globals
+        module = g.get('__name__', '')
+        name = frame.f_code.co_name
+        if module.startswith('npcl') and module != __name__ and \
+                not name.startswith('_'):
+            func = g.get(name)
+            if getattr(func, '__code__', None) is frame.f_code:
+                return '%s.%s' % (module.split('.')[-1], name)
+        frame = frame.f_back
+    return None
+
+
+def _nbytes(arg):
+    if isinstance(arg, cl.MemoryObjectHolder):
+        return arg.size
+    return getattr(arg, 'nbytes', 0)
+
+
+def _size(size):
+    return None if size is None else tuple(int(s) for s in size)
+
+
+class Profile(object):
+    """
+    Records of a profile() block.
+
+    Attributes:
+        records : list of dicts, one per kernel launch or transfer, with
+            keys kind ('kernel' or 'transfer'), name, op, iteration,
+            global_size, local_size, bytes, queue, and start, end, time
+            (device timestamps and duration in ns, None when the queue
+            has no profiling enabled).
+    """
+
+    def __init__(self):
+        self.records = []
+        self.iteration = None
+        self._events = []
+
+    def _record(self, event, kind, name, queue, nbytes,
+                global_size=None, local_size=None):
+        self.records.append({
+            'kind': kind,
+            'name': name,
+            'op': _op(),
+            'iteration': self.iteration,
+            'global_size': _size(global_size),
+            'local_size': _size(local_size),
+            'bytes': int(nbytes),
+            'queue': queue.int_ptr,
+            })
+        self._events.append(event)
+
+    def _resolve(self):
+        for record, event in zip(self.records, self._events):
+            try:
+                event.wait()
+                record['start'] = event.profile.start
+                record['end'] = event.profile.end
+                record['time'] = record['end'] - record['start']
+            except (cl.Error, AttributeError):
+                record['start'] = record['end'] = record['time'] = None
+        self._events = []
+
+    def summary(self, by='op'):
+        """
+        Aggregates of the records.
+
+        Inputs:
+            by : 'op', 'name' (kernel name) or 'iteration' (solver
+                iteration, as 'solver:k').
+
+        Outputs:
+            summary : OrderedDict key -> dict of count, time (ns) and
+                bytes, sorted by decreasing time.
+        """
+        res = {}
+        for r in self.records:
+            if by == 'iteration':
+                if r['iteration'] is None:
+                    continue
+                key = '%s:%d' % r['iteration']
+            else:
+                key = r[by]
+            s = res.setdefault(key, {'count': 0, 'time': 0, 'bytes': 0})
+            s['count'] += 1
+            s['time'] += r['time'] or 0
+            s['bytes'] += r['bytes']
+        if by == 'iteration':
+            return OrderedDict(res.items())
+        return OrderedDict(
+            sorted(res.items(), key=lambda item: -item[1]['time']))
+
+    def iterations(self):
+        """
+        Per solver aggregates over its iterations: number of iterations,
+        total and mean device time per iteration (ns).
+        """
+        res = OrderedDict()
+        for key, s in self.summary('iteration').items():
+            solver = key.rsplit(':', 1)[0]
+            a = res.setdefault(solver, {'iterations': 0, 'time': 0})
+            a['iterations'] += 1
+            a['time'] += s['time']
+        for a in res.values():
+            a['mean_time'] = a['time']/a['iterations']
+        return res
+
+    def report(self, by='op'):
+        """
+        Text table of summary(by), followed by the solver iterations.
+        """
+        total = sum(r['time'] or 0 for r in self.records) or 1
+        lines = ['%-40s %8s %12s %7s %12s' % (
+            by, 'count', 'time (ms)', '%', 'MB')]
+        for key, s in self.summary(by).items():
+            lines.append('%-40s %8d %12.3f %7.1f %12.2f' % (
+                key, s['count'], s['time']*1e-6, 100.*s['time']/total,
+                s['bytes']/2.**20,
+                ))
+        for solver, a in self.iterations().items():
+            lines.append('%s: %d iterations, %.3f ms per iteration' % (
+                solver, a['iterations'], a['mean_time']*1e-6))
+        return '\n'.join(lines)
+
+    def to_json(self, path=None):
+        """
+        The records and the aggregates as JSON, written to path if given.
+        """
+        text = json.dumps({
+            'records': self.records,
+            'ops': self.summary('op'),
+            'kernels': self.summary('name'),
+            'iterations': self.iterations(),
+            }, indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def to_chrome_trace(self, path=None):
+        """
+        The records in the Chrome trace event format (chrome://tracing,
+        Perfetto), with one track per queue, written to path if given.
+        """
+        timed = [r for r in self.records if r['start'] is not None]
+        t0 = min([r['start'] for r in timed] or [0])
+        queues = {}
+        events = []
+        for r in timed:
+            events.append({
+                'name': r['name'],
+                'cat': r['kind'],
+                'ph': 'X',
+                'ts': (r['start']-t0)*1e-3,
+                'dur': r['time']*1e-3,
+                'pid': 0,
+                'tid': queues.setdefault(r['queue'], len(queues)),
+                'args': {
+                    'op': r['op'],
+                    'iteration': r['iteration'],
+                    'global_size': r['global_size'],
+                    'local_size': r['local_size'],
+                    'bytes': r['bytes'],
+                    },
+                })
+        text = json.dumps({'traceEvents': events})
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+class profile(object):
+    """
+    Context manager profiling npcl, returning a Profile.
+
+    The default queue is replaced by a queue with profiling enabled on
+    the same context for the duration of the block, so arrays should be
+    created within it (or on a queue created with
+    cl.command_queue_properties.PROFILING_ENABLE). Launches on other
+    queues are recorded without device times.
+    """
+
+    def __init__(self):
+        self.profile = Profile()
+
+    def __enter__(self):
+        global _active
+        if _active is not None:
+            raise RuntimeError('npcl.profile() blocks cannot be nested')
+        queue = npcl._queue(None)
+        self._queue = queue
+        if not queue.properties & \
+                cl.command_queue_properties.PROFILING_ENABLE:
+            npcl.queue = cl.CommandQueue(
+                queue.context, queue.device,
+                properties=cl.command_queue_properties.PROFILING_ENABLE,
+                )
+        prof = self.profile
+        kernel_call = self._kernel_call = cl.Kernel.__call__
+        enqueue_copy = self._enqueue_copy = cl.enqueue_copy
+
+        def profiled_call(kernel, queue, global_size, local_size, *args,
+                          **kwargs):
+            event = kernel_call(
+                kernel, queue, global_size, local_size, *args, **kwargs)
+            prof._record(
+                event, 'kernel', kernel.function_name, queue,
+                sum(_nbytes(arg) for arg in args), global_size, local_size,
+                )
+            return event
+
+        def profiled_copy(queue, dest, src, **kwargs):
+            event = enqueue_copy(queue, dest, src, **kwargs)
+            if 'byte_count' in kwargs:
+                nbytes = kwargs['byte_count']
+            else:
+                nbytes = min(_nbytes(dest) or _nbytes(src),
+                             _nbytes(src) or _nbytes(dest))
+            prof._record(event, 'transfer', _copy_name(dest, src), queue,
+                         nbytes)
+            return event
+
+        cl.Kernel.__call__ = profiled_call
+        cl.enqueue_copy = profiled_copy
+        _active = prof
+        return prof
+
+    def __exit__(self, *exc):
+        global _active
+        cl.Kernel.__call__ = self._kernel_call
+        cl.enqueue_copy = self._enqueue_copy
+        _active = None
+        npcl.queue.finish()
+        npcl.queue = self._queue
+        self.profile._resolve()
+        return False
+
+
+def _copy_name(dest, src):
+    def side(x):
+        return 'device' if isinstance(x, cl.MemoryObjectHolder) else 'host'
+    return '%s_to_%s' % (side(src), side(dest))
@@ -0,0 +1,161 @@
+"""
+Per-context registry of built OpenCL programs and generated kernels.
+
+Programs are built lazily the first time they are requested for a context
+and shared by every module of npcl afterwards, so that arrays living on
+different contexts (or devices) in the same process always launch kernels
+built for their own context.
+"""
+import threading
+import weakref
+import pyopencl as cl
+import pyopencl.array as cl_array
+import numpy as np
+from .cache import build_file
+
+
+_lock = threading.RLock()
+_registry = {}
+_array_caches = {}
+
+
+def context_of(parameter):
+    if isinstance(parameter, cl.Context):
+        return parameter
+    if isinstance(parameter, (cl_array.Array, cl.CommandQueue)):
+        return parameter.context
+    if parameter is None:
+        import npcl
+        if npcl.ctx is None:
+            npcl.create_ctx_queue()
+        return npcl.ctx
+    raise TypeError(
+        'cannot determine an OpenCL context from %s' % type(parameter))
+
+
+def device_of(parameter):
+    if isinstance(parameter, cl_array.Array):
+        return parameter.queue.device
+    if isinstance(parameter, cl.CommandQueue):
+        return parameter.device
+    return context_of(parameter).devices[0]
+
+
+def get(parameter, key, factory):
+    """
+    Return the object registered under key for the context of parameter.
+
+    factory(ctx) is called to create the object the first time it is
+    requested for a given context.
+    """
+    ctx = context_of(parameter)
+    # every entry keeps a reference to its context, which prevents
+    # int_ptr from being reused while the entry is alive.
+    full_key = (ctx.int_ptr, key)
+    with _lock:
+        entry = _registry.get(full_key)
+        if entry is None:
+            entry = (ctx, factory(ctx))
+            _registry[full_key] = entry
+    return entry[1]
+
+
+def find(key, parameter=None):
+    """
+    Return the objects registered under key, for the context of parameter
+    or for every context.
+    """
+    if parameter is not None:
+        ptr = context_of(parameter).int_ptr
+    with _lock:
+        return [
+            entry[1] for full_key, entry in _registry.items()
+            if full_key[1] == key
+            and (parameter is None or full_key[0] == ptr)
+            ]
+
+
+class Kernels(object):
+    """
+    A built program whose kernels are created once per thread and reused.
+
+    Kernels are accessed as attributes, like on pyopencl.Program. Setting
+    the arguments of a kernel and enqueueing it is not atomic, so that
+    every thread launches its own kernel objects.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.context = program.context
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        local = self.__dict__.get('_local')
+        if local is None:
+            raise AttributeError(name)
+        kernels = getattr(local, 'kernels', None)
+        if kernels is None:
+            kernels = local.kernels = {
+                knl.function_name: knl
+                for knl in self.program.all_kernels()
+                }
+        try:
+            return kernels[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def get_program(parameter, kernel_fp, options=None, dtype=np.float32):
+    """
+    Return the Kernels of kernel_fp, rendered for dtype, on the context of
+    parameter.
+    """
+    options = tuple(options) if options is not None else ()
+    dtype = np.dtype(dtype)
+    return get(
+        parameter, ('program', kernel_fp, options, dtype.name),
+        lambda ctx: Kernels(
+            build_file(ctx, kernel_fp, list(options), dtype)),
+        )
+
+
+def release(parameter=None):
+    """
+    Drop the registered programs of a context (or of every context).
+    """
+    with _lock:
+        if parameter is None:
+            _registry.clear()
+            return
+        ptr = context_of(parameter).int_ptr
+        for key in [key for key in _registry if key[0] == ptr]:
+            del _registry[key]
+
+
+def array_cache(array):
+    """
+    Return a dict of derived data that lives as long as array does.
+
+    Used to keep host/device data derived from a (constant) kernel array,
+    such as its spectrum, between calls. Call forget(array) after
+    modifying the array in place.
+    """
+    key = id(array)
+    with _lock:
+        entry = _array_caches.get(key)
+        if entry is None or entry[0]() is not array:
+            entry = (weakref.ref(array, lambda ref: _drop(key, ref)), {})
+            _array_caches[key] = entry
+    return entry[1]
+
+
+def _drop(key, ref):
+    with _lock:
+        entry = _array_caches.get(key)
+        if entry is not None and entry[0] is ref:
+            del _array_caches[key]
+
+
+def forget(array):
+    with _lock:
+        _array_caches.pop(id(array), None)
@@ -1,46 +1,93 @@
 import npcl
 import numpy as np
-from npcl.ops.local import grad2d, norm2d, divergence2d
+from npcl.ops.local import tv_step, tv_primal, grad2d, norm2d
+from npcl.ops import batch
 
 
-def denoise_tv(image, weight=0.1, eps=2.e-4, n_iter_max=100):
-    img_dev = image.copy()
+def denoise_tv(
+        image, weight=0.1, eps=2.e-4, n_iter_max=100, check_every=4,
+        ):
+    """
+    Total Variation denoising with Chambolle's projection algorithm.
+
+    Every iteration is a single fused kernel. The energy is only
+    evaluated, and the stopping criterion tested, every check_every
+    iterations.
+
+    Inputs:
+        image : input image, or batch of images (3D). Every item of a
+            batch stops iterating as soon as it has converged.
+        weight : (float) regularization weight.
+        eps : (float) relative tolerance on the energy decrease per
+            iteration.
+        n_iter_max : (int) maximum number of iterations.
+        check_every : (int) number of iterations between energy checks.
+
+    Outputs:
+        out : denoised image.
+    """
+    if n_iter_max < 1:
+        return image.copy()
     ndim = 2
     weight = np.float32(weight)
     eps = np.float32(eps)
+    tau = np.float32(1/(2.*ndim))
+    n_items, height, width = batch.batch_shape(image)
+    N = np.float32(height*width)
     px = npcl.zeros_like(image)
     py = npcl.zeros_like(image)
-    d = npcl.zeros_like(image)
-    tau = np.float32(1/(2.*ndim))
-    N = np.float32(img_dev.shape[0]*img_dev.shape[1])
+    qx = npcl.empty_like(image)
+    qy = npcl.empty_like(image)
+    energy = npcl.empty_like(image)
+    res = npcl.empty_like(image)
+    # running : items still iterating, pending : items not written to res
+    running = np.ones(n_items, bool)
+    pending = running.copy()
+    active = None
     i = 0
     while i < n_iter_max:
-        if i > 0:
-            # d will be the (negative) divergence of p
-            d = divergence2d(px, py)
-            d = -d
-            out = img_dev + d
-        else:
-            out = img_dev
-        E = npcl.sum((d ** 2)).get()
-        # (gx, gy) stores the gradients of out along each axis
-        gx, gy = grad2d(out)
-        norm = norm2d(gx, gy)
-        E += weight*npcl.sum(norm).get()
-        norm *= tau/weight
-        norm += np.float32(1)
-        px = px-tau*gx
-        py = py-tau*gy
-        px /= norm
-        py /= norm
-        E /= N
-        if i == 0:
-            E_init = E
-            E_previous = E
-        else:
-            if np.abs(E_previous-E) < eps * E_init:
-                break
+        check = i % check_every == 0
+        tv_step(
+            image, px, py, tau, weight, out=(qx, qy),
+            energy=energy if check else None, active=active,
+            )
+        # (qx, qy) now holds the dual field the energy was evaluated at
+        px, py, qx, qy = qx, qy, px, py
+        if check:
+            E = batch.sum(energy).get()/N
+            if i == 0:
+                E_init = E
+                E_previous = E
             else:
+                converged = running & (
+                    np.abs(E_previous-E) < eps*E_init*check_every)
                 E_previous = E
+                running &= ~converged
+                if not running.any():
+                    break
+                if converged.any():
+                    tv_primal(
+                        image, qx, qy, out=res,
+                        mask=npcl.to_device(converged, np.int32, queue=image.queue),
+                        )
+                    pending &= ~converged
+                    active = npcl.to_device(
+                        running, np.int32, queue=image.queue)
         i += 1
-    return out
+    tv_primal(
+        image, qx, qy, out=res,
+        mask=None if pending.all() else npcl.to_device(
+            pending, np.int32, queue=image.queue),
+        )
+    return res
+
+
+def total_variation(image):
+    """
+    Isotropic total variation, the regularizer of denoise_tv.
+
+    Outputs:
+        tv : (N,) numpy array, the total variation of every item of a
+            batch (N = 1 for an image).
+    """
+    return batch.sum(norm2d(*grad2d(image))).get()
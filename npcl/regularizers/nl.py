@@ -1,19 +1,100 @@
-from os.path import abspath
-import pyopencl as cl
-import pyopencl.array as cl_array
+import npcl
 import numpy as np
+from npcl.ops.nl import nl_weights, nl_tv_primal, nl_tv_step
+from npcl.ops import batch
 
 
-prg = None
+def denoise_nltv(
+        image, weight=0.1, graph=None, eps=2.e-4, n_iter_max=100,
+        check_every=4, **kwargs
+        ):
+    """
+    Nonlocal Total Variation denoising with Chambolle's projection
+    algorithm, on the weight graph of npcl.ops.nl.
 
+    Same calling convention as denoise_tv, so that
+        ProxR = lambda x, mu: denoise_nltv(x, mu, graph=graph)
+    plugs into solve_fbs and solve_fista (see nltv_denoiser).
 
-def build():
-    from npcl import ctx, queue
-    global ctx, queue
-    if ctx is None:
-        ctx = cl.create_some_context(interactive=False)
-        queue = cl.CommandQueue(ctx)
-    global prg
-    kernel_fp = abspath(__file__).replace('.py', '.cl')
-    prg = cl.Program(ctx, open(kernel_fp, 'r').read())
-    prg.build()
\ No newline at end of file
+    Inputs:
+        image : input image, or batch of images (3D). Every item of a
+            batch stops iterating as soon as it has converged.
+        weight : (float) regularization weight.
+        graph : NLGraph of image, computed from image with
+            nl_weights(image, **kwargs) when None.
+        eps : (float) relative tolerance on the energy decrease per
+            iteration.
+        n_iter_max : (int) maximum number of iterations.
+        check_every : (int) number of iterations between energy checks.
+
+    Outputs:
+        out : denoised image.
+    """
+    if n_iter_max < 1:
+        return image.copy()
+    if graph is None:
+        graph = nl_weights(image, **kwargs)
+    weight = np.float32(weight)
+    eps = np.float32(eps)
+    tau = np.float32(1./graph.norm2)
+    n_items, height, width = batch.batch_shape(image)
+    N = np.float32(height*width)
+    p = npcl.zeros_like(graph.weights)
+    q = npcl.empty_like(graph.weights)
+    u = image.copy()
+    energy = npcl.empty_like(image)
+    res = npcl.empty_like(image)
+    # running : items still iterating, pending : items not written to res
+    running = np.ones(n_items, bool)
+    pending = running.copy()
+    active = None
+    i = 0
+    while i < n_iter_max:
+        check = i % check_every == 0
+        nl_tv_step(
+            image, u, p, graph, tau, weight, out=q,
+            energy=energy if check else None, active=active,
+            )
+        # q now holds the dual field, p the one the energy was evaluated at
+        p, q = q, p
+        if check:
+            E = batch.sum(energy).get()/N
+            if i == 0:
+                E_init = E
+                E_previous = E
+            else:
+                converged = running & (
+                    np.abs(E_previous-E) < eps*E_init*check_every)
+                E_previous = E
+                running &= ~converged
+                if not running.any():
+                    break
+                if converged.any():
+                    nl_tv_primal(
+                        image, q, graph, out=res,
+                        mask=npcl.to_device(
+                            converged, np.int32, queue=image.queue),
+                        )
+                    pending &= ~converged
+                    active = npcl.to_device(
+                        running, np.int32, queue=image.queue)
+        nl_tv_primal(image, p, graph, out=u, mask=active)
+        i += 1
+    nl_tv_primal(
+        image, q, graph, out=res,
+        mask=None if pending.all() else npcl.to_device(
+            pending, np.int32, queue=image.queue),
+        )
+    return res
+
+
+def nltv_denoiser(graph, **kwargs):
+    """
+    A python function computing Prox_{mu NLTV}(x) on a fixed graph, e.g.
+    the graph of a pilot estimate, for solve_fbs and solve_fista:
+        ProxR = nltv_denoiser(nl_weights(x_pilot))
+        x, k = deconv_fista(img_blurry, psf, denoiser=ProxR)
+    """
+    def denoiser(image, weight):
+        return denoise_nltv(image, weight, graph=graph, **kwargs)
+    return denoiser
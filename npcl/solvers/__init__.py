@@ -3,3 +3,5 @@ from . import fbs
 from . import deconv
 from . import flb
 from . import fista
+from . import lipschitz
+from . import pdhg
@@ -1,9 +1,17 @@
 import npcl
+from npcl import profiling
+from npcl.registry import get
+from npcl.dtypes import real_dtype, ctypes, check_solver
+from npcl.ops import batch
+from mako.template import Template
+from pyopencl.elementwise import ElementwiseKernel
+from pyopencl.reduction import ReductionKernel
 import numpy as np
 
 
 def solve_cg(
         A, b, x_0, tol=np.float32(1e-3), max_iter=None, verbose=False,
+        sync_every=None,
         ):
     """
     Conjugate Gradient Method.
@@ -17,13 +25,30 @@ def solve_cg(
             for a vector (pyopencl.array.Array) x.
         b : (pyopencl.array.Array) represents the vector b.
         x_0 : (pyopencl.array.Array) represents the initial point x_0.
+            A 3D x_0 is a batch of independent systems, which are solved
+            together. Every item stops as soon as it has converged.
         tol : (np.float32) represents tolerence value.
         max_iter : (int) maximum number of iteration.
+        sync_every : (int) if given, keep alpha, beta and the residuals on
+            the device and only read the convergence state back every
+            sync_every iterations. See solve_cg_device. Not supported for
+            batches.
 
     Outputs:
         x : (pyopencl.array.Array) the solution x.
-        k : (int) the total iteration number.
+        k : (int) the total iteration number, an (N,) array of iteration
+            numbers for a batch.
     """
+    check_solver(b.dtype)
+    if x_0.ndim == 3:
+        if sync_every is not None:
+            raise ValueError('sync_every is not supported for batches')
+        return _solve_cg_batch(A, b, x_0, tol, max_iter, verbose)
+    if sync_every is not None:
+        return solve_cg_device(
+            A, b, x_0, tol=tol, max_iter=max_iter, verbose=verbose,
+            sync_every=sync_every,
+            )
     r = b - A(x_0)
     p = r.copy()
     x = x_0.copy()
@@ -33,8 +58,9 @@ def solve_cg(
     bnorm = npcl.sum(b**2).get()
     rsold = npcl.sum(r**2).get()
     for k in range(dim):
+        profiling.iteration('solve_cg', k+1)
         Ap = A(p)
-        alpha = np.float32(rsold/npcl.sum(p*Ap).get())
+        alpha = x.dtype.type(rsold/npcl.sum(p*Ap).get())
         x += alpha*p
         r += -alpha*Ap
         rsnew = npcl.sum(r**2).get()
@@ -48,7 +74,196 @@ def solve_cg(
         if max_iter is not None:
             if k+1 == max_iter:
                 break
-        beta = np.float32(rsnew/rsold)
+        beta = x.dtype.type(rsnew/rsold)
         p = r + beta*p
         rsold = rsnew
+    profiling.iteration(None)
     return x, k
+
+
+def _solve_cg_batch(A, b, x_0, tol, max_iter, verbose):
+    queue = x_0.queue
+    real = real_dtype(x_0.dtype)
+    r = b - A(x_0)
+    p = r.copy()
+    x = x_0.copy()
+    n_items, height, width = batch.batch_shape(x)
+    bnorm = batch.norms(b).get()
+    rsold = batch.norms(r).get()
+    # items starting at the solution (e.g. b = 0) are done before the
+    # first update, which would compute alpha = 0/0
+    done = rsold <= bnorm*tol**2
+    iters = np.zeros(n_items, int)
+    for k in range(height*width):
+        if done.all():
+            break
+        profiling.iteration('solve_cg', k+1)
+        Ap = A(p)
+        pAp = batch.dot(p, Ap).get()
+        # converged items get alpha = 0, which leaves x and r unchanged
+        alpha = np.zeros(n_items, real)
+        np.divide(rsold, pAp, out=alpha, where=~done, casting='unsafe')
+        x = batch.axpy(x, npcl.to_device(alpha, real, queue), p, out=x)
+        r = batch.axpy(r, npcl.to_device(-alpha, real, queue), Ap, out=r)
+        rsnew = batch.norms(r).get()
+        if verbose is True:
+            print(
+                'iteration number: ', k+1,
+                ', residual: ', np.sqrt(rsnew/bnorm),
+                )
+        iters[~done] = k
+        done |= rsnew <= bnorm*tol**2
+        if done.all():
+            break
+        if max_iter is not None:
+            if k+1 == max_iter:
+                break
+        beta = np.zeros(n_items, real)
+        np.divide(rsnew, rsold, out=beta, where=~done, casting='unsafe')
+        p = batch.axpy(r, npcl.to_device(beta, real, queue), p, out=p)
+        rsold = np.where(done, rsold, rsnew)
+    profiling.iteration(None)
+    return x, iters
+
+
+# Device state of solve_cg_device.
+# state : rsold, pAp, rsnew, bnorm*tol^2, beta
+# flags : done, number of iterations, max_iter
+_cg_preamble = """
+#pragma OPENCL FP_CONTRACT OFF
+
+${R} cg_update_xr(
+    int i, __global ${R} *x, __global ${R} *r,
+    __global const ${R} *p, __global const ${R} *Ap,
+    __global const ${R} *state, __global const int *flags
+    ){
+    if (!flags[0]){
+        ${R} alpha = state[0]/state[1];
+        x[i] = x[i] + alpha*p[i];
+        r[i] = r[i] + (-alpha)*Ap[i];
+    }
+    return r[i]*r[i];
+}
+"""
+
+_cg_options = ['-cl-fp32-correctly-rounded-divide-sqrt']
+
+
+def _cg_kernels(ctx, dtype):
+    R = ctypes(dtype)[1]
+
+    def render(source):
+        return Template(source).render(R=R)
+    dot = ReductionKernel(
+        ctx, dtype, neutral='0', reduce_expr='a+b',
+        map_expr='a[i]*b[i]',
+        arguments=render(
+            '__global const ${R} *a, __global const ${R} *b'),
+        )
+    update_xr = ReductionKernel(
+        ctx, dtype, neutral='0', reduce_expr='a+b',
+        map_expr='cg_update_xr(i, x, r, p, Ap, state, flags)',
+        arguments=render(
+            '__global ${R} *x, __global ${R} *r, '
+            '__global const ${R} *p, __global const ${R} *Ap, '
+            '__global const ${R} *state, __global const int *flags'),
+        preamble=render(_cg_preamble), options=_cg_options,
+        )
+    # a single work-item updates the scalars between the two vector updates
+    step = ElementwiseKernel(
+        ctx,
+        render('__global ${R} *state, __global int *flags'),
+        """
+        if (!flags[0]){
+            flags[1] += 1;
+            if (state[2] < state[3] || flags[1] == flags[2]){
+                flags[0] = 1;
+            }
+            else{
+                state[4] = state[2]/state[0];
+                state[0] = state[2];
+            }
+        }
+        """,
+        name='cg_step', preamble='#pragma OPENCL FP_CONTRACT OFF',
+        options=_cg_options,
+        )
+    update_p = ElementwiseKernel(
+        ctx,
+        render(
+            '__global ${R} *p, __global const ${R} *r, '
+            '__global const ${R} *state, __global const int *flags'),
+        'if (!flags[0]) p[i] = r[i] + state[4]*p[i]',
+        name='cg_update_p', preamble='#pragma OPENCL FP_CONTRACT OFF',
+        )
+    return dot, update_xr, step, update_p
+
+
+def solve_cg_device(
+        A, b, x_0, tol=np.float32(1e-3), max_iter=None, verbose=False,
+        sync_every=10,
+        ):
+    """
+    Conjugate Gradient Method, without per-iteration host synchronisation.
+
+    Follows the same recurrence as solve_cg, up to rounding in the
+    reductions, which are summed in a different order. alpha, beta and the
+    residual norms stay on the device, and the updates of x, r and p are
+    fused with the dot products. The convergence state is read back every
+    sync_every iterations only; iterations enqueued after convergence do
+    not modify x.
+
+    Inputs:
+        A : a python function that computes Ax, i.e.,
+            A(x) = Ax,
+            for a vector (pyopencl.array.Array) x.
+        b : (pyopencl.array.Array) represents the vector b.
+        x_0 : (pyopencl.array.Array) represents the initial point x_0.
+        tol : (np.float32) represents tolerence value.
+        max_iter : (int) maximum number of iteration.
+        sync_every : (int) number of iterations between two read backs.
+
+    Outputs:
+        x : (pyopencl.array.Array) the solution x.
+        k : (int) the total iteration number.
+    """
+    dtype = check_solver(b.dtype)
+    dot, update_xr, step, update_p = get(
+        b, ('cg.kernels', dtype.name), lambda ctx: _cg_kernels(ctx, dtype))
+    queue = b.queue
+    tol = dtype.type(tol)
+    dim = 1
+    for d in x_0.shape:
+        dim *= d
+    if max_iter is None or max_iter > dim:
+        max_iter = dim
+    r = b - A(x_0)
+    p = r.copy()
+    x = x_0.copy()
+    s = npcl.zeros((5,), dtype, queue=queue)
+    n = npcl.to_device(
+        np.array([0, 0, max_iter], np.int32), np.int32, queue=queue)
+    dot(b, b, out=s[3])
+    dot(r, r, out=s[0])
+    bnorm = s[3].get()
+    s[3] = bnorm*tol**2
+    k = 0
+    while True:
+        profiling.iteration('solve_cg', k+1)
+        Ap = A(p)
+        dot(p, Ap, out=s[1])
+        update_xr(x, r, p, Ap, s, n, out=s[2])
+        step(s, n, range=slice(1))
+        update_p(p, r, s, n)
+        k += 1
+        if k % sync_every == 0 or k == max_iter:
+            done, iters, _ = n.get()
+            if verbose is True:
+                print(
+                    'iteration number: ', iters,
+                    ', residual: ', np.sqrt(s[2].get()/bnorm),
+                    )
+            if done:
+                break
+    profiling.iteration(None)
+    return x, iters-1
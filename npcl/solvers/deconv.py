@@ -1,29 +1,47 @@
 import numpy as np
-from npcl.ops.convolve import convolve2d, transpose2d
-from npcl.ops.convolve import convolve2d_sv, transpose2d_sv
-from npcl.regularizers.local import denoise_tv
-from .fbs import solve_fbs
+import pyopencl as cl
+import npcl
+from npcl.ops.convolve import convolve2d, normal2d, transpose2d
+from npcl.ops.convolve import convolve2d_sv, correlate2d_sv
+from npcl.ops.lowrank import LowRankPSF, convolve2d_lowrank
+from npcl.ops.lowrank import correlate2d_lowrank
+from npcl.ops import batch
+from npcl.regularizers.local import denoise_tv, total_variation
+from .fbs import solve_fbs, STEP as FBS_STEP
 from .fista import solve_fista
+from .lipschitz import lipschitz, cached_lipschitz
+
+
+def _step(delta, scale, ATA, x_0, psf, kernel, key):
+    # delta, or scale/L with L estimated (and cached with psf)
+    if delta is not None:
+        return np.float32(delta)
+    if kernel is None:
+        L = cached_lipschitz(psf, key, ATA, x_0)
+    else:
+        L = lipschitz(ATA, x_0)
+    return np.float32(scale/L)
 
 
 def deconv_fbs(
         img_blurry, psf, kernel=None, denoiser=denoise_tv,
-        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=np.float32(1.5),
-        max_iter=50, verbose=False,
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
+        max_iter=50, verbose=False, padding='zero',
         ):
     """
     Deconvolution with Forward-Backward Splitting Method.
+
+    With wrap padding, the normal operator is precomputed as a single
+    convolution when cheaper, see npcl.ops.convolve.normal2d. When delta
+    is None, the step size is npcl.solvers.fbs.STEP/L, with L estimated
+    by power iteration (once per psf, see npcl.solvers.lipschitz).
     """
     x_0 = img_blurry.copy()
-    if kernel is None:
-        kernel = transpose2d(psf)
     mu = np.float32(mu)
-    delta = np.float32(delta)
     tol = np.float32(tol)
-    ATb = convolve2d(x_0, psf)
-
-    def ATA(x):
-        return convolve2d(convolve2d(x, kernel), psf)
+    ATb = convolve2d(x_0, psf, padding)
+    ATA = normal2d(psf, kernel, padding, x_0.shape)
+    delta = _step(delta, FBS_STEP, ATA, x_0, psf, kernel, padding)
     ProxR = denoiser
 
     x, k = solve_fbs(
@@ -35,22 +53,22 @@ def deconv_fbs(
 
 def deconv_fista(
         img_blurry, psf, kernel=None, denoiser=denoise_tv,
-        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=np.float32(1.5),
-        max_iter=50, verbose=False,
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
+        max_iter=50, verbose=False, padding='zero',
         ):
     """
     Deconvolution with FISTA method.
+
+    With wrap padding, the normal operator is precomputed as a single
+    convolution when cheaper, see npcl.ops.convolve.normal2d. When delta
+    is None, the step size is 1/L, see deconv_fbs.
     """
     x_0 = img_blurry.copy()
-    if kernel is None:
-        kernel = transpose2d(psf)
     mu = np.float32(mu)
-    delta = np.float32(delta)
     tol = np.float32(tol)
-    ATb = convolve2d(x_0, psf)
-
-    def ATA(x):
-        return convolve2d(convolve2d(x, kernel), psf)
+    ATb = convolve2d(x_0, psf, padding)
+    ATA = normal2d(psf, kernel, padding, x_0.shape)
+    delta = _step(delta, 1., ATA, x_0, psf, kernel, padding)
     ProxR = denoiser
 
     x, k = solve_fista(
@@ -62,19 +80,40 @@ def deconv_fista(
 
 def deconv_sv_fbs(
         img_blurry, psf, kernel=None, denoiser=denoise_tv,
-        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=np.float32(1.5),
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
         max_iter=50, verbose=False,
         ):
+    """
+    Spatially-variant deconvolution with Forward-Backward Splitting
+    Method.
+
+    psf is either a dense 4D kernel (see convolve2d_sv) or a LowRankPSF.
+    The adjoint is applied matrix-free with correlate2d_sv, unless a
+    transposed kernel is given (dense psf only). When delta is None, the
+    step size is set as in deconv_fbs.
+    """
     x_0 = img_blurry.copy()
-    if kernel is None:
-        kernel = transpose2d_sv(psf)
     mu = np.float32(mu)
-    delta = np.float32(delta)
     tol = np.float32(tol)
-    ATb = convolve2d_sv(x_0, psf)
+    tmp = npcl.empty_like(x_0)
+    if isinstance(psf, LowRankPSF):
+        ATb = convolve2d_lowrank(x_0, psf)
+
+        def ATA(x):
+            return convolve2d_lowrank(
+                correlate2d_lowrank(x, psf, out=tmp), psf)
+    else:
+        ATb = convolve2d_sv(x_0, psf)
 
-    def ATA(x):
-        return convolve2d_sv(convolve2d_sv(x, kernel), psf)
+        def ATA(x):
+            if kernel is None:
+                y = correlate2d_sv(x, psf, out=tmp)
+            else:
+                y = convolve2d_sv(x, kernel, out=tmp)
+            return convolve2d_sv(y, psf)
+    if isinstance(psf, LowRankPSF):
+        kernel = None
+    delta = _step(delta, FBS_STEP, ATA, x_0, psf, kernel, 'zero')
     ProxR = denoiser
 
     x, k = solve_fbs(
@@ -82,3 +121,109 @@ def deconv_sv_fbs(
         delta=delta, mu=mu, tol=tol, verbose=verbose, max_iter=max_iter,
         )
     return x, k
+
+
+def _stack(x, n):
+    # batch of n copies of the image x
+    res = npcl.empty((n,)+x.shape, x.dtype, queue=x.queue)
+    for i in range(n):
+        cl.enqueue_copy(
+            x.queue, res.base_data, x.base_data, byte_count=x.nbytes,
+            src_offset=x.offset, dst_offset=res.offset+i*x.nbytes,
+            )
+    return res
+
+
+def _unstack(x):
+    # the items of the batch x, as contiguous arrays of their own
+    res = []
+    for i in range(x.shape[0]):
+        y = npcl.empty(x.shape[1:], x.dtype, queue=x.queue)
+        cl.enqueue_copy(
+            x.queue, y.base_data, x.base_data, byte_count=y.nbytes,
+            src_offset=x.offset+i*y.nbytes, dst_offset=y.offset,
+            )
+        res.append(y)
+    return res
+
+
+def deconv_path(
+        img_blurry, psf, mus, kernel=None, denoiser=denoise_tv,
+        regularizer=total_variation, solver=solve_fista,
+        tol=np.float32(1e-4), delta=None, max_iter=50, batch_size=1,
+        verbose=False, padding='zero',
+        ):
+    """
+    Deconvolution for a sequence of regularization parameters (a
+    regularization path), e.g. to pick mu.
+
+    The mu values are swept in decreasing order. Every solve starts from
+    the solution for the previous mu, and A^Tb, the normal operator and
+    the step size are computed once.
+
+    Inputs:
+        img_blurry, psf, kernel, denoiser, tol, delta, max_iter, padding :
+            see deconv_fista.
+        mus : list of regularization parameters.
+        regularizer : a python function computing the regularizer R(x)
+            of every item of a batch, for the objective values.
+        solver : solve_fista or solve_fbs.
+        batch_size : (int) number of mu values solved at once, as a batch.
+            Assumes that the denoiser is positively homogeneous, i.e.
+            denoiser(x, t*mu) = mu*denoiser(x/mu, t), as for total
+            variation or l1 regularization.
+
+    Outputs:
+        mus : (numpy.ndarray) the mu values, in decreasing order.
+        xs : list of the solutions, for every mu.
+        iters : (numpy.ndarray) the iteration numbers, for every mu.
+        objectives : (numpy.ndarray) the values of
+            1/2*|Ax-b|^2 + mu*R(x), for every mu.
+    """
+    mus = np.sort(np.asarray(mus, np.float64))[::-1]
+    tol = np.float32(tol)
+    b = img_blurry
+    ATb = convolve2d(b, psf, padding)
+    ATA = normal2d(psf, kernel, padding, b.shape)
+    A_kernel = transpose2d(psf) if kernel is None else kernel
+    delta = _step(
+        delta, FBS_STEP if solver is solve_fbs else 1., ATA, b, psf, kernel,
+        padding,
+        )
+    xs = []
+    iters = []
+    objectives = []
+    x = b
+    for start in range(0, len(mus), batch_size):
+        group = mus[start:start+batch_size]
+        if batch_size == 1:
+            mu = np.float32(group[0])
+            x_0, ATb_group, ProxR = x, ATb, denoiser
+        else:
+            n = len(group)
+            mu = np.float32(1.)
+            x_0 = _stack(x, n)
+            ATb_group = _stack(ATb, n)
+            M = npcl.to_device(
+                np.broadcast_to(group[:, None, None], x_0.shape), b.dtype,
+                queue=b.queue,
+                )
+
+            def ProxR(v, t, M=M):
+                return M*denoiser(v/M, t)
+        y, k = solver(
+            ATA, ATb_group, x_0, ProxR,
+            delta=delta, mu=mu, tol=tol, verbose=verbose,
+            max_iter=max_iter,
+            )
+        residual = convolve2d(y, A_kernel, padding)-(
+            b if y.ndim == 2 else _stack(b, len(group)))
+        objectives.extend(
+            0.5*batch.norms(residual).get()+group*regularizer(y))
+        iters.extend(np.atleast_1d(k))
+        if y.ndim == 2:
+            xs.append(y)
+        else:
+            xs.extend(_unstack(y))
+        x = xs[-1]
+    return mus, xs, np.array(iters), np.array(objectives)
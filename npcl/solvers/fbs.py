@@ -1,11 +1,21 @@
 import npcl
+from npcl import profiling
+from npcl.ops import batch
+from npcl.dtypes import check_solver
+from .lipschitz import lipschitz
 import numpy as np
 
 
+# automatic step size in units of 1/L. FBS converges for steps below 2/L,
+# but the power iteration underestimates L when it stops early, so that
+# the step keeps a margin of a factor 2, as for FISTA.
+STEP = 1.
+
+
 def solve_fbs(
         ATA, ATb, x_0, ProxR_solver,
         delta=np.float32(0.9), mu=np.float32(1e-3), tol=np.float32(1e-3),
-        verbose=False, max_iter=50,
+        verbose=False, max_iter=50, dot=None,
         ):
     """
     Forward-Backward Splitting (FBS) Method.
@@ -22,20 +32,35 @@ def solve_fbs(
             for a vector (pyopencl.array.Array) x.
         ATb : (pyopencl.array.Array) represents the vector A^tb.
         x_0 : (pyopencl.array.Array) represents the initial point x_0.
+            A 3D x_0 is a batch of independent problems, which are solved
+            together. Every item stops as soon as it has converged.
         ProxR_solver : a python function that computes Prox_{mu R}(x), i.e.,
             ProxR_solver(x, mu) = Prox_{mu R}(x)
             for a vector (pyopencl.array.Array) x and a scalar mu > 0.
-        delta : (np.float32) parameter for gradient update step.
+        delta : (np.float32) parameter for gradient update step. When
+            None, STEP/L with L estimated by lipschitz(ATA, x_0).
         mu : (np.float32) regularization parameter.
         tol : (np.float32) represents tolerence value.
         max_iter : maximum number of iterations.
+        dot : a python function computing the dot product of two vectors
+            on the host, dot(x, y) = x^Ty. Needed for vectors which are not
+            pyopencl arrays, see npcl.multidevice.
 
     Outputs:
         x : (pyopencl.array.Array) the solution x.
-        k : (int) the total iteration number.
+        k : (int) the total iteration number, an (N,) array of iteration
+            numbers for a batch.
     """
+    check_solver(ATb.dtype)
+    if delta is None:
+        delta = np.float32(STEP/lipschitz(ATA, x_0, dot=dot))
+    if x_0.ndim == 3:
+        return _solve_fbs_batch(
+            ATA, ATb, x_0, ProxR_solver, delta, mu, tol, verbose, max_iter)
 
     def norms(x):
+        if dot is not None:
+            return dot(x, x)
         return npcl.sum(x**2).get()
 
     x = x_0.copy()
@@ -43,6 +68,7 @@ def solve_fbs(
     bnorm = norms(ATb)
     while True:
         k += 1
+        profiling.iteration('solve_fbs', k)
         v = x - delta*(ATA(x)-ATb)
         x_new = ProxR_solver(v, delta*mu)
         seq_diff = norms(x-x_new)
@@ -59,4 +85,44 @@ def solve_fbs(
         if k == max_iter:
             break
         x = x_new.copy()
+    profiling.iteration(None)
     return x_new, k
+
+
+def _solve_fbs_batch(
+        ATA, ATb, x_0, ProxR_solver, delta, mu, tol, verbose, max_iter):
+    x = x_0.copy()
+    k = 0
+    bnorm = batch.norms(ATb).get()
+    done = np.zeros(len(bnorm), bool)
+    iters = np.zeros(len(bnorm), int)
+    mask = None
+    while True:
+        k += 1
+        profiling.iteration('solve_fbs', k)
+        v = x - delta*(ATA(x)-ATb)
+        x_new = ProxR_solver(v, delta*mu)
+        if mask is not None:
+            # converged items keep their solution
+            x_new = batch.select(mask, x, x_new)
+        seq_diff = batch.norms(x-x_new).get()
+        if not np.all(np.isfinite(seq_diff)):
+            print('something wrong with the problem setting...')
+            break
+        if verbose is True:
+            print(
+                'iteration number: ', k, ', sequential difference: ',
+                np.sqrt(seq_diff/bnorm),
+                )
+        iters[~done] = k
+        converged = ~done & (seq_diff < bnorm*tol**2)
+        if converged.any():
+            done |= converged
+            mask = npcl.to_device(done, np.int32, queue=x.queue)
+        if done.all():
+            break
+        if k == max_iter:
+            break
+        x = x_new.copy()
+    profiling.iteration(None)
+    return x_new, iters
@@ -1,4 +1,8 @@
 import npcl
+from npcl import profiling
+from npcl.dtypes import real_dtype, check_solver
+from npcl.ops import batch
+from .lipschitz import lipschitz
 import numpy as np
 
 
@@ -6,7 +10,7 @@ def solve_fista(
         ATA, ATb, x_0, ProxR_solver,
         delta=np.float32(1.0), mu=np.float32(1e-3), tol=np.float32(1e-3),
         p=1, q=1, r=4, restarting=False,
-        verbose=False, max_iter=50,
+        verbose=False, max_iter=50, dot=None,
         ):
     """
     Fast Iterative Shrinkage Thresholding Algorithm (FISTA) Method.
@@ -23,23 +27,39 @@ def solve_fista(
             for a vector (pyopencl.array.Array) x.
         ATb : (pyopencl.array.Array) represents the vector A^tb.
         x_0 : (pyopencl.array.Array) represents the initial point x_0.
+            A 3D x_0 is a batch of independent problems, which are solved
+            together. Every item has its own momentum and restarts, and
+            stops as soon as it has converged.
         ProxR_solver : a python function that computes Prox_{mu R}(x), i.e.,
             ProxR_solver(x, mu) = Prox_{mu R}(x)
             for a vector (pyopencl.array.Array) x and a scalar mu > 0.
         delta : (np.float32) inverse of Lipschitz constant of A^TA.
+            Estimated by lipschitz(ATA, x_0) when None.
         mu : (np.float32) regularization parameter.
         tol : (np.float32) represents tolerence value.
         p, q, r : (np.float32) momentum parameter. 0<p<=1, 0<q<=1, 0<r<=4.
         max_iter : maximum number of iterations.
+        dot : a python function computing the dot product of two vectors
+            on the host, dot(x, y) = x^Ty. Needed for vectors which are not
+            pyopencl arrays, see npcl.multidevice.
 
     Outputs:
         y : (pyopencl.array.Array) the solution x.
-        k : (int) the total iteration number.
+        k : (int) the total iteration number, an (N,) array of iteration
+            numbers for a batch.
 
     Reference:
         A Fast Iterative Shrinkage-Thresholding Algorithm for Linear Inverse Problems
         Read More: https://epubs.siam.org/doi/abs/10.1137/080716542
     """
+    check_solver(ATb.dtype)
+    if delta is None:
+        delta = np.float32(1./lipschitz(ATA, x_0, dot=dot))
+    if x_0.ndim == 3:
+        return _solve_fista_batch(
+            ATA, ATb, x_0, ProxR_solver, delta, mu, tol, p, q, r,
+            restarting, verbose, max_iter,
+            )
 
     xold = x_0.copy()
     y = xold.copy()
@@ -50,10 +70,14 @@ def solve_fista(
         return ProxR_solver(x-delta*(ATA(x)-ATb), mu*delta)
 
     def norms(x):
+        if dot is not None:
+            return dot(x, x)
         return npcl.sum(x**2).get()
 
     if restarting:
         def restart(y, x, xold):
+            if dot is not None:
+                return dot(y-x, x-xold) >= 0
             return npcl.sum((y-x)*(x-xold)).get() >= 0
         restarted = False
 
@@ -61,6 +85,7 @@ def solve_fista(
 
     while True:
         k += 1
+        profiling.iteration('solve_fista', k)
         x = p_L(y)
         t = (p+np.sqrt(q+r*told**2))/2
         beta = np.float32(min((told-1)/t, 1))
@@ -92,9 +117,81 @@ def solve_fista(
             break
         xold = x.copy()
         told = t
+    profiling.iteration(None)
     return x, k
 
 
+def _solve_fista_batch(
+        ATA, ATb, x_0, ProxR_solver, delta, mu, tol, p, q, r,
+        restarting, verbose, max_iter,
+        ):
+    queue = x_0.queue
+    real = real_dtype(x_0.dtype)
+    xold = x_0.copy()
+    y = xold.copy()
+    k = 0
+
+    def p_L(x):
+        return ProxR_solver(x-delta*(ATA(x)-ATb), mu*delta)
+
+    bnorm = batch.norms(ATb).get()
+    n_items = len(bnorm)
+    told = np.ones(n_items, np.float32)
+    r = np.full(n_items, r, np.float32)
+    xi = np.ones(n_items, np.float32)
+    restarted = np.zeros(n_items, bool)
+    done = np.zeros(n_items, bool)
+    iters = np.zeros(n_items, int)
+    mask = None
+
+    while True:
+        k += 1
+        profiling.iteration('solve_fista', k)
+        x = p_L(y)
+        if mask is not None:
+            # converged items keep their solution
+            x = batch.select(mask, xold, x)
+        t = (p+np.sqrt(q+r*told**2))/2
+        beta = np.minimum((told-1)/t, 1).astype(np.float32)
+        dx = x-xold
+        if restarting:
+            restart = ~done & (batch.dot(y-x, dx).get() >= 0)
+            if restart.any():
+                print(
+                    'restarting occured at iteration ', k,
+                    'for items ', np.flatnonzero(restart),
+                )
+                first = restart & ~restarted
+                xi[first] = ((4+beta[first])/5.)**(1/30.)
+                restarted |= first
+                r[restart] *= xi[restart]
+                t[restart] = 1
+                beta[restart] = 0
+        y = batch.axpy(x, npcl.to_device(beta, real, queue), dx)
+        seq_diff = batch.norms(dx).get()
+        if not np.all(np.isfinite(seq_diff)):
+            print('something wrong with the problem setting...')
+            break
+        if verbose is True:
+            print(
+                'iteration number: ', k, ', sequential difference: ',
+                np.sqrt(seq_diff/bnorm),
+                )
+        iters[~done] = k
+        converged = ~done & (seq_diff < bnorm*tol**2)
+        if converged.any():
+            done |= converged
+            mask = npcl.to_device(done, np.int32, queue=queue)
+        if done.all():
+            break
+        if k == max_iter:
+            break
+        xold = x.copy()
+        told = t
+    profiling.iteration(None)
+    return x, iters
+
+
 def solve_gfista(
         ATA, ATb, x_0, ProxR_solver,
         L_inv=np.float32(1.0), delta=np.float32(1.),
@@ -121,6 +218,7 @@ def solve_gfista(
             ProxR_solver(x, mu) = Prox_{mu R}(x)
             for a vector (pyopencl.array.Array) x and a scalar mu > 0.
         L_inv : (np.float32) inverse of Lipschitz constant of A^TA.
+            Estimated by lipschitz(ATA, x_0) when None.
         delta : (np.float32) starting step size.
         mu : (np.float32) regularization parameter.
         tol : (np.float32) represents tolerence value.
@@ -138,7 +236,9 @@ def solve_gfista(
         - Improving "Fast Iterative Shrinkage-Thresholding Algorithm": Faster, Smarter and Greedier
         Read More: https://arxiv.org/abs/1811.01430
     """
-
+    check_solver(ATb.dtype)
+    if L_inv is None:
+        L_inv = np.float32(1./lipschitz(ATA, x_0))
     x = x_0.copy()
     y = x.copy()
     delta0 = np.float32(delta*L_inv)
@@ -157,6 +257,7 @@ def solve_gfista(
 
     while True:
         k += 1
+        profiling.iteration('solve_gfista', k)
         xold = x
         yold = y
 
@@ -188,4 +289,5 @@ def solve_gfista(
             break
         if k == max_iter:
             break
+    profiling.iteration(None)
     return x, k
@@ -1,5 +1,7 @@
 import npcl
+from npcl import profiling
 from npcl.ops.local import sign, soft_shrink
+from npcl.dtypes import check_solver
 import numpy as np
 
 
@@ -32,6 +34,7 @@ def solve_flb(
         x : (pyopencl.array.Array) the solution x.
         k : (int) the total iteration number.
     """
+    check_solver(b.dtype)
     ATb = AT(b)
 
     def ATA(x):
@@ -47,6 +50,7 @@ def solve_flb(
     k = 0
     while True:
         k += 1
+        profiling.iteration('solve_flb', k)
         v += (ATb-ATA(x))
         x_new = delta*soft_shrink(v, mu)
         residual = np.log(norm(A(x_new)-b))
@@ -75,4 +79,5 @@ def solve_flb(
         if k >= max_iter:
             break
         x = x_new.copy()
+    profiling.iteration(None)
     return x_new, k
@@ -2,17 +2,21 @@ import numpy as np
 import npcl
 from npcl.ops.convolve import convolve2d as convolve
 from npcl import to_device
+from npcl.registry import get
 from .cg import solve_cg
 
 
-dx = np.array([[0, -1, 1]], dtype=np.float32)
-dy = dx.T
-dxT = dx[..., ::-1]
-dyT = dxT.T
-dx = to_device(dx)
-dy = to_device(dy)
-dxT = to_device(dxT)
-dyT = to_device(dyT)
+def derivative_filters(x):
+    """
+    Forward difference filters (dx, dy, dxT, dyT) on the context of x.
+    """
+    def factory(ctx):
+        dx = np.array([[0, -1, 1]], dtype=np.float32)
+        dy = dx.T
+        dxT = dx[..., ::-1]
+        dyT = dxT.T
+        return tuple(to_device(d, queue=x.queue) for d in (dx, dy, dxT, dyT))
+    return get(x, 'inpaint.derivative_filters', factory)
 
 
 def inpaint_h1(
@@ -24,6 +28,7 @@ def inpaint_h1(
     Harmonic Inpainting with conjugate gradient method.
     """
     mu = np.float32(mu)
+    dx, dy, dxT, dyT = derivative_filters(img)
 
     def masked_laplacian(x, mask):
         px = convolve(x, dx)
@@ -53,7 +58,8 @@ def inpaint_tv(img, mask,
     """
     Total Variation Inpainting with Split Bregman method.
     """
-    
+    dx, dy, dxT, dyT = derivative_filters(img)
+
     def masked_laplacian(x):
         px = convolve(x, dx)
         py = convolve(x, dy)
@@ -0,0 +1,62 @@
+import npcl
+from npcl.dtypes import real_dtype, check_solver
+from npcl.registry import array_cache
+import numpy as np
+
+
+def lipschitz(ATA, x_0, tol=1e-3, max_iter=100, dot=None):
+    """
+    Estimate the Lipschitz constant of the gradient of 1/2*|Ax-b|^2, the
+    largest eigenvalue |A^TA|, by power iteration on the device.
+
+    Inputs:
+        ATA : a python function that computes A^TAx, see solve_fista.
+        x_0 : (pyopencl.array.Array) a vector of the problem size. The
+            iteration starts from a random vector of its shape, or from x_0
+            itself when dot is given.
+        tol : (float) relative tolerance on the change of the estimate.
+        max_iter : maximum number of iterations.
+        dot : see solve_fista.
+
+    Outputs:
+        L : (float) the estimate, slightly enlarged by tol, since the power
+            iteration approaches |A^TA| from below.
+    """
+    check_solver(x_0.dtype)
+    def norm(x):
+        if dot is not None:
+            return np.sqrt(dot(x, x))
+        return np.sqrt(npcl.sum(x**2).get())
+
+    if dot is None:
+        rng = np.random.RandomState(0)
+        x = npcl.to_device(
+            rng.rand(*x_0.shape), x_0.dtype, queue=x_0.queue)
+    else:
+        x = x_0.copy()
+    scalar = real_dtype(x_0.dtype).type
+    x = x*scalar(1./norm(x))
+    L = 0.
+    for _ in range(max_iter):
+        y = ATA(x)
+        L_new = float(norm(y))
+        if not np.isfinite(L_new) or L_new == 0:
+            return L_new
+        x = y*scalar(1./L_new)
+        if abs(L_new-L) <= tol*L_new:
+            break
+        L = L_new
+    return L_new*(1+tol)
+
+
+def cached_lipschitz(psf, key, ATA, x_0, tol=1e-3, max_iter=100):
+    """
+    lipschitz(ATA, x_0), cached for as long as psf is alive under key
+    (e.g. the padding mode), along with the image size.
+    Call npcl.registry.forget(psf) after modifying psf in place.
+    """
+    cache = array_cache(psf)
+    key = ('lipschitz', key, tuple(x_0.shape[-2:]), np.dtype(x_0.dtype).name)
+    if key not in cache:
+        cache[key] = lipschitz(ATA, x_0, tol, max_iter)
+    return cache[key]
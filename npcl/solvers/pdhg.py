@@ -0,0 +1,156 @@
+import npcl
+from npcl import profiling
+from npcl.dtypes import check_solver
+from npcl.ops.convolve import convolve2d, normal2d, transpose2d
+from npcl.ops.local import pdhg_dual_tv, pdhg_dual_data, pdhg_primal
+from .lipschitz import cached_lipschitz, lipschitz
+import numpy as np
+
+
+def solve_pdhg(
+        A, AT, b, x_0, mu=np.float32(1e-3), tau=None, sigma=None,
+        sigma_tv=None, theta=np.float32(1.), tol=np.float32(1e-3),
+        verbose=False, max_iter=50,
+        ):
+    """
+    First-order primal-dual (Chambolle-Pock) Method for total variation
+    regularized least squares.
+
+    This function solves the following problem:
+        f(x) = 1/2*|Ax-b|^2 + mu*TV(x),
+    as the saddle point problem of K = [A; grad], without inner loop. The
+    dual steps and the primal step are each a single fused kernel (see
+    npcl.ops.local.pdhg_primal), besides the applications of A and A^T.
+
+    Inputs:
+        A : a python function that computes Ax.
+        AT : a python function that computes A^Ty.
+        b : (pyopencl.array.Array) the observation.
+        x_0 : (pyopencl.array.Array) represents the initial point x_0.
+        mu : (np.float32) regularization parameter.
+        tau : primal step size, a scalar or an array of per-pixel steps of
+            the shape of x_0.
+        sigma : dual step size of the data term, a scalar or an array of
+            the shape of b.
+        sigma_tv : (np.float32) dual step size of the total variation term.
+            Convergence requires tau*sigma*|K|^2 <= 1 for scalar steps.
+            When tau, sigma and sigma_tv are all None, they are set to
+            1/|K|, with |K|^2 <= |A^TA| + 8 estimated by lipschitz.
+        theta : (np.float32) extrapolation parameter.
+        tol : (np.float32) represents tolerence value.
+        max_iter : maximum number of iterations.
+
+    Outputs:
+        x : (pyopencl.array.Array) the solution x.
+        k : (int) the total iteration number.
+
+    Reference:
+        A first-order primal-dual algorithm for convex problems with
+        applications to imaging
+        Read More: https://doi.org/10.1007/s10851-010-0251-1
+    """
+    check_solver(b.dtype)
+    steps = (tau, sigma, sigma_tv)
+    if all(step is None for step in steps):
+        norm = np.sqrt(lipschitz(lambda x: AT(A(x)), x_0)+8.)
+        tau = sigma = sigma_tv = np.float32(1./norm)
+    elif any(step is None for step in steps):
+        raise ValueError('tau, sigma and sigma_tv must be given together')
+    x = x_0.copy()
+    xbar = x.copy()
+    y = npcl.zeros_like(b)
+    px = npcl.zeros_like(x)
+    py = npcl.zeros_like(x)
+    diff = npcl.empty_like(x)
+    bnorm = npcl.sum(AT(b)**2).get()
+    k = 0
+    while True:
+        k += 1
+        profiling.iteration('solve_pdhg', k)
+        pdhg_dual_data(y, A(xbar), b, sigma)
+        pdhg_dual_tv(xbar, px, py, sigma_tv, mu)
+        x, xbar = pdhg_primal(x, AT(y), px, py, tau, theta, xbar, diff)
+        seq_diff = npcl.sum(diff).get()
+        if np.isnan(seq_diff) or np.isinf(seq_diff):
+            print('something wrong with the problem setting...')
+            break
+        if verbose is True:
+            print(
+                'iteration number: ', k, ', sequential difference: ',
+                np.sqrt(seq_diff/bnorm),
+                )
+        if seq_diff < bnorm*tol**2:
+            break
+        if k == max_iter:
+            break
+    profiling.iteration(None)
+    return x, k
+
+
+def _grad_degree(shape):
+    # number of nonzero entries of grad in every column (pixel)
+    Ny, Nx = shape[-2:]
+    cx = np.full(Nx, 2.)
+    cx[0] = 1
+    cx[-1] = 1
+    cy = np.full(Ny, 2.)
+    cy[0] = 1
+    cy[-1] = 1
+    return np.broadcast_to(cy[:, None]+cx[None, :], shape)
+
+
+def deconv_pdhg(
+        img_blurry, psf, kernel=None,
+        mu=np.float32(1e-3), tol=np.float32(1e-4), delta=None,
+        max_iter=50, verbose=False, padding='zero', precondition=False,
+        ):
+    """
+    Total variation deconvolution with the primal-dual Method, with the
+    calling convention of deconv_fista.
+
+    delta scales the step sizes, tau = delta/|K| and sigma = 1/(delta*|K|),
+    with |K|^2 <= |A^TA| + 8 estimated by power iteration (1 when None).
+    With precondition, the diagonal preconditioning of Pock and Chambolle
+    (alpha = 1) sets per-pixel steps from the absolute row and column sums
+    of K instead, and delta is not used.
+
+    Reference:
+        Diagonal preconditioning for first order primal-dual algorithms in
+        convex optimization
+        Read More: https://doi.org/10.1109/ICCV.2011.6126441
+    """
+    b = img_blurry
+    A_kernel = transpose2d(psf) if kernel is None else kernel
+    mu = np.float32(mu)
+    tol = np.float32(tol)
+
+    def A(x):
+        return convolve2d(x, A_kernel, padding)
+
+    def AT(y):
+        return convolve2d(y, psf, padding)
+    if precondition:
+        ones = npcl.to_device(np.ones(b.shape), b.dtype, queue=b.queue)
+        # |A| 1 and |A|^T 1
+        rows = convolve2d(ones, abs(A_kernel), padding).get()
+        cols = convolve2d(ones, abs(psf), padding).get()
+        tau = npcl.to_device(
+            1/(cols+_grad_degree(b.shape)), b.dtype, queue=b.queue)
+        sigma = npcl.to_device(
+            1/np.maximum(rows, np.finfo(b.dtype).tiny), b.dtype,
+            queue=b.queue)
+        sigma_tv = np.float32(0.5)
+    else:
+        ATA = normal2d(psf, kernel, padding, b.shape)
+        if kernel is None:
+            L = cached_lipschitz(psf, padding, ATA, b)
+        else:
+            L = lipschitz(ATA, b)
+        norm = np.sqrt(L+8.)
+        delta = np.float32(1. if delta is None else delta)
+        tau = np.float32(delta/norm)
+        sigma = sigma_tv = np.float32(1./(delta*norm))
+    return solve_pdhg(
+        A, AT, b, b, mu=mu, tau=tau, sigma=sigma, sigma_tv=sigma_tv,
+        tol=tol, verbose=verbose, max_iter=max_iter,
+        )
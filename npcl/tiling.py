@@ -0,0 +1,263 @@
+"""
+Tiled (out-of-core) processing of images larger than device memory.
+
+The image is read tile by tile from any array-like source supporting 2D
+slicing (numpy.memmap, h5py or zarr datasets, ...). Every tile is extended
+by a halo of context pixels, processed on the device, cropped and written
+to the output, which can be a numpy.memmap as well. Only one tile lives on
+the device at a time.
+
+Neighbouring tiles may also overlap, in which case their results are
+blended with linear ramps. This hides the seams of operators without a
+finite support, such as deconvolution solvers.
+"""
+import numpy as np
+import npcl
+from . import memory
+from .ops.convolve import convolve2d
+from .ops.fft import PADDING_MODES
+from .solvers.deconv import deconv_fista
+
+
+def tile_size(budget, halo=0, overlap=0, buffers=8, dtype=np.float32):
+    """
+    Largest tile size whose working set fits in budget bytes.
+
+    Inputs:
+        budget : (int) device memory budget in bytes.
+        halo : (int) halo width.
+        overlap : (int) overlap between neighbouring tiles.
+        buffers : (int) number of tile-sized arrays alive at once on the
+            device while processing a tile.
+        dtype : dtype of the tiles.
+
+    Outputs:
+        size : (int) side of the (square) tile core, a multiple of 16.
+    """
+    side = int(np.sqrt(budget/(buffers*np.dtype(dtype).itemsize)))
+    size = (side - 2*(halo+overlap//2)) // 16 * 16
+    if size < 16:
+        raise ValueError('device memory budget too small for this halo')
+    return size
+
+
+def _splits(n, size, min_size):
+    bounds = list(range(0, n, size)) + [n]
+    if len(bounds) > 2 and bounds[-1]-bounds[-2] < min_size:
+        # a too small last tile is merged into the previous one
+        del bounds[-2]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def tiles(shape, tile_shape, min_size=1):
+    """
+    Core regions (y0, y1, x0, x1) of the tiles, in raster order. They
+    partition the image. Tiles are at least min_size pixels wide, which
+    can make the last row and column of tiles larger than tile_shape.
+    """
+    H, W = shape
+    for y0, y1 in _splits(H, tile_shape[0], min_size):
+        for x0, x1 in _splits(W, tile_shape[1], min_size):
+            yield y0, y1, x0, x1
+
+
+def _wrapped(src, start, stop, size, axis):
+    # slices of src covering indices start..stop-1 modulo size
+    parts = []
+    i = start
+    while i < stop:
+        j = min(stop, (i//size+1)*size)
+        sl = slice(i % size, (j-1) % size + 1)
+        parts.append(
+            np.asarray(src[sl] if axis == 0 else src[:, sl]))
+        i = j
+    return np.concatenate(parts, axis=axis)
+
+
+def read_tile(src, y0, y1, x0, x1, padding='zero'):
+    """
+    Read src[y0:y1, x0:x1], where the region may exceed the image bounds,
+    extended according to the padding mode.
+    """
+    H, W = src.shape
+    if padding == 'wrap':
+        rows = _wrapped(src, y0, y1, H, 0) if y0 < 0 or y1 > H \
+            else src[y0:y1]
+        return _wrapped(rows, x0, x1, W, 1) if x0 < 0 or x1 > W \
+            else np.asarray(rows[:, x0:x1])
+    if padding not in PADDING_MODES:
+        raise ValueError('unknown padding mode: %s' % padding)
+    cy0, cy1 = max(y0, 0), min(y1, H)
+    cx0, cx1 = max(x0, 0), min(x1, W)
+    tile = np.asarray(src[cy0:cy1, cx0:cx1])
+    pad = ((cy0-y0, y1-cy1), (cx0-x0, x1-cx1))
+    if any(p for p in pad[0]+pad[1]):
+        mode = 'constant' if padding == 'zero' else 'edge'
+        tile = np.pad(tile, pad, mode)
+    return tile
+
+
+def _ramp(start, stop, before, after, m):
+    # blending weights along one axis of the window [start, stop), which
+    # ramp over 2*m pixels on the sides that have a neighbouring tile
+    w = np.ones(stop-start)
+    t = (np.arange(2*m)+0.5)/(2*m)
+    if before:
+        w[:2*m] = t
+    if after:
+        w[-2*m:] = 1-t
+    return w
+
+
+def process_tiles(
+        func, src, out=None, halo=0, overlap=0, tile_shape=None,
+        budget=None, buffers=8, padding='zero', dtype=np.float32,
+        queue=None,
+        ):
+    """
+    Apply an image operator tile by tile.
+
+    Inputs:
+        func : a python function computing the operator on a device
+            array, func(x) = y, where y has the shape of x.
+        src : 2D array-like source image.
+        out : 2D array-like output (e.g. numpy.memmap). Allocated in host
+            memory when omitted.
+        halo : (int) context pixels read around every tile and discarded
+            after processing. Convolutions are exact when halo is at least
+            the kernel radius.
+        overlap : (int) width of the zone where the results of
+            neighbouring tiles are blended.
+        tile_shape : (tuple) shape of the tile cores. Derived from budget
+            when omitted.
+        budget : (int) device memory budget in bytes. Held blocks of the
+            memory pool are released whenever it is exceeded.
+        buffers : (int) number of tile-sized arrays func keeps alive, used
+            to derive the tile size from budget.
+        padding : 'zero', 'same' or 'wrap', how the image is extended
+            beyond its bounds. With None, tiles are not extended beyond the
+            image bounds, and func handles the image boundaries.
+        dtype : dtype of the device tiles.
+
+    Outputs:
+        out : output array.
+    """
+    H, W = src.shape
+    m = overlap//2
+    if tile_shape is None:
+        if budget is None:
+            raise ValueError('either tile_shape or budget is needed')
+        size = tile_size(budget, halo, overlap, buffers, dtype)
+        tile_shape = (size, size)
+    if min(tile_shape) < 2*m:
+        raise ValueError('tiles must be at least as large as the overlap')
+    if out is None:
+        out = np.empty((H, W), dtype)
+    queue = npcl._queue(queue)
+    for y0, y1, x0, x1 in tiles((H, W), tile_shape, 2*m):
+        # window : core extended by the blending margins
+        wy0, wy1 = max(y0-m, 0), min(y1+m, H)
+        wx0, wx1 = max(x0-m, 0), min(x1+m, W)
+        if padding is None:
+            # the halo stops at the image bounds, where func applies its
+            # own boundary conditions
+            ry0, ry1 = max(wy0-halo, 0), min(wy1+halo, H)
+            rx0, rx1 = max(wx0-halo, 0), min(wx1+halo, W)
+            tile = np.asarray(src[ry0:ry1, rx0:rx1])
+        else:
+            ry0, ry1 = wy0-halo, wy1+halo
+            rx0, rx1 = wx0-halo, wx1+halo
+            tile = read_tile(src, ry0, ry1, rx0, rx1, padding)
+        x = npcl.to_device(tile, dtype, queue)
+        res = func(x).get()[wy0-ry0:wy1-ry0, wx0-rx0:wx1-rx0]
+        del x
+        if m > 0:
+            wy = _ramp(wy0, wy1, y0 > 0, y1 < H, m)
+            wx = _ramp(wx0, wx1, x0 > 0, x1 < W, m)
+            res = res*np.outer(wy, wx)
+            # the top and left margins were partly written by the
+            # previous tiles, which are accumulated
+            prev = np.zeros_like(res)
+            top = 2*m if y0 > 0 else 0
+            left = 2*m if x0 > 0 else 0
+            prev[:top] = out[wy0:wy0+top, wx0:wx1]
+            prev[top:, :left] = out[wy0+top:wy1, wx0:wx0+left]
+            res = res + prev
+        out[wy0:wy1, wx0:wx1] = res
+        if budget is not None and \
+                memory.stats(queue).get('managed_bytes', 0) > budget:
+            memory.free_held(queue)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def convolve2d_tiled(
+        src, k, padding='zero', out=None, tile_shape=None, budget=None,
+        dtype=np.float32, **kwargs
+        ):
+    """
+    Out-of-core npcl.ops.convolve.convolve2d, exact up to rounding.
+
+    Inputs:
+        src : 2D array-like source image.
+        k : convolutional kernel array (on the device).
+        padding : 'zero', 'same' or 'wrap'.
+        out : 2D array-like output. Allocated when omitted.
+        tile_shape, budget, dtype : see process_tiles.
+        kwargs : passed to convolve2d (method, rank).
+
+    Outputs:
+        out : output array.
+    """
+    # the fft path pads tiles to powers of two and holds three complex
+    # spectra at once
+    buffers = 4 if kwargs.get('method') in ('direct', 'separable') else 28
+    return process_tiles(
+        lambda x: convolve2d(x, k, padding, **kwargs), src, out,
+        halo=max(k.shape)//2, tile_shape=tile_shape, budget=budget,
+        buffers=buffers, padding=padding, dtype=dtype, queue=k.queue,
+        )
+
+
+def deconv_tiled(
+        src, psf, solver=deconv_fista, out=None, halo=None, overlap=None,
+        tile_shape=None, budget=None, padding=None, dtype=np.float32,
+        **kwargs
+        ):
+    """
+    Out-of-core deconvolution, with one full solve per tile.
+
+    Tiles are solved independently on their halo-extended region, and
+    blended over overlap pixels. Iterative solvers propagate information
+    by about the size of the psf per iteration, so the halo must grow
+    with the number of iterations for the result to match a full-image
+    solve. The regularizer should also run a fixed number of iterations,
+    as a stopping criterion evaluated on each tile differs from one
+    evaluated on the whole image.
+
+    Inputs:
+        src : 2D array-like blurry image.
+        psf : point spread function array (on the device).
+        solver : npcl.solvers.deconv function, called as
+            solver(img_blurry, psf, **kwargs).
+        out : 2D array-like output. Allocated when omitted.
+        halo : (int) context pixels around every tile. Defaults to eight
+            times the size of psf.
+        overlap : (int) blending width. Defaults to the size of psf.
+        tile_shape, budget, dtype : see process_tiles.
+        padding : how the image is extended beyond its bounds, see
+            process_tiles. By default the solver sees the image bounds.
+        kwargs : passed to solver (mu, tol, max_iter, ...).
+
+    Outputs:
+        out : output array.
+    """
+    size = max(psf.shape)
+    halo = 8*size if halo is None else halo
+    overlap = size if overlap is None else overlap
+    return process_tiles(
+        lambda x: solver(x, psf, **kwargs)[0], src, out,
+        halo=halo, overlap=overlap, tile_shape=tile_shape, budget=budget,
+        buffers=16, padding=padding, dtype=dtype, queue=psf.queue,
+        )
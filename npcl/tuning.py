@@ -0,0 +1,194 @@
+"""
+Auto-tuning of the direct and spatially-variant convolution kernels.
+
+tune_convolve2d benchmarks the global memory kernel and the local memory
+kernel with candidate work-group tile shapes (non-square ones included)
+for a device, an image size and a kernel size, and saves the winner to a
+per-device tuning database. npcl.ops.convolve.convolve2d consults the
+database at dispatch time, and falls back to its heuristic for untuned
+problems.
+
+Entries are keyed by the image size rounded up to powers of two, the
+kernel shape, the padding mode and the dtype. The database is a json file
+in the cache directory (see npcl.cache), one per device and driver.
+"""
+import json
+import os
+from time import perf_counter
+import numpy as np
+import pyopencl as cl
+from .cache import cache_dir, cache_enabled, cache_key
+from .ops.fft import next_pow2
+
+
+enabled = True
+
+_databases = {}
+
+
+def _path(device):
+    return os.path.join(
+        cache_dir(), 'tuning-%s.json' % cache_key('tuning', device)[:32])
+
+
+def database(device):
+    """
+    Tuning database of device, a dict key -> entry.
+    """
+    db = _databases.get(device.int_ptr)
+    if db is None:
+        db = {}
+        if cache_enabled():
+            try:
+                with open(_path(device)) as f:
+                    db = json.load(f)
+            except (OSError, ValueError):
+                pass
+        _databases[device.int_ptr] = db
+    return db
+
+
+def save(device):
+    if not cache_enabled():
+        return
+    path = _path(device)
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(database(device), f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def clear(device):
+    """
+    Forget the tuned entries of device.
+    """
+    database(device).clear()
+    save(device)
+
+
+def key(op, shape, kernel_shape, padding, dtype):
+    Ny, Nx = shape[-2:]
+    return '%s/%dx%d/%dx%d/%s/%s' % (
+        op, next_pow2(Ny), next_pow2(Nx), kernel_shape[0], kernel_shape[1],
+        padding, np.dtype(dtype).name,
+        )
+
+
+def lookup(device, op, shape, kernel_shape, padding, dtype):
+    """
+    Tuned entry of a problem, None when untuned (or tuning is disabled).
+    """
+    if not enabled:
+        return None
+    return database(device).get(
+        key(op, shape, kernel_shape, padding, dtype))
+
+
+def store(device, op, shape, kernel_shape, padding, dtype, entry):
+    database(device)[key(op, shape, kernel_shape, padding, dtype)] = entry
+    save(device)
+
+
+def candidate_tiles(device, kernel_shape, itemsize=4):
+    """
+    Work-group tile shapes (rows, columns) that fit the device limits and
+    whose halo-extended tile fits in local memory.
+    """
+    max_size = device.get_info(cl.device_info.MAX_WORK_GROUP_SIZE)
+    max_items = device.get_info(cl.device_info.MAX_WORK_ITEM_SIZES)
+    local_mem = device.get_info(cl.device_info.LOCAL_MEM_SIZE)
+    tiles = []
+    for ty in (1, 2, 4, 8, 16, 32, 64):
+        for tx in (8, 16, 32, 64, 128, 256):
+            if ty*tx > max_size or tx > max_items[0] or ty > max_items[1]:
+                continue
+            cache = (ty+kernel_shape[0]-1)*(tx+kernel_shape[1]-1)*itemsize
+            if cache > local_mem:
+                continue
+            tiles.append((ty, tx))
+    return tiles
+
+
+def _time(func, queue, repeat):
+    func()
+    queue.finish()
+    times = []
+    for _ in range(repeat):
+        t = perf_counter()
+        func()
+        queue.finish()
+        times.append(perf_counter()-t)
+    return float(np.median(times))
+
+
+def _tune(op, run, x, kernel_shape, padding, tiles, repeat, save):
+    from .dtypes import real_dtype
+    queue = x.queue
+    device = queue.device
+    if tiles is None:
+        tiles = candidate_tiles(
+            device, kernel_shape, real_dtype(x.dtype).itemsize)
+    variants = [{'path': 'global'}] + [
+        {'path': 'local', 'tile': list(tile)} for tile in tiles]
+    timings = []
+    for entry in variants:
+        try:
+            timings.append(
+                (entry, _time(lambda: run(entry), queue, repeat)))
+        except cl.Error:
+            # e.g. out of resources for this work-group size
+            continue
+    best, t = min(timings, key=lambda item: item[1])
+    best = dict(best, time=t)
+    if save:
+        store(device, op, x.shape, kernel_shape, padding, x.dtype, best)
+    return best, timings
+
+
+def tune_convolve2d(x, k, padding='zero', tiles=None, repeat=5, save=True):
+    """
+    Benchmark the direct convolution variants on x and k.
+
+    Inputs:
+        x : input array, an image or a batch of images, with the size and
+            dtype to tune for.
+        k : convolutional kernel array.
+        padding : 'zero', 'same' or 'wrap'.
+        tiles : list of (rows, columns) tile shapes to try. By default
+            candidate_tiles.
+        repeat : (int) number of timed runs of each variant.
+        save : (bool) store the winner in the tuning database.
+
+    Outputs:
+        best : (dict) the winning entry, {'path': 'global'} or
+            {'path': 'local', 'tile': [rows, columns]}, with its 'time'.
+        timings : list of (entry, time in seconds) of every variant.
+    """
+    import npcl
+    from .ops.convolve import convolve2d_direct
+    out = npcl.empty_like(x)
+    return _tune(
+        'convolve2d',
+        lambda entry: convolve2d_direct(x, k, padding, entry, out=out),
+        x, k.shape, padding, tiles, repeat, save,
+        )
+
+
+def tune_convolve2d_sv(
+        x, k, padding='zero', tiles=None, repeat=5, save=True):
+    """
+    Benchmark the spatially-variant convolution variants on x and k, see
+    tune_convolve2d.
+    """
+    import npcl
+    from .ops.convolve import convolve2d_sv
+    out = npcl.empty_like(x)
+    return _tune(
+        'convolve2d_sv',
+        lambda entry: convolve2d_sv(x, k, padding, out=out, variant=entry),
+        x, k.shape[:2], padding, tiles, repeat, save,
+        )
@@ -0,0 +1,18 @@
+import numpy as np
+import npcl
+from npcl.ops.convolve import convolve2d
+from npcl.solvers.cg import solve_cg
+
+
+def test_batch_with_zero_item():
+    psf = npcl.to_device(np.array([[0, .1, 0], [.1, 1, .1], [0, .1, 0]]))
+    b = np.random.RandomState(0).rand(3, 16, 16)
+    b[1] = 0
+    x, iters = solve_cg(
+        lambda x: convolve2d(x, psf), npcl.to_device(b),
+        npcl.zeros((3, 16, 16), np.float32), tol=np.float32(1e-5),
+        )
+    x = x.get()
+    assert np.all(np.isfinite(x))
+    assert iters[1] == 0
+    np.testing.assert_array_equal(x[1], 0)
@@ -0,0 +1,19 @@
+import numpy as np
+import npcl
+from npcl.ops.convolve import convolve2d
+from npcl.solvers.deconv import deconv_path
+
+
+def test_batched_path_solutions_are_arrays():
+    rng = np.random.RandomState(0)
+    img = npcl.to_device(rng.rand(32, 32))
+    psf = npcl.to_device(np.ones((3, 3))/9)
+    mus = [1e-1, 1e-2, 1e-3, 1e-4]
+    _, xs, _, _ = deconv_path(img, psf, mus, batch_size=2, max_iter=5)
+    _, ref, _, _ = deconv_path(img, psf, mus, batch_size=1, max_iter=5)
+    assert len(xs) == len(mus)
+    for x in xs:
+        assert x.offset == 0
+        # every solution can be fed back into the ops
+        convolve2d(x, psf)
+    np.testing.assert_allclose(xs[0].get(), ref[0].get(), atol=1e-4)
@@ -0,0 +1,54 @@
+import numpy as np
+import pyopencl as cl
+import pytest
+import npcl
+from npcl.multidevice import Strips, denoise_tv_strips, deconv_fista_multi
+from npcl.regularizers.local import denoise_tv
+from npcl.solvers.deconv import deconv_fista
+
+
+@pytest.fixture
+def queues():
+    # three strips, on three contexts of the same device
+    device = cl.get_platforms()[0].get_devices()[0]
+    return [cl.CommandQueue(cl.Context([device])) for _ in range(3)]
+
+
+@pytest.fixture
+def image():
+    return np.random.RandomState(0).rand(60, 50).astype(np.float32)
+
+
+def test_denoise_tv_strips(queues, image):
+    x = Strips.scatter(image, queues, 2)
+    res = denoise_tv_strips(x, 0.5).gather()
+    ref = denoise_tv(npcl.to_device(image), 0.5).get()
+    np.testing.assert_allclose(res, ref, atol=1e-5)
+
+
+def test_denoise_tv_strips_halo(queues, image):
+    with pytest.raises(ValueError):
+        denoise_tv_strips(Strips.scatter(image, queues, 1), 0.5)
+
+
+def test_deconv_fista_multi(queues, image):
+    # a 3x3 PSF, whose radius is smaller than the halo of the TV steps
+    psf = np.ones((3, 3), np.float32)/9
+    res, _ = deconv_fista_multi(
+        image, psf, queues, mu=5, max_iter=20, delta=1.5)
+    ref, _ = deconv_fista(
+        npcl.to_device(image), npcl.to_device(psf), mu=5, max_iter=20,
+        delta=1.5,
+        )
+    np.testing.assert_allclose(res, ref.get(), atol=1e-4)
+
+
+def test_deconv_fista_multi_step(queues, image):
+    # the step size estimated by power iteration, as on a single device
+    psf = np.ones((3, 3), np.float32)/9
+    res, _ = deconv_fista_multi(image, psf, queues, mu=5, max_iter=20)
+    ref, _ = deconv_fista(
+        npcl.to_device(image), npcl.to_device(psf), mu=5, max_iter=20,
+        )
+    assert np.all(np.isfinite(res))
+    np.testing.assert_allclose(res, ref.get(), atol=1e-3)